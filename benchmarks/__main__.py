@@ -0,0 +1,4 @@
+# python -m benchmarks: the end-to-end suite, see benchmarks/e2e.py
+from .e2e import main
+
+main()
@@ -0,0 +1,110 @@
+# Benchmark of the Content-Encoding of the HTTP(S) legs on HL7 payloads
+# (ACK, ORU with a base64 PDF, MDM with a text report): compressed size,
+# compression and decompression times per encoding and level, and the
+# latency saved on a link of each bandwidth (transfer time saved minus the
+# time spent compressing and decompressing; negative is a loss).
+#
+#   python -m benchmarks.compression [--repeat N] [--bandwidths 10,100,1000]
+import argparse
+import random
+import time
+
+from mllp_http_https.compression import ENCODINGS, compress, decompress
+
+from .mllp_framing import ACK, oru
+
+WORDS = (
+    b"patient presents with no acute distress findings consistent with mild "
+    b"chronic changes recommend follow up in six weeks impression normal study "
+    b"left right bilateral lesion measuring mm without evidence of"
+).split()
+
+
+def mdm(size, rng):
+    # MDM^T02 with a dictated text report as TX OBX segments
+    head = (
+        b"MSH|^~\\&|RIS|FAC|EHR|FAC|20220801000000||MDM^T02|3|P|2.5\r"
+        b"PID|||123456^^^FAC^MR||Doe^Jane||19700101|F\r"
+        b"TXA|1|RAD|TX|20220801000000\r"
+    )
+    segments = [head]
+    total = len(head)
+    i = 1
+    while total < size:
+        line = b" ".join(rng.choice(WORDS) for _ in range(12))
+        segment = b"OBX|%d|TX|REPORT||%s\r" % (i, line)
+        segments.append(segment)
+        total += len(segment)
+        i += 1
+    return b"".join(segments)
+
+
+def corpus(rng):
+    return [
+        ("ack", ACK),
+        ("oru-pdf-1mb", oru(1024 * 1024, rng)),
+        ("mdm-text-256kb", mdm(256 * 1024, rng)),
+    ]
+
+
+def levels(encoding):
+    return (1, 3, 10, 19) if encoding == "zstd" else (1, 6, 9)
+
+
+def timed(function, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser("compression")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--bandwidths", default="10,100,1000", help="Mbit/s, comma separated"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    bandwidths = [float(b) for b in args.bandwidths.split(",")]
+
+    print(
+        "{:<16} {:<8} {:>5} {:>10} {:>7} {:>9} {:>9}".format(
+            "payload", "encoding", "level", "bytes", "ratio", "comp ms", "decomp ms"
+        )
+        + "".join(" {:>12}".format("saved@%gM" % b) for b in bandwidths)
+    )
+    for name, payload in corpus(random.Random(args.seed)):
+        for encoding in ENCODINGS:
+            for level in levels(encoding):
+                compress_time, compressed = timed(
+                    lambda: compress(payload, encoding, level), args.repeat
+                )
+                decompress_time, decompressed = timed(
+                    lambda: decompress(compressed, encoding), args.repeat
+                )
+                assert decompressed == payload
+                saved = [
+                    (len(payload) - len(compressed)) * 8 / (b * 1e6)
+                    - compress_time
+                    - decompress_time
+                    for b in bandwidths
+                ]
+                print(
+                    "{:<16} {:<8} {:>5} {:>10} {:>7.3f} {:>9.3f} {:>9.3f}".format(
+                        name,
+                        encoding,
+                        level,
+                        len(compressed),
+                        len(compressed) / len(payload),
+                        compress_time * 1000,
+                        decompress_time * 1000,
+                    )
+                    + "".join(" {:>10.3f}ms".format(s * 1000) for s in saved)
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+# End-to-end benchmark of the four bridges against in-process stand-ins: an
+# MLLP ACK server and an HTTP(S) backend, with configurable delay and ACK
+# size. Each bridge runs in its own process; results are printed as JSON so
+# that runs from different commits can be diffed.
+#
+#   python -m benchmarks.e2e [--bridges http2mllp,mllp2http] [--concurrency 1,16]
+#                            [--sizes 1024,65536] [--output results.json]
+import argparse
+import asyncio
+import json
+import os
+import platform
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+from .mllp_engines import free_port, sender as mllp_sender, wait_listening
+from .standins import HttpBackend, MllpBackend, sized_ack
+from .tls_accept import self_signed
+
+BRIDGES = ("http2mllp", "https2mllp", "mllp2http", "mllp2https")
+
+SERVERS = {
+    "http2mllp": """
+import mllp_http_https.http2mllp as m
+m.serve(
+    ("127.0.0.1", port),
+    m.HttpServerOptions(timeout=30, content_type="application/hl7-v2", keep_alive=None, engine=engine),
+    backend,
+    m.MllpClientOptions(keep_alive=-1, max_messages=-1, timeout=30),
+)
+""",
+    "https2mllp": """
+import mllp_http_https.https2mllp as m
+m.serve(
+    ("127.0.0.1", port),
+    m.HttpsServerOptions(
+        timeout=30, content_type="application/hl7-v2", certfile=certfile, keyfile=keyfile,
+        keep_alive=None, username=None, password=None, mllp_parser=True, engine=engine,
+    ),
+    backend,
+    m.MllpClientOptions(keep_alive=-1, max_messages=-1, timeout=30),
+)
+""",
+    "mllp2http": """
+import urllib.parse
+import mllp_http_https.mllp2http as m
+m.serve(
+    address=("127.0.0.1", port),
+    options=m.MllpServerOptions(timeout=None, engine=engine),
+    http_url=urllib.parse.urlparse("http://localhost:%d/" % backend[1]),
+    http_options=m.HttpClientOptions(content_type="application/hl7-v2", timeout=30),
+)
+""",
+    "mllp2https": """
+import urllib.parse
+import mllp_http_https.mllp2https as m
+m.serve(
+    address=("127.0.0.1", port),
+    options=m.MllpServerOptions(timeout=None, engine=engine),
+    https_url=urllib.parse.urlparse("https://localhost:%d/" % backend[1]),
+    https_options=m.HttpsClientOptions(
+        content_type="application/hl7-v2", timeout=30, verify=certfile, username=None, password=None,
+    ),
+)
+""",
+}
+
+PRELUDE = """
+import sys
+port, backend_port, engine, certfile, keyfile = sys.argv[1:]
+port = int(port)
+backend = ("127.0.0.1", int(backend_port))
+"""
+
+
+def process_usage(pid):
+    # (cpu seconds, peak rss in kB) of a process, Linux only
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            fields = f.read().rpartition(")")[2].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        with open("/proc/{}/status".format(pid)) as f:
+            peak = next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+    except (OSError, StopIteration):
+        return None, None
+    return cpu, peak
+
+
+async def http_sender(address, context, messages, message, latencies):
+    # HTTP(S) client, reusing the connection while the bridge keeps it
+    # alive; returns False on an error response or a dropped connection
+    head = (
+        b"POST / HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/hl7-v2\r\n"
+        b"Content-Length: %d\r\n\r\n" % len(message)
+    )
+    writer = None
+    try:
+        for _ in range(messages):
+            start = time.perf_counter()
+            if writer is None:
+                reader, writer = await asyncio.open_connection(
+                    *address,
+                    ssl=context,
+                    server_hostname="localhost" if context else None
+                )
+            writer.write(head + message)
+            response = await reader.readuntil(b"\r\n\r\n")
+            lines = response.split(b"\r\n")
+            version, _, status = lines[0].partition(b" ")
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(b":")
+                headers[name.strip().lower()] = value.strip().lower()
+            await reader.readexactly(int(headers.get(b"content-length", 0)))
+            if not status.startswith(b"200"):
+                return False
+            latencies.append(time.perf_counter() - start)
+            keep_alive = (
+                version == b"HTTP/1.1" or headers.get(b"connection") == b"keep-alive"
+            )
+            if not keep_alive or headers.get(b"connection") == b"close":
+                writer.close()
+                writer = None
+        return True
+    except (OSError, asyncio.IncompleteReadError):
+        return False
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def drive(bridge, address, context, concurrency, messages, message):
+    latencies = []
+    if bridge.startswith("http"):
+        senders = [
+            http_sender(address, context, messages, message, latencies)
+            for _ in range(concurrency)
+        ]
+    else:
+        senders = [
+            mllp_sender(address, messages, message, latencies)
+            for _ in range(concurrency)
+        ]
+    start = time.perf_counter()
+    results = await asyncio.gather(*senders, return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    failed = sum(1 for result in results if result is not True)
+    return latencies, elapsed, failed
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(bridge, engine, concurrency, size, args, backends, certfile, keyfile):
+    port = free_port()
+    backend_port = backends[bridge][1]
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            PRELUDE + SERVERS[bridge],
+            str(port),
+            str(backend_port),
+            engine,
+            certfile,
+            keyfile,
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    message = b"MSH|^~\\&|BENCH|FAC|RECV|FAC|20220801000000||ADT^A01|1|P|2.5\r"
+    message += b"NTE|1||" + b"X" * max(0, size - len(message) - 8) + b"\r"
+    context = None
+    if bridge == "https2mllp":
+        context = ssl.create_default_context(cafile=certfile)
+    try:
+        wait_listening(port)
+        # Warm up connections and imports
+        asyncio.run(drive(bridge, ("127.0.0.1", port), context, 1, 5, message))
+        cpu_before, _ = process_usage(process.pid)
+        latencies, elapsed, failed = asyncio.run(
+            drive(
+                bridge,
+                ("127.0.0.1", port),
+                context,
+                concurrency,
+                args.messages,
+                message,
+            )
+        )
+        cpu_after, peak = process_usage(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+    latencies.sort()
+    return {
+        "bridge": bridge,
+        "engine": engine,
+        "concurrency": concurrency,
+        "size": size,
+        "messages": len(latencies),
+        "failed_connections": failed,
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000 if latencies else None,
+        "p95_ms": percentile(latencies, 0.95) * 1000 if latencies else None,
+        "p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None,
+        "cpu_seconds": cpu_after - cpu_before if cpu_before is not None else None,
+        "peak_rss_kb": peak,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser("e2e")
+    parser.add_argument("--bridges", default=",".join(BRIDGES))
+    parser.add_argument("--engines", default="threaded")
+    parser.add_argument("--concurrency", default="1,16")
+    parser.add_argument("--sizes", default="1024,65536")
+    parser.add_argument("--messages", type=int, default=200, help="per connection")
+    parser.add_argument(
+        "--delay", type=float, default=0.0, help="stand-in delay, in seconds"
+    )
+    parser.add_argument(
+        "--ack-size", type=int, default=0, help="stand-in ACK size, in bytes"
+    )
+    parser.add_argument("--output", default=None, help="JSON file, or stdout")
+    args = parser.parse_args()
+
+    ack = sized_ack(args.ack_size)
+    bridges = args.bridges.split(",")
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        certfile, keyfile = self_signed(directory)
+        server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        server_context.load_cert_chain(certfile, keyfile)
+
+        standins = [MllpBackend(args.delay, ack), HttpBackend(args.delay, ack)]
+        standins.append(HttpBackend(args.delay, ack, ssl=server_context))
+        mllp, http, https = (standin.start() for standin in standins)
+        backends = {
+            "http2mllp": mllp,
+            "https2mllp": mllp,
+            "mllp2http": http,
+            "mllp2https": https,
+        }
+        try:
+            for bridge in bridges:
+                for engine in args.engines.split(","):
+                    for concurrency in (int(c) for c in args.concurrency.split(",")):
+                        for size in (int(s) for s in args.sizes.split(",")):
+                            result = run(
+                                bridge,
+                                engine,
+                                concurrency,
+                                size,
+                                args,
+                                backends,
+                                certfile,
+                                keyfile,
+                            )
+                            results.append(result)
+                            print(
+                                "{bridge} {engine} c={concurrency} size={size}: "
+                                "{throughput:.0f} msg/s, {failed_connections} failed".format(
+                                    **result
+                                ),
+                                file=sys.stderr,
+                            )
+        finally:
+            for standin in standins:
+                standin.stop()
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "messages": args.messages,
+            "delay": args.delay,
+            "ack_size": len(ack),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# Cost of the metrics on the hot path: per observation, per message (the
+# instrumentation of one http2mllp request), and end to end, against the
+# same bridge with the metrics replaced by no-ops.
+#
+#   python -m benchmarks.metrics_overhead [--requests N] [--clients N]
+import argparse
+import http.client
+import subprocess
+import sys
+import threading
+import time
+
+from mllp_http_https import metrics
+
+from .mllp_engines import free_port, wait_listening
+from .standins import MllpBackend
+
+SERVER = """
+import sys
+import mllp_http_https.http2mllp as m
+from mllp_http_https import metrics
+port, mllp_port, engine, enabled = sys.argv[1:]
+if enabled == "off":
+    metrics.Histogram.observe = lambda self, value: None
+    metrics.Counter.inc = lambda self, *labels, value=1: None
+m.serve(
+    ("127.0.0.1", int(port)),
+    m.HttpServerOptions(timeout=30, content_type="application/hl7-v2", keep_alive=None, engine=engine),
+    ("127.0.0.1", int(mllp_port)),
+    m.MllpClientOptions(keep_alive=-1, max_messages=-1, timeout=30),
+)
+"""
+
+MESSAGE = b"MSH|^~\\&|BENCH|FAC|RECV|FAC|20220801000000||ADT^A01|1|P|2.5\r" * 20
+
+
+def per_call(function, calls, threads=1):
+    # Nanoseconds per call, with calls spread over threads
+    def run():
+        for _ in range(calls // threads):
+            function()
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (time.perf_counter() - start) / calls * 1e9
+
+
+def instrumented_message():
+    # What the http2mllp handler records for one message
+    start = time.perf_counter()
+    metrics.BODY_READ.observe(time.perf_counter() - start)
+    metrics.MESSAGES.inc()
+    metrics.BYTES.inc("in", value=1000)
+    start = time.perf_counter()
+    metrics.MLLP_ROUND_TRIP.observe(time.perf_counter() - start)
+    start = time.perf_counter()
+    metrics.PARSE_MLLP.observe(time.perf_counter() - start)
+    start = time.perf_counter()
+    metrics.RESPONSE_WRITE.observe(time.perf_counter() - start)
+    metrics.BYTES.inc("out", value=100)
+
+
+def client(port, requests, latencies):
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    for _ in range(requests):
+        start = time.perf_counter()
+        connection.request("POST", "/", body=MESSAGE)
+        connection.getresponse().read()
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+
+
+def bridge(engine, enabled, mllp_port, clients, requests):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-c", SERVER, str(port), str(mllp_port), engine, enabled],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    latencies = []
+    try:
+        wait_listening(port)
+        client(port, 50, [])  # warm up
+        workers = [
+            threading.Thread(target=client, args=(port, requests, latencies))
+            for _ in range(clients)
+        ]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        process.terminate()
+        process.wait()
+    latencies.sort()
+    return len(latencies) / elapsed, latencies[len(latencies) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser("metrics_overhead")
+    parser.add_argument("--calls", type=int, default=400000)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--engines", default="threaded,asyncio")
+    args = parser.parse_args()
+
+    histogram = metrics.Histogram("bench_seconds", "Benchmark.")
+    counter = metrics.Counter("bench_total", "Benchmark.", ("kind",))
+    for threads in (1, 8):
+        print(
+            "{} thread(s): observe {:.0f} ns, inc {:.0f} ns, message {:.0f} ns".format(
+                threads,
+                per_call(lambda: histogram.observe(0.0003), args.calls, threads),
+                per_call(lambda: counter.inc("in", value=10), args.calls, threads),
+                per_call(instrumented_message, args.calls // 10, threads),
+            )
+        )
+
+    backend = MllpBackend()
+    _, mllp_port = backend.start()
+    print("{:<10} {:>8} {:>10} {:>10}".format("engine", "metrics", "req/s", "p50 us"))
+    for engine in args.engines.split(","):
+        for enabled in ("off", "on", "off", "on"):
+            rate, p50 = bridge(engine, enabled, mllp_port, args.clients, args.requests)
+            print(
+                "{:<10} {:>8} {:>10.0f} {:>10.0f}".format(
+                    engine, enabled, rate, p50 * 1e6
+                )
+            )
+    backend.stop()
+
+
+if __name__ == "__main__":
+    main()
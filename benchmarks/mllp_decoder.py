@@ -0,0 +1,64 @@
+# Throughput of the MLLP frame decoder against the byte-at-a-time pipeline.
+#
+#   python -m benchmarks.mllp_decoder [--size BYTES] [--frames N] [--chunk BYTES]
+import argparse
+import io
+import time
+
+from mllp_http_https.mllp import read_mllp, read_mllp_chunks
+from mllp_http_https.net import read_socket_bytes, read_socket_chunks
+
+
+def make_stream(size, frames):
+    segment = b"OBX|1|ED|PDF^Base64||" + b"QUJD" * 64 + b"\r"
+    payload = (segment * (size // len(segment) + 1))[:size]
+    return b"\x0b" + payload + b"\x1c\x0d", frames
+
+
+def run(name, decode, stream, frames, repeat):
+    best = None
+    for _ in range(repeat):
+        rfile = io.BufferedReader(io.BytesIO(stream * frames))
+        start = time.perf_counter()
+        count = sum(1 for _ in decode(rfile))
+        elapsed = time.perf_counter() - start
+        assert count == frames, (name, count)
+        best = elapsed if best is None else min(best, elapsed)
+    total = len(stream) * frames
+    print(
+        "{:<10} {:>10.1f} MB/s {:>10.1f} frames/s".format(
+            name, total / best / 1e6, frames / best
+        )
+    )
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser("mllp_decoder")
+    parser.add_argument("--size", type=int, default=200 * 1024)
+    parser.add_argument("--frames", type=int, default=20)
+    parser.add_argument("--chunk", type=int, default=64 * 1024)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    stream, frames = make_stream(args.size, args.frames)
+    print("{} frames of {} bytes".format(frames, args.size))
+    before = run(
+        "bytes",
+        lambda rfile: read_mllp(read_socket_bytes(rfile)),
+        stream,
+        frames,
+        args.repeat,
+    )
+    after = run(
+        "chunks",
+        lambda rfile: read_mllp_chunks(read_socket_chunks(rfile, args.chunk)),
+        stream,
+        frames,
+        args.repeat,
+    )
+    print("speedup    {:>10.1f}x".format(before / after))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+# Connection scaling of the mllp2http engines: many concurrent MLLP senders
+# against one bridge, reporting throughput, server threads and RSS.
+#
+#   python -m benchmarks.mllp_engines [--connections 10,100,500] [--messages N]
+import argparse
+import asyncio
+import socket
+import subprocess
+import sys
+import time
+
+from mllp_http_https.mllp import MllpDecoder, frame_mllp
+
+from .standins import HttpBackend
+
+SERVER = """
+import sys, urllib.parse
+import mllp_http_https.mllp2http as m
+m.serve(
+    address=("127.0.0.1", int(sys.argv[1])),
+    options=m.MllpServerOptions(timeout=None, engine=sys.argv[2]),
+    http_url=urllib.parse.urlparse(sys.argv[3]),
+    http_options=m.HttpClientOptions(content_type="application/hl7-v2", timeout=30),
+)
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def process_status(pid):
+    # (threads, rss in kB) of a process, Linux only
+    status = {}
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                status[name] = value.split()[:1]
+    except OSError:
+        return None, None
+    return int(status["Threads"][0]), int(status["VmRSS"][0])
+
+
+async def sender(address, messages, message, latencies):
+    # Returns False if the connection was refused or dropped by the bridge
+    try:
+        reader, writer = await asyncio.open_connection(*address)
+        decoder = MllpDecoder()
+        for _ in range(messages):
+            start = time.perf_counter()
+            writer.write(frame_mllp(message))
+            frame = decoder.next_frame()
+            while frame is None:
+                data = await reader.read(64 * 1024)
+                if not data:
+                    return False
+                decoder.feed(data)
+                frame = decoder.next_frame()
+            latencies.append(time.perf_counter() - start)
+        writer.close()
+        return True
+    except ConnectionError:
+        return False
+
+
+async def drive(address, connections, messages, message, pid):
+    latencies = []
+    peak = [0, 0]
+
+    async def sample():
+        while True:
+            threads, rss = process_status(pid)
+            if threads is not None:
+                peak[0] = max(peak[0], threads)
+                peak[1] = max(peak[1], rss)
+            await asyncio.sleep(0.05)
+
+    sampler = asyncio.ensure_future(sample())
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *(sender(address, messages, message, latencies) for _ in range(connections))
+    )
+    elapsed = time.perf_counter() - start
+    sampler.cancel()
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] if latencies else float("nan")
+    return len(latencies) / elapsed, p50, results.count(False), peak
+
+
+def wait_listening(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("bridge did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser("mllp_engines")
+    parser.add_argument("--connections", default="10,100,500")
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--size", type=int, default=2 * 1024)
+    parser.add_argument("--engines", default="threaded,asyncio")
+    args = parser.parse_args()
+
+    backend = HttpBackend()
+    host, port = backend.start()
+    url = "http://{}:{}/".format(host, port)
+    message = b"MSH|^~\\&|" + b"X" * args.size + b"\r"
+
+    print(
+        "{:<10} {:>11} {:>7} {:>10} {:>10} {:>8} {:>9}".format(
+            "engine", "connections", "failed", "msg/s", "p50 ms", "threads", "rss MB"
+        )
+    )
+    for engine in args.engines.split(","):
+        for connections in (int(c) for c in args.connections.split(",")):
+            bridge_port = free_port()
+            process = subprocess.Popen(
+                [sys.executable, "-c", SERVER, str(bridge_port), engine, url],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            try:
+                wait_listening(bridge_port)
+                rate, p50, failed, (threads, rss) = asyncio.run(
+                    drive(
+                        ("127.0.0.1", bridge_port),
+                        connections,
+                        args.messages,
+                        message,
+                        process.pid,
+                    )
+                )
+            finally:
+                process.terminate()
+                process.wait()
+            print(
+                "{:<10} {:>11} {:>7} {:>10.0f} {:>10.2f} {:>8} {:>9.1f}".format(
+                    engine,
+                    connections,
+                    failed,
+                    rate,
+                    p50 * 1000,
+                    threads,
+                    rss / 1024,
+                )
+            )
+    backend.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+# Micro-benchmark of the MLLP framing functions on a corpus of realistic HL7
+# frames (tiny ACKs, a 1 MB ORU with base64 OBX, back-to-back frames), in
+# MB/s and frames/s, plus a fuzz mode checking that decoding does not depend
+# on how the stream is split into chunks. A faster framer has to pass the
+# fuzz mode before its numbers count.
+#
+#   python -m benchmarks.mllp_framing [--repeat N] [--only read_mllp,parse_mllp]
+#   python -m benchmarks.mllp_framing --fuzz 2000 [--seed S]
+import argparse
+import base64
+import io
+import logging
+import random
+import socket
+import sys
+import threading
+import time
+
+from mllp_http_https.mllp import (
+    MllpDecoder,
+    MllpError,
+    MllpReader,
+    ParseMode,
+    frame_mllp,
+    logger as mllp_logger,
+    parse_mllp,
+    read_mllp,
+    read_mllp_chunks,
+    send_mllp,
+    sendall_mllp,
+    write_mllp,
+)
+
+ACK = b"MSH|^~\\&|RCV|FAC|SND|FAC|20220801000000||ACK^R01|1|P|2.5\rMSA|AA|1\r"
+
+
+def oru(size, rng):
+    # ORU^R01 with a PDF report as base64 OBX segments, of about size bytes
+    head = (
+        b"MSH|^~\\&|LAB|FAC|EHR|FAC|20220801000000||ORU^R01|2|P|2.5\r"
+        b"PID|||123456^^^FAC^MR||Doe^Jane||19700101|F\r"
+        b"OBR|1||789|PDF^Report\r"
+    )
+    segments = [head]
+    total = len(head)
+    i = 1
+    while total < size:
+        data = base64.b64encode(rng.randbytes(48 * 1024))
+        segment = b"OBX|%d|ED|PDF^Base64||^application^pdf^Base64^%s\r" % (i, data)
+        segments.append(segment)
+        total += len(segment)
+        i += 1
+    return b"".join(segments)[: size - 1] + b"\r"
+
+
+def corpus(rng):
+    # (name, payloads) used for timings
+    return [
+        ("ack", [ACK] * 2000),
+        ("oru-1mb", [oru(1024 * 1024, rng)]),
+        ("mixed", [ACK, oru(16 * 1024, rng), ACK.replace(b"\r", b"\r\n")] * 100),
+    ]
+
+
+def malformed():
+    # (name, stream, frames decoded before the error)
+    frame = frame_mllp(ACK)
+    return [
+        ("garbage-before-start", b"X" + frame, []),
+        ("lf-before-start", b"\n" + frame, []),
+        ("start-in-content", b"\x0bMSH\x0b" + frame, []),
+        ("missing-cr", frame[:-1] + frame, [ACK]),
+        ("missing-cr-at-eof", frame[:-1], [ACK]),
+        ("truncated", frame + frame[: len(frame) // 2], [ACK]),
+        ("end-without-start", frame + b"MSA|AA\x1c\r", [ACK]),
+        ("trailing-start", frame + b"\x0b", [ACK]),
+    ]
+
+
+# Timings
+
+
+def measure(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def chunked(data, size):
+    with memoryview(data) as view:
+        for i in range(0, len(data), size):
+            yield bytes(view[i : i + size])
+
+
+def echo_ack(s):
+    # Peer of send_mllp: reads frames and answers each with an ACK
+    reader = MllpReader(s)
+    try:
+        while True:
+            reader.read()
+            sendall_mllp(s, ACK)
+    except (MllpError, OSError):
+        pass
+
+
+def send_all(payloads):
+    a, b = socket.socketpair()
+    peer = threading.Thread(target=echo_ack, args=(b,), daemon=True)
+    peer.start()
+    try:
+        reader = MllpReader(a)
+        for payload in payloads:
+            assert send_mllp(a, payload, reader) == ACK
+    finally:
+        a.close()
+        peer.join()
+        b.close()
+
+
+def functions(payloads):
+    # (name, callable processing the whole corpus once)
+    stream = b"".join(frame_mllp(payload) for payload in payloads)
+    frames = [frame_mllp(payload) for payload in payloads]
+
+    def decode(frames_iter):
+        count = sum(1 for _ in frames_iter)
+        assert count == len(payloads), count
+
+    def write():
+        wfile = io.BytesIO()
+        for payload in payloads:
+            write_mllp(wfile, payload)
+
+    def parse(mode):
+        return lambda: [parse_mllp(frame, mode) for frame in frames]
+
+    return [
+        ("read_mllp", lambda: decode(read_mllp(iter(stream)))),
+        (
+            "read_mllp_chunks",
+            lambda: decode(read_mllp_chunks(chunked(stream, 64 * 1024))),
+        ),
+        ("frame_mllp", lambda: [frame_mllp(payload) for payload in payloads]),
+        ("write_mllp", write),
+        ("send_mllp", lambda: send_all(payloads)),
+    ] + [("parse_mllp " + mode, parse(mode)) for mode in ParseMode.ALL]
+
+
+def bench(args):
+    rng = random.Random(args.seed)
+    only = args.only.split(",") if args.only else None
+    print("{:<26} {:<8} {:>10} {:>12}".format("function", "corpus", "MB/s", "frames/s"))
+    for name, payloads in corpus(rng):
+        size = sum(len(payload) for payload in payloads)
+        for function_name, function in functions(payloads):
+            if only and function_name.split()[0] not in only:
+                continue
+            best = measure(function, args.repeat)
+            print(
+                "{:<26} {:<8} {:>10.1f} {:>12.0f}".format(
+                    function_name, name, size / best / 1e6, len(payloads) / best
+                )
+            )
+
+
+# Fuzzing
+
+
+def reference(stream):
+    # Frames and error of the byte-at-a-time read_mllp, the reference framer
+    errors = []
+    handler = logging.Handler()
+    handler.emit = lambda record: errors.append(record.getMessage())
+    mllp_logger.addHandler(handler)
+    frames = []
+    try:
+        for frame in read_mllp(iter(stream)):
+            frames.append(frame)
+    except TypeError:
+        # read_mllp does not handle the end of the stream inside a frame
+        errors.append(None)
+    finally:
+        mllp_logger.removeHandler(handler)
+    return frames, errors[0] if errors else False
+
+
+def decode(chunks):
+    # Frames and error of MllpDecoder fed with chunks
+    decoder = MllpDecoder()
+    frames = []
+    try:
+        for chunk in chunks:
+            decoder.feed(chunk)
+            frame = decoder.next_frame()
+            while frame is not None:
+                frames.append(frame)
+                frame = decoder.next_frame()
+        decoder.close()
+    except MllpError as e:
+        return frames, str(e)
+    return frames, None
+
+
+def splits(stream, rng, exhaustive):
+    # Chunkings of stream: at every byte boundary (if exhaustive), one byte
+    # at a time, and at random cut points
+    yield [stream]
+    yield [stream[i : i + 1] for i in range(len(stream))]
+    if exhaustive:
+        for i in range(len(stream) + 1):
+            yield [stream[:i], stream[i:]]
+    for _ in range(8):
+        cuts = sorted(rng.randrange(len(stream) + 1) for _ in range(rng.randint(1, 8)))
+        yield [stream[i:j] for i, j in zip([0] + cuts, cuts + [len(stream)])]
+
+
+def check_stream(stream, rng, exhaustive=False):
+    expected_frames, expected_error = reference(stream)
+    for chunks in splits(stream, rng, exhaustive):
+        frames, error = decode(chunks)
+        sizes = [len(chunk) for chunk in chunks]
+        assert frames == expected_frames, (stream, sizes, frames, expected_frames)
+        assert (error is None) == (expected_error is False), (stream, sizes, error)
+        # The legacy framer has no message for a stream ending in a frame
+        if expected_error:
+            assert error == expected_error, (stream, sizes, error, expected_error)
+    frames = list(read_mllp_chunks(chunked(stream, rng.randint(1, 64))))
+    assert frames == expected_frames, (stream, frames, expected_frames)
+    return expected_frames, expected_error
+
+
+def random_payload(rng):
+    alphabet = b"MSHPIDOBXACK|^~\\&0123456789 \r\r\r\n"
+    payload = bytes(rng.choice(alphabet) for _ in range(rng.randint(0, 40)))
+    if rng.random() < 0.1:
+        payload += base64.b64encode(rng.randbytes(rng.randint(0, 300)))
+    return payload
+
+
+def random_stream(rng):
+    # Back-to-back frames, sometimes damaged with a framing byte inserted,
+    # a byte dropped, or the end cut off
+    payloads = [random_payload(rng) for _ in range(rng.randint(0, 4))]
+    stream = bytearray(b"".join(frame_mllp(payload) for payload in payloads))
+    damage = rng.random()
+    if damage < 0.2:
+        stream.insert(rng.randint(0, len(stream)), rng.choice(b"\x0b\x1c\r\nX"))
+    elif damage < 0.3 and stream:
+        del stream[rng.randrange(len(stream))]
+    elif damage < 0.4:
+        del stream[rng.randint(0, len(stream)) :]
+    return bytes(stream), payloads, damage < 0.4
+
+
+def check_roundtrip(payload, rng):
+    # Payload through framing, parse_mllp and a socket read with small recvs
+    frame = frame_mllp(payload)
+    wfile = io.BytesIO()
+    write_mllp(wfile, payload)
+    assert wfile.getvalue() == frame
+    for data in (payload, frame):
+        assert parse_mllp(data, ParseMode.RAW) == frame, data
+        assert parse_mllp(data, ParseMode.STRIP_FRAMING) == payload, data
+        crlf = payload.replace(b"\r\n", b"\r").replace(b"\r", b"\r\n")
+        assert parse_mllp(data, ParseMode.CRLF) == crlf, data
+    a, b = socket.socketpair()
+    with a, b:
+        sendall_mllp(a, payload)
+        sendall_mllp(a, ACK)
+        reader = MllpReader(b, recv_size=rng.randint(1, 16))
+        assert reader.read() == payload
+        assert reader.read() == ACK
+
+
+def fuzz(args):
+    rng = random.Random(args.seed)
+    # The errors are expected, and checked
+    mllp_logger.propagate = False
+    mllp_logger.addHandler(logging.NullHandler())
+
+    count = 0
+    for name, stream, frames in malformed():
+        decoded, error = check_stream(stream, rng, exhaustive=True)
+        assert decoded == frames and error is not False, (name, decoded, error)
+        count += 1
+    for name, payloads in corpus(random.Random(args.seed)):
+        if name == "oru-1mb":
+            payloads = [payloads[0][:2048]]
+        stream = b"".join(frame_mllp(payload) for payload in payloads[:10])
+        decoded, error = check_stream(stream, rng, exhaustive=len(stream) < 4096)
+        assert decoded == payloads[:10] and error is False, name
+        count += 1
+    print("corpus: {} streams ok, split at every byte boundary".format(count))
+
+    damaged = 0
+    for i in range(args.fuzz):
+        stream, payloads, damage = random_stream(rng)
+        decoded, error = check_stream(stream, rng)
+        if not damage:
+            assert decoded == payloads and error is False, (stream, decoded, error)
+        damaged += error is not False
+        for payload in payloads:
+            check_roundtrip(payload, rng)
+    print(
+        "fuzz: {} streams ok ({} malformed), seed {}".format(
+            args.fuzz, damaged, args.seed
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser("mllp_framing")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", default=None, help="function names, comma separated")
+    parser.add_argument("--fuzz", type=int, default=0, help="random streams to check")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    if args.seed is None:
+        args.seed = random.randrange(2**32)
+
+    if args.fuzz:
+        try:
+            fuzz(args)
+        except AssertionError as e:
+            print("seed {}: {!r}".format(args.seed, e), file=sys.stderr)
+            sys.exit(1)
+    else:
+        bench(args)
+
+
+if __name__ == "__main__":
+    main()
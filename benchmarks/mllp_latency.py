@@ -0,0 +1,81 @@
+# Round-trip latency of MLLP frame writes over loopback TCP: the previous
+# three-write framing against a single sendmsg, with and without TCP_NODELAY.
+#
+#   python -m benchmarks.mllp_latency [--messages N] [--size BYTES]
+import argparse
+import socket
+import threading
+import time
+
+from mllp_http_https.mllp import END_BLOCK, START_BLOCK, MllpReader, sendall_mllp
+from mllp_http_https.net import set_no_delay
+
+ACK = b"MSH|^~\\&|RECEIVER|FAC|SENDER|FAC|20220801||ACK^A01|1|P|2.5\rMSA|AA|1\r"
+
+
+def legacy_send(s, content):
+    s.sendall(START_BLOCK)
+    s.sendall(content)
+    s.sendall(END_BLOCK)
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run(send, no_delay, messages, size):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+
+    def serve():
+        connection, _ = listener.accept()
+        if no_delay:
+            set_no_delay(connection)
+        reader = MllpReader(connection)
+        try:
+            for _ in range(messages):
+                reader.read()
+                send(connection, ACK)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+
+    client = socket.create_connection(listener.getsockname())
+    if no_delay:
+        set_no_delay(client)
+    reader = MllpReader(client)
+    message = b"MSH|^~\\&|" + b"X" * size + b"\r"
+    latencies = []
+    for _ in range(messages):
+        start = time.perf_counter()
+        send(client, message)
+        reader.read()
+        latencies.append(time.perf_counter() - start)
+    client.close()
+    thread.join()
+    listener.close()
+
+    latencies.sort()
+    return percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser("mllp_latency")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--size", type=int, default=2 * 1024)
+    args = parser.parse_args()
+
+    print("{:<10} {:<8} {:>10} {:>10}".format("write", "nodelay", "p50 ms", "p99 ms"))
+    for name, send in (("legacy", legacy_send), ("sendmsg", sendall_mllp)):
+        for no_delay in (False, True):
+            p50, p99 = run(send, no_delay, args.messages, args.size)
+            print(
+                "{:<10} {:<8} {:>10.3f} {:>10.3f}".format(name, str(no_delay), p50, p99)
+            )
+
+
+if __name__ == "__main__":
+    main()
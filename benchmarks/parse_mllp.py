@@ -0,0 +1,73 @@
+# Parity checks and timings of parse_mllp against the previous str-based
+# implementation (with its CRLF check corrected, so both do the same work).
+#
+#   python -m benchmarks.parse_mllp [--size BYTES] [--number N]
+import argparse
+import timeit
+
+from mllp_http_https.mllp import ParseMode, frame_mllp, parse_mllp
+
+
+def legacy_parse_mllp(mllp_data, crlf):
+    hl7_text = mllp_data.decode("utf-8")
+    hl7_text = hl7_text.replace("\x0b", "")
+    hl7_text = hl7_text.replace("\x1c\r", "")
+    if crlf:
+        hl7_text = hl7_text.replace("\r\n", "\r").replace("\r", "\r\n")
+    return bytes(hl7_text, "utf-8")
+
+
+def corpus():
+    ack = b"MSH|^~\\&|RCV|FAC|SND|FAC|20220801||ACK^R01|1|P|2.5\rMSA|AA|1\r"
+    yield ack
+    yield ack.replace(b"\r", b"\r\n")
+    yield ack.replace(b"\r", b"\r\n", 1)
+    yield ack.rstrip(b"\r")
+    yield "MSH|^~\\&|RCV|FAC|SND|FAC\rPID|||1||Müller^José\r".encode("utf-8")
+    yield b""
+    yield b"\r"
+
+
+def check_parity():
+    count = 0
+    for payload in corpus():
+        for data in (payload, frame_mllp(payload)):
+            expected = legacy_parse_mllp(frame_mllp(payload), crlf=False)
+            assert parse_mllp(data, ParseMode.STRIP_FRAMING) == expected, data
+            expected = legacy_parse_mllp(frame_mllp(payload), crlf=True)
+            assert parse_mllp(data, ParseMode.CRLF) == expected, data
+            assert parse_mllp(data, ParseMode.RAW) == frame_mllp(payload), data
+            count += 3
+    # Non UTF-8 feeds are passed through instead of raising
+    latin1 = "PID|||1||Müller\r".encode("latin-1")
+    assert parse_mllp(frame_mllp(latin1), ParseMode.CRLF) == latin1.replace(
+        b"\r", b"\r\n"
+    )
+    print("parity: {} cases ok".format(count + 1))
+
+
+def main():
+    parser = argparse.ArgumentParser("parse_mllp")
+    parser.add_argument("--size", type=int, default=1024 * 1024)
+    parser.add_argument("--number", type=int, default=50)
+    args = parser.parse_args()
+
+    check_parity()
+
+    segment = b"OBX|1|ED|PDF^Base64||" + b"QUJD" * 64 + b"\r"
+    frame = frame_mllp((segment * (args.size // len(segment) + 1))[: args.size])
+    print("{:<16} {:>12} {:>12}".format("mode", "legacy us", "bytes us"))
+    for mode, crlf in ((ParseMode.STRIP_FRAMING, False), (ParseMode.CRLF, True)):
+        legacy = timeit.timeit(
+            lambda: legacy_parse_mllp(frame, crlf), number=args.number
+        )
+        current = timeit.timeit(lambda: parse_mllp(frame, mode), number=args.number)
+        print(
+            "{:<16} {:>12.1f} {:>12.1f}".format(
+                mode, legacy / args.number * 1e6, current / args.number * 1e6
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# In-process stand-ins for the peers of the bridges, each running its own
+# event loop on a daemon thread.
+import asyncio
+import threading
+
+from mllp_http_https.mllp import MllpDecoder, MllpError, frame_mllp
+
+ACK = (
+    b"MSH|^~\\&|RECEIVER|FAC|SENDER|FAC|20220801000000||ACK^R01|1|P|2.5\r" b"MSA|AA|1\r"
+)
+
+
+def sized_ack(size):
+    # ACK padded with an NTE segment to about size bytes
+    padding = max(0, size - len(ACK) - 8)
+    return ACK + b"NTE|1||" + b"X" * padding + b"\r"
+
+
+class Standin:
+    def __init__(self, handler, ssl=None):
+        self.handler = handler
+        self.ssl = ssl
+        self.address = None
+        self.loop = asyncio.new_event_loop()
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self, host="127.0.0.1", port=0):
+        self._host, self._port = host, port
+        self._thread.start()
+        self._started.wait()
+        return self.address
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        server = self.loop.run_until_complete(
+            asyncio.start_server(self.handler, self._host, self._port, ssl=self.ssl)
+        )
+        self.address = server.sockets[0].getsockname()[:2]
+        self._started.set()
+        self.loop.run_forever()
+        server.close()
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+
+class HttpBackend(Standin):
+    # HTTP/1.1 keep-alive server answering every POST with an ACK (HTTPS
+    # with an ssl context)
+
+    def __init__(self, delay=0.0, ack=ACK, ssl=None):
+        super().__init__(self._handle, ssl)
+        self.delay = delay
+        self.ack = ack
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.split(b"\r\n"):
+                    name, _, value = line.partition(b":")
+                    if name.strip().lower() == b"content-length":
+                        length = int(value)
+                await reader.readexactly(length)
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/hl7-v2\r\n"
+                    b"Content-Length: %d\r\n\r\n" % len(self.ack) + self.ack
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.CancelledError, OSError):
+            pass
+        finally:
+            writer.close()
+
+
+class MllpBackend(Standin):
+    # MLLP server answering every message with an ACK
+
+    def __init__(self, delay=0.0, ack=ACK):
+        super().__init__(self._handle)
+        self.delay = delay
+        self.ack = ack
+
+    async def _handle(self, reader, writer):
+        decoder = MllpDecoder()
+        try:
+            while True:
+                data = await reader.read(64 * 1024)
+                if not data:
+                    break
+                decoder.feed(data)
+                while decoder.next_frame() is not None:
+                    if self.delay:
+                        await asyncio.sleep(self.delay)
+                    writer.write(frame_mllp(self.ack))
+                await writer.drain()
+        except (asyncio.CancelledError, ConnectionError, MllpError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,148 @@
+# Peak memory of http2mllp under concurrent large uploads, with the body
+# read whole and with streaming (--stream-threshold): the bridge runs in its
+# own process against an MLLP stand-in that discards the messages as they
+# arrive, and the growth of its peak RSS (VmHWM) over a small warm-up
+# message is reported for each engine.
+#
+#   python -m benchmarks.streaming_rss [--size 52428800] [--concurrency 4]
+#                                      [--engines threaded,asyncio]
+import argparse
+import asyncio
+import subprocess
+import sys
+import time
+
+from mllp_http_https.mllp import MllpDecoder, MllpError, frame_mllp
+
+from .e2e import process_usage
+from .mllp_engines import free_port, wait_listening
+from .standins import ACK, Standin
+
+SERVER = """
+import sys
+import mllp_http_https.http2mllp as m
+port, backend_port, engine, threshold = sys.argv[1:]
+m.serve(
+    ("127.0.0.1", int(port)),
+    m.HttpServerOptions(
+        timeout=60, content_type="application/hl7-v2", keep_alive=None, engine=engine,
+        stream_threshold=int(threshold) if threshold != "off" else None,
+    ),
+    ("127.0.0.1", int(backend_port)),
+    m.MllpClientOptions(keep_alive=-1, max_messages=-1, timeout=60),
+)
+"""
+
+
+class DiscardingMllpBackend(Standin):
+    # MLLP server answering every message with an ACK, without keeping the
+    # messages, so that it does not hold 50 MB per connection itself
+
+    def __init__(self):
+        super().__init__(self._handle)
+
+    async def _handle(self, reader, writer):
+        decoder = MllpDecoder()
+        try:
+            while True:
+                data = await reader.read(64 * 1024)
+                if not data:
+                    break
+                decoder.feed(data)
+                part = decoder.next_part()
+                while part is not None:
+                    if part[1]:
+                        writer.write(frame_mllp(ACK))
+                    part = decoder.next_part()
+                await writer.drain()
+        except (asyncio.CancelledError, ConnectionError, MllpError):
+            pass
+        finally:
+            writer.close()
+
+
+def message(size):
+    head = b"MSH|^~\\&|BENCH|FAC|RECV|FAC|20220801000000||ORU^R01|1|P|2.5\r"
+    return head + b"OBX|1|ED|PDF||" + b"A" * max(0, size - len(head) - 16) + b"\r"
+
+
+async def upload(port, body):
+    # One POST; returns whether it got a 200 with a complete body
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        writer.write(
+            b"POST / HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/hl7-v2\r\n"
+            b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body)
+        )
+        with memoryview(body) as view:
+            for offset in range(0, len(body), 1024 * 1024):
+                writer.write(view[offset : offset + 1024 * 1024])
+                await writer.drain()
+        head = await reader.readuntil(b"\r\n\r\n")
+        await reader.read()
+        return head.split(b" ", 2)[1] == b"200"
+    except (OSError, asyncio.IncompleteReadError):
+        return False
+    finally:
+        writer.close()
+
+
+async def uploads(port, body, concurrency):
+    return await asyncio.gather(*(upload(port, body) for _ in range(concurrency)))
+
+
+def run(engine, threshold, backend, args, body):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-c", SERVER, str(port), str(backend[1]), engine, threshold],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_listening(port)
+        asyncio.run(uploads(port, message(4096), 1))
+        _, baseline = process_usage(process.pid)
+        start = time.perf_counter()
+        results = asyncio.run(uploads(port, body, args.concurrency))
+        elapsed = time.perf_counter() - start
+        _, peak = process_usage(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+    return results.count(True), elapsed, baseline, peak
+
+
+def main():
+    parser = argparse.ArgumentParser("streaming_rss")
+    parser.add_argument("--size", type=int, default=50 * 1024 * 1024)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--engines", default="threaded,asyncio")
+    parser.add_argument("--threshold", type=int, default=1024 * 1024)
+    args = parser.parse_args()
+
+    body = message(args.size)
+    backend = DiscardingMllpBackend()
+    backend.start()
+    print(
+        "{:<9} {:<10} {:>4} {:>8} {:>12} {:>12} {:>12}".format(
+            "engine", "mode", "ok", "seconds", "base kB", "peak kB", "growth kB"
+        )
+    )
+    for engine in args.engines.split(","):
+        for mode, threshold in (
+            ("buffered", "off"),
+            ("streaming", str(args.threshold)),
+        ):
+            ok, elapsed, baseline, peak = run(
+                engine, threshold, backend.address, args, body
+            )
+            print(
+                "{:<9} {:<10} {:>4} {:>8.2f} {:>12} {:>12} {:>12}".format(
+                    engine, mode, ok, elapsed, baseline, peak, peak - baseline
+                )
+            )
+    backend.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+# Accept rate of https2mllp under a mix of stalled and fast TLS clients.
+# Stalled clients open a TCP connection and never send a ClientHello; fast
+# clients each do a handshake and a POST per connection. "legacy" is the
+# listening socket wrapped with the handshake in accept(), as before.
+#
+#   python -m benchmarks.tls_accept [--stalled 0,5] [--fast 8] [--seconds 5]
+import argparse
+import os
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from .mllp_engines import free_port, wait_listening
+from .standins import MllpBackend
+
+SERVER = """
+import functools, http.server, sys
+import mllp_http_https.https2mllp as m
+mode, port, mllp_port, certfile, keyfile, ciphers = sys.argv[1:]
+options = m.HttpsServerOptions(
+    timeout=30, content_type="application/hl7-v2", certfile=certfile,
+    keyfile=keyfile, keep_alive=None, username=None, password=None,
+    mllp_parser=True, engine="asyncio" if mode == "asyncio" else "threaded",
+    ciphers=ciphers or None, handshake_timeout=1,
+)
+mllp_address = ("127.0.0.1", int(mllp_port))
+mllp_options = m.MllpClientOptions(keep_alive=-1, max_messages=-1, timeout=30)
+if mode == "legacy":
+    handler = functools.partial(
+        m.HttpsHandler, content_type=options.content_type, keep_alive=None,
+        timeout=30, mllp_client=m.MllpClient(mllp_address, mllp_options),
+        authentication=None, mllp_response=options.mllp_response,
+    )
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", int(port)), handler)
+    server.socket = m.server_ssl_context(options).wrap_socket(server.socket, server_side=True)
+    server.serve_forever()
+else:
+    m.serve(("127.0.0.1", int(port)), options, mllp_address, mllp_options)
+"""
+
+MESSAGE = b"MSH|^~\\&|BENCH\r"
+REQUEST = (
+    b"POST / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n"
+    b"Content-Length: %d\r\n\r\n" % len(MESSAGE) + MESSAGE
+)
+
+
+def self_signed(directory):
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-keyout",
+            keyfile,
+            "-out",
+            certfile,
+            "-days",
+            "1",
+            "-subj",
+            "/CN=localhost",
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return certfile, keyfile
+
+
+def stalled_client(address, stop):
+    # Holds a connection without a ClientHello, reconnecting when dropped
+    while not stop.is_set():
+        try:
+            with socket.create_connection(address, timeout=0.5) as s:
+                while not stop.is_set():
+                    try:
+                        if not s.recv(1):
+                            break
+                    except socket.timeout:
+                        pass
+        except OSError:
+            time.sleep(0.05)
+
+
+def fast_client(address, context, resume, stop, handshakes, failures):
+    session = None
+    while not stop.is_set():
+        try:
+            with socket.create_connection(address, timeout=2) as raw:
+                start = time.perf_counter()
+                with context.wrap_socket(
+                    raw, server_hostname="localhost", session=session
+                ) as s:
+                    handshakes.append((time.perf_counter() - start, s.session_reused))
+                    s.sendall(REQUEST)
+                    while s.recv(64 * 1024):
+                        pass
+                    if resume:
+                        session = s.session
+        except OSError:
+            failures.append(1)
+
+
+def run(mode, stalled, fast, seconds, resume, ciphers, mllp_port, certfile, keyfile):
+    port = free_port()
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            SERVER,
+            mode,
+            str(port),
+            str(mllp_port),
+            certfile,
+            keyfile,
+            ciphers,
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    stop = threading.Event()
+    handshakes, failures = [], []
+    context = ssl.create_default_context(cafile=certfile)
+    address = ("127.0.0.1", port)
+    try:
+        wait_listening(port)
+        threads = [
+            threading.Thread(target=stalled_client, args=(address, stop))
+            for _ in range(stalled)
+        ]
+        threads += [
+            threading.Thread(
+                target=fast_client,
+                args=(address, context, resume, stop, handshakes, failures),
+            )
+            for _ in range(fast)
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        process.terminate()
+        process.wait()
+    latencies = sorted(latency for latency, _ in handshakes)
+    p50 = latencies[len(latencies) // 2] if latencies else float("nan")
+    reused = sum(1 for _, session_reused in handshakes if session_reused)
+    return len(handshakes) / seconds, p50, reused, len(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser("tls_accept")
+    parser.add_argument("--stalled", default="0,5")
+    parser.add_argument("--fast", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--modes", default="legacy,threaded,asyncio")
+    parser.add_argument("--ciphers", default="", help="e.g. modern")
+    args = parser.parse_args()
+
+    backend = MllpBackend()
+    _, mllp_port = backend.start()
+
+    print(
+        "{:<9} {:>7} {:>7} {:>10} {:>13} {:>7} {:>7}".format(
+            "mode", "stalled", "resume", "accepts/s", "handshake ms", "reused", "failed"
+        )
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        certfile, keyfile = self_signed(directory)
+        for mode in args.modes.split(","):
+            for stalled in (int(s) for s in args.stalled.split(",")):
+                for resume in (False, True):
+                    rate, p50, reused, failed = run(
+                        mode,
+                        stalled,
+                        args.fast,
+                        args.seconds,
+                        resume,
+                        args.ciphers,
+                        mllp_port,
+                        certfile,
+                        keyfile,
+                    )
+                    print(
+                        "{:<9} {:>7} {:>7} {:>10.0f} {:>13.2f} {:>7} {:>7}".format(
+                            mode,
+                            stalled,
+                            "yes" if resume else "no",
+                            rate,
+                            p50 * 1000,
+                            reused,
+                            failed,
+                        )
+                    )
+    backend.stop()
+
+
+if __name__ == "__main__":
+    main()
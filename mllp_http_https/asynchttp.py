@@ -0,0 +1,411 @@
+### Minimal non-blocking HTTP/1.1 client and server for the asyncio engine
+import asyncio
+import email.utils
+import http
+import http.server
+import logging
+import os
+import ssl
+import time
+
+from .compression import decode_parts_async, read_parts_async
+
+logger = logging.getLogger(__name__)
+
+
+class HttpStatusError(Exception):
+    def __init__(self, response):
+        super().__init__("{} {}".format(response.status, response.reason))
+        self.response = response
+
+
+class HttpResponse:
+    def __init__(self, status, reason, headers, content):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    def __repr__(self):
+        return "<Response [{}]>".format(self.status)
+
+    def raise_for_status(self):
+        if 400 <= self.status:
+            raise HttpStatusError(self)
+
+
+class StaleConnection(Exception):
+    # A pooled connection closed by the server before the response
+    pass
+
+
+def ssl_context(verify):
+    # SSL context equivalent to the verify argument of requests:
+    # True, False, or a path to a CA bundle file or directory
+    if verify is False:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    elif verify is True:
+        context = ssl.create_default_context()
+    elif os.path.isdir(verify):
+        context = ssl.create_default_context(capath=verify)
+    else:
+        context = ssl.create_default_context(cafile=verify)
+    return context
+
+
+class AsyncHttpClient:
+    # HTTP/1.1 client with a pool of keep-alive connections to a single
+    # origin, shared by every MLLP connection of the asyncio engine
+
+    def __init__(self, url, timeout=None, verify=True, pool_size=16, max_idle=None):
+        self.url = url
+        self.timeout = timeout
+        self.host = url.hostname
+        self.tls = url.scheme == "https"
+        self.port = url.port or (443 if self.tls else 80)
+        self.ssl_context = ssl_context(verify) if self.tls else None
+        self.target = url.path or "/"
+        if url.query:
+            self.target += "?" + url.query
+        self.host_header = url.netloc.rpartition("@")[2]
+        self.pool_size = pool_size
+        self.max_idle = max_idle
+        self.connections = []  # (reader, writer, last used)
+
+    async def post(self, data, headers):
+        request = self._request(data, headers)
+        if self.timeout:
+            return await asyncio.wait_for(self._send(request), self.timeout)
+        return await self._send(request)
+
+    async def close(self):
+        connections, self.connections = self.connections, []
+        for reader, writer, last_used in connections:
+            writer.close()
+
+    def _request(self, data, headers):
+        lines = [
+            "POST {} HTTP/1.1".format(self.target),
+            "Host: {}".format(self.host_header),
+            "Content-Length: {}".format(len(data)),
+        ]
+        lines.extend("{}: {}".format(name, value) for name, value in headers.items())
+        head = "\r\n".join(lines).encode("latin-1") + b"\r\n\r\n"
+        return head, data
+
+    async def _send(self, request):
+        while self.connections:
+            # A pooled connection may have been closed by the server while
+            # idle: the request is then sent on another one, but only if the
+            # connection failed before any byte of the response arrived (a
+            # POST is not idempotent)
+            reader, writer, last_used = self.connections.pop()
+            if reader.at_eof() or (
+                self.max_idle is not None
+                and self.max_idle < time.monotonic() - last_used
+            ):
+                writer.close()
+                continue
+            try:
+                return await self._exchange((reader, writer), request, reused=True)
+            except StaleConnection as e:
+                logger.debug("Discarding stale HTTP connection: %s", e.__cause__)
+        connection = await asyncio.open_connection(
+            self.host,
+            self.port,
+            ssl=self.ssl_context,
+            server_hostname=self.host if self.tls else None,
+        )
+        return await self._exchange(connection, request)
+
+    async def _exchange(self, connection, request, reused=False):
+        # Raises StaleConnection if reused and the connection failed before
+        # any byte of the response arrived
+        reader, writer = connection
+        try:
+            head, data = request
+            try:
+                writer.write(head)
+                writer.write(data)
+                await writer.drain()
+                status_line = await reader.readuntil(b"\r\n")
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                if reused and not getattr(e, "partial", b""):
+                    raise StaleConnection() from e
+                raise
+            response, keep_alive = await self._read_response(reader, status_line)
+        except BaseException:
+            writer.close()
+            raise
+        if keep_alive and len(self.connections) < self.pool_size:
+            self.connections.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+        return response
+
+    async def _read_response(self, reader, status_line):
+        version, status, reason = (
+            status_line.decode("latin-1").rstrip("\r\n").split(" ", 2) + [""]
+        )[:3]
+        headers = {}
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        status = int(status)
+        keep_alive = version == "HTTP/1.1"
+        connection = headers.get("connection", "").lower()
+        if connection == "close":
+            keep_alive = False
+        elif connection == "keep-alive":
+            keep_alive = True
+
+        if status in (204, 304) or 100 <= status < 200:
+            content = b""
+        elif "chunked" in headers.get("transfer-encoding", "").lower():
+            content = await read_chunked(reader)
+        elif "content-length" in headers:
+            content = await reader.readexactly(int(headers["content-length"]))
+        else:
+            content = await reader.read()
+            keep_alive = False
+        return HttpResponse(status, reason, headers, content), keep_alive
+
+
+async def read_chunked(reader):
+    # Reads a body with Transfer-Encoding: chunked
+    content = bytearray()
+    while True:
+        size_line = await reader.readuntil(b"\r\n")
+        size = int(size_line.split(b";", 1)[0], 16)
+        if not size:
+            break
+        content += await reader.readexactly(size + 2)
+        del content[-2:]
+    # Trailer section
+    while await reader.readuntil(b"\r\n") != b"\r\n":
+        pass
+    return bytes(content)
+
+
+class HttpRequestError(Exception):
+    pass
+
+
+class UnsupportedTransferEncoding(HttpRequestError):
+    pass
+
+
+class HeadersTooLarge(HttpRequestError):
+    pass
+
+
+# Longest chunk size or trailer line of a chunked request body
+MAX_LINE = 8 * 1024
+
+# Header fields, and bytes of the request line and header fields, of a
+# request at most (http.server also takes 100 header fields at most)
+MAX_HEADERS = 100
+MAX_HEADER_SIZE = 64 * 1024
+
+
+def is_chunked(transfer_encoding):
+    # Whether a request body with this Transfer-Encoding header (None if it
+    # has none) is chunked. Raises UnsupportedTransferEncoding for any other
+    # transfer coding.
+    if transfer_encoding is None:
+        return False
+    if [c.strip().lower() for c in transfer_encoding.split(",")] == ["chunked"]:
+        return True
+    raise UnsupportedTransferEncoding(transfer_encoding)
+
+
+def parse_content_length(value):
+    # Body size of a Content-Length header (0 if None). Raises
+    # HttpRequestError unless it is a non-negative integer.
+    if value is None:
+        return 0
+    value = value.strip()
+    if not (value.isascii() and value.isdigit()):
+        raise HttpRequestError("Bad Content-Length: %r" % value[:80])
+    return int(value)
+
+
+def chunk_size(line):
+    # Size in a chunk size line (chunk extensions are ignored)
+    size = line.split(b";", 1)[0].strip()
+    if MAX_LINE < len(line) or not line.endswith(b"\n") or not size.isalnum():
+        raise HttpRequestError("Bad chunk size line: %r" % line[:80])
+    try:
+        return int(size, 16)
+    except ValueError:
+        raise HttpRequestError("Bad chunk size line: %r" % line[:80])
+
+
+def chunked_parts(rfile, size=64 * 1024):
+    # Data of a chunked request body, read from a file (the rfile of
+    # http.server) in parts of at most size bytes, as they arrive. Trailer
+    # fields are ignored.
+    while True:
+        remaining = chunk_size(rfile.readline(MAX_LINE + 1))
+        if not remaining:
+            break
+        while remaining:
+            data = rfile.read(min(size, remaining))
+            if not data:
+                raise HttpRequestError("Chunked body ended within a chunk")
+            remaining -= len(data)
+            yield data
+        if rfile.readline(3) not in (b"\r\n", b"\n"):
+            raise HttpRequestError("Chunk not followed by CRLF")
+    while True:
+        line = rfile.readline(MAX_LINE + 1)
+        if not line.endswith(b"\n"):
+            raise HttpRequestError("Bad trailer section")
+        if line in (b"\r\n", b"\n"):
+            return
+
+
+async def chunked_parts_async(reader, size=64 * 1024, timeout=None):
+    # Same as chunked_parts, from an asyncio stream, with timeout seconds
+    # for each read
+    async def readline():
+        try:
+            return await asyncio.wait_for(reader.readuntil(b"\n"), timeout)
+        except asyncio.LimitOverrunError:
+            raise HttpRequestError("Chunked body line too long")
+
+    while True:
+        remaining = chunk_size(await readline())
+        if not remaining:
+            break
+        while remaining:
+            data = await asyncio.wait_for(
+                reader.readexactly(min(size, remaining)), timeout
+            )
+            remaining -= len(data)
+            yield data
+        if await readline() not in (b"\r\n", b"\n"):
+            raise HttpRequestError("Chunk not followed by CRLF")
+    while await readline() not in (b"\r\n", b"\n"):
+        pass
+
+
+class HttpRequest:
+    def __init__(self, method, target, version, headers):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers  # header names in lower case
+        self.chunked = is_chunked(headers.get("transfer-encoding"))
+
+    @property
+    def length(self):
+        # Content-Length, or None if the body is chunked
+        if self.chunked:
+            return None
+        return parse_content_length(self.headers.get("content-length"))
+
+    @property
+    def keep_alive(self):
+        if self.chunked and "content-length" in self.headers:
+            # Ambiguous length (a way to smuggle requests to proxies in
+            # front of the bridge): the connection is not reused
+            return False
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.1":
+            return connection != "close"
+        return connection == "keep-alive"
+
+
+async def read_request(reader):
+    # Reads the request line and headers of the next request on a keep-alive
+    # connection. Returns None if the client closed the connection. Raises
+    # HeadersTooLarge past MAX_HEADERS or MAX_HEADER_SIZE.
+    try:
+        request_line = await reader.readuntil(b"\r\n")
+    except asyncio.IncompleteReadError:
+        return None
+    except asyncio.LimitOverrunError:
+        raise HeadersTooLarge("Request line too long")
+    words = request_line.decode("latin-1").split()
+    if len(words) != 3 or not words[2].startswith("HTTP/"):
+        raise HttpRequestError("Bad request line: %r" % request_line[:80])
+    headers = {}
+    size = len(request_line)
+    while True:
+        try:
+            line = await reader.readuntil(b"\r\n")
+        except asyncio.LimitOverrunError:
+            raise HeadersTooLarge("Header line too long")
+        if line == b"\r\n":
+            break
+        size += len(line)
+        if MAX_HEADERS <= len(headers) or MAX_HEADER_SIZE < size:
+            raise HeadersTooLarge(
+                "More than {} header fields or {} bytes".format(
+                    MAX_HEADERS, MAX_HEADER_SIZE
+                )
+            )
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return HttpRequest(words[0], words[1], words[2], headers)
+
+
+async def read_body(reader, writer, request, compression=None, take=None):
+    # The request body, decompressed (compressed bodies are refused unless
+    # compression, the CompressionOptions of the server, is set). take(size),
+    # if given, is called with the size of each part, as decompressed,
+    # before it is kept.
+    if request.headers.get("expect", "").lower() == "100-continue":
+        writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+    if request.chunked:
+        parts = chunked_parts_async(reader)
+    else:
+        parts = read_parts_async(reader, request.length)
+    body = []
+    async for part in decode_parts_async(
+        parts, request.headers.get("content-encoding"), compression
+    ):
+        if take is not None:
+            take(len(part))
+        body.append(part)
+    return b"".join(body)
+
+
+def chunk(data):
+    # One chunk of a body with Transfer-Encoding: chunked (LAST_CHUNK ends it)
+    return b"%x\r\n%s\r\n" % (len(data), data)
+
+
+LAST_CHUNK = b"0\r\n\r\n"
+
+
+async def write_part(writer, data, chunked=True):
+    # Writes a part of a body (a chunk, if chunked) and waits for it to be
+    # sent, so that at most one part is buffered. Returns its size.
+    if data:
+        writer.write(chunk(data) if chunked else data)
+        await writer.drain()
+    return len(data)
+
+
+def response_head(status, headers, date=True):
+    # Status line and headers, with the Server and Date headers that
+    # BaseHTTPRequestHandler.send_response adds
+    lines = [
+        "HTTP/1.1 {} {}".format(status, http.HTTPStatus(status).phrase),
+        "Server: {} {}".format(
+            http.server.BaseHTTPRequestHandler.server_version,
+            http.server.BaseHTTPRequestHandler.sys_version,
+        ),
+    ]
+    if date:
+        lines.append("Date: {}".format(email.utils.formatdate(usegmt=True)))
+    lines.extend("{}: {}".format(name, value) for name, value in headers)
+    return "\r\n".join(lines).encode("latin-1") + b"\r\n\r\n"
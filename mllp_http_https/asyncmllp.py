@@ -0,0 +1,301 @@
+### Non-blocking MLLP client for the asyncio engine
+import asyncio
+import collections
+import logging
+import socket
+import time
+
+from .mllp import END_BLOCK, START_BLOCK, MllpDecoder, MllpError, frame_mllp
+from .net import set_no_delay
+from .pool import FILL_RETRY, PoolStats, PoolTimeout
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncMllpClient:
+    # Same as MllpClient, on asyncio streams: idle connections are reused
+    # most recently used first, and a reaper task closes the ones idle for
+    # options.keep_alive seconds (never, if negative; not reused at all, if
+    # 0 without pool_min) and keeps pool_min open. At most options.pool_max
+    # messages are in flight, each on its own connection.
+
+    def __init__(self, address, options):
+        self.address = address
+        self.options = options
+        self.connections = collections.deque()  # idle, most recently used last
+        self.in_use = 0
+        self.waiting = 0
+        self.stats = PoolStats()
+        self.slots = None
+        if 0 < options.pool_max:
+            self.slots = asyncio.Semaphore(options.pool_max)
+        self._reaper_wakeup = asyncio.Event()
+        self._reaper = asyncio.ensure_future(self._reap())
+
+    @property
+    def size(self):
+        return self.in_use + len(self.connections)
+
+    async def _connect(self):
+        reader, writer = await asyncio.open_connection(*self.address)
+        s = writer.get_extra_info("socket")
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 10)
+        if self.options.no_delay:
+            set_no_delay(s)
+        self.stats.created += 1
+        return AsyncMllpConnection(reader, writer, self.options.recv_size)
+
+    def _idle_connection(self):
+        while self.connections:
+            connection = self.connections.pop()
+            if connection.reader.at_eof():
+                self._close(connection)
+            else:
+                return connection
+        return None
+
+    async def send(self, data):
+        await self._acquire()
+        try:
+            return await self._send(data)
+        finally:
+            if self.slots is not None:
+                self.slots.release()
+
+    async def _acquire(self):
+        # Waits for one of the pool_max slots, if limited
+        if self.slots is not None and self.slots.locked():
+            self.waiting += 1
+            start = time.monotonic()
+            try:
+                await asyncio.wait_for(self.slots.acquire(), self.options.pool_timeout)
+            except asyncio.TimeoutError:
+                self.stats.timeouts += 1
+                raise PoolTimeout(
+                    "No MLLP connection available after {}s".format(
+                        self.options.pool_timeout
+                    )
+                )
+            finally:
+                self.waiting -= 1
+                self.stats.waited(time.monotonic() - start)
+        elif self.slots is not None:
+            await self.slots.acquire()
+        self.stats.acquired += 1
+
+    async def _send(self, data):
+        self.in_use += 1
+        try:
+            return await self._exchange(data)
+        finally:
+            self.in_use -= 1
+
+    async def _exchange(self, data):
+        connection = await self._open()
+        try:
+            if self.options.timeout:
+                response = await asyncio.wait_for(
+                    connection.send(data), self.options.timeout
+                )
+            else:
+                response = await connection.send(data)
+        except BaseException:
+            self._close(connection)
+            raise
+        self._release(connection)
+        return response
+
+    async def stream(self, parts):
+        # Same as send, for a message given in parts (an asynchronous
+        # iterable of bytes, sent as they come): yields the parts of the
+        # response as they are received. options.timeout applies to each
+        # read and write rather than to the whole exchange.
+        await self._acquire()
+        self.in_use += 1
+        try:
+            connection = await self._open()
+            try:
+                async for part in connection.stream(
+                    parts, self.options.timeout or None
+                ):
+                    yield part
+            except BaseException:
+                self._close(connection)
+                raise
+            self._release(connection)
+        finally:
+            self.in_use -= 1
+            if self.slots is not None:
+                self.slots.release()
+
+    async def _open(self):
+        # An idle connection, or a new one
+        connection = self._idle_connection()
+        if connection is None:
+            if self.options.timeout:
+                connection = await asyncio.wait_for(
+                    self._connect(), self.options.timeout
+                )
+            else:
+                connection = await self._connect()
+        return connection
+
+    def _release(self, connection):
+        if connection.message_count >= self.options.max_messages >= 0 or (
+            self.options.keep_alive == 0 and self.options.pool_min <= 0
+        ):
+            self._close(connection)
+        else:
+            connection.last_update = time.monotonic()
+            self.connections.append(connection)
+            if len(self.connections) == 1:
+                # The oldest idle connection, that the reaper waits for
+                self._reaper_wakeup.set()
+
+    def _close(self, connection):
+        connection.close()
+        self.stats.closed += 1
+        # Reopened by the reaper if below pool_min
+        self._reaper_wakeup.set()
+
+    def _deadline(self):
+        # As MllpClient._deadline
+        keep_alive = self.options.keep_alive
+        if (
+            not self.connections
+            or self.size <= self.options.pool_min
+            or keep_alive is None
+            or keep_alive < 0
+        ):
+            return None
+        return self.connections[0].last_update + keep_alive
+
+    async def _reap(self):
+        # As MllpClient._reap
+        stats_interval = self.options.stats_interval
+        next_stats = time.monotonic() + stats_interval if stats_interval else None
+        next_fill = time.monotonic()
+        while True:
+            if next_fill is not None and next_fill <= time.monotonic():
+                filled = await self._fill()
+                next_fill = None if filled else time.monotonic() + FILL_RETRY
+            self._reaper_wakeup.clear()
+            now = time.monotonic()
+            deadline = self._deadline()
+            while deadline is not None and deadline <= now:
+                self.connections.popleft().close()
+                self.stats.closed += 1
+                deadline = self._deadline()
+            if next_fill is None and self.size < self.options.pool_min:
+                next_fill = now
+            if next_stats is not None and next_stats <= now:
+                logger.info("MLLP pool: %s", self.snapshot())
+                next_stats = now + stats_interval
+            timeouts = [
+                t - now for t in (deadline, next_fill, next_stats) if t is not None
+            ]
+            try:
+                await asyncio.wait_for(
+                    self._reaper_wakeup.wait(), min(timeouts) if timeouts else None
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fill(self):
+        # As MllpClient._fill
+        while self.size < self.options.pool_min:
+            try:
+                if self.options.timeout:
+                    connection = await asyncio.wait_for(
+                        self._connect(), self.options.timeout
+                    )
+                else:
+                    connection = await self._connect()
+            except (OSError, asyncio.TimeoutError) as e:
+                logger.warning("Could not open MLLP connection: %s", e)
+                return False
+            connection.last_update = time.monotonic()
+            self.connections.append(connection)
+        return True
+
+    def snapshot(self):
+        # Pool occupancy and wait statistics, as MllpClient.snapshot()
+        stats = self.stats
+        return {
+            "size": self.size,
+            "idle": len(self.connections),
+            "in_use": self.in_use,
+            "waiting": self.waiting,
+            "max": self.options.pool_max,
+            "created": stats.created,
+            "closed": stats.closed,
+            "acquired": stats.acquired,
+            "waits": stats.waits,
+            "timeouts": stats.timeouts,
+            "wait_time": stats.wait_time,
+            "max_wait_time": stats.max_wait_time,
+        }
+
+    async def close(self):
+        self._reaper.cancel()
+        connections, self.connections = self.connections, collections.deque()
+        for connection in connections:
+            connection.close()
+
+
+class AsyncMllpConnection:
+    def __init__(self, reader, writer, recv_size):
+        self.last_update = None
+        self.message_count = 0
+        self.reader = reader
+        self.writer = writer
+        self.recv_size = recv_size
+        self.decoder = MllpDecoder()
+
+    def close(self):
+        self.writer.close()
+        logger.info("Disconnected from MLLP Server")
+
+    async def send(self, data):
+        self.message_count += 1
+        self.writer.write(frame_mllp(data))
+        await self.writer.drain()
+
+        # Wait for the ACK/NACK, keeping any bytes after it for the next one
+        frame = self.decoder.next_frame()
+        while frame is None:
+            chunk = await self.reader.read(self.recv_size)
+            if not chunk:
+                self.decoder.close()
+                raise MllpError("Connection closed by MLLP peer")
+            self.decoder.feed(chunk)
+            frame = self.decoder.next_frame()
+        return frame
+
+    async def stream(self, parts, timeout=None):
+        # Same as send, for a message given in parts: yields the parts of
+        # the response as they are received
+        self.message_count += 1
+        self.writer.write(START_BLOCK)
+        async for part in parts:
+            self.writer.write(part)
+            await asyncio.wait_for(self.writer.drain(), timeout)
+        self.writer.write(END_BLOCK)
+        await asyncio.wait_for(self.writer.drain(), timeout)
+
+        while True:
+            part = self.decoder.next_part()
+            if part is None:
+                chunk = await asyncio.wait_for(
+                    self.reader.read(self.recv_size), timeout
+                )
+                if not chunk:
+                    self.decoder.close()
+                    raise MllpError("Connection closed by MLLP peer")
+                self.decoder.feed(chunk)
+                continue
+            data, end = part
+            if data:
+                yield data
+            if end:
+                return
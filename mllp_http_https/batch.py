@@ -0,0 +1,297 @@
+### Micro-batching of mllp2http and mllp2https: messages received on all
+### MLLP connections within a short time are sent to the HTTP(S) server in
+### one request (HL7 batch or multipart), whose response is split back into
+### the ACK of each message
+import asyncio
+import logging
+import re
+import threading
+import time
+import uuid
+
+from . import hl7
+
+logger = logging.getLogger(__name__)
+
+
+class BatchFormat:
+    # FHS, BHS, the messages, BTS and FTS; the response is an HL7 batch of
+    # ACKs, matched to the messages by MSA-2 (or in order)
+    HL7 = "hl7"
+    # multipart/mixed, one part per message; the response has one part per
+    # ACK, in order
+    MULTIPART = "multipart"
+
+
+# Headers of each part of a multipart request
+PART_HEADERS = ("Content-Type", "Forwarded", "X-Forwarded-For")
+
+BATCH_SEGMENTS = (b"FHS", b"BHS", b"BTS", b"FTS")
+
+
+class BatchError(Exception):
+    pass
+
+
+def hl7_batch(messages):
+    # HL7 batch file of messages, with the separators of the first one
+    fields = hl7.header(messages[0])
+    separator = messages[0][3:4] if fields else b"|"
+    encoding = fields[1] if fields and 1 < len(fields) else b"^~\\&"
+    timestamp = time.strftime("%Y%m%d%H%M%S").encode("ascii")
+    parts = [
+        separator.join([b"FHS", encoding, b"", b"", b"", b"", timestamp]) + b"\r",
+        separator.join([b"BHS", encoding, b"", b"", b"", b"", timestamp]) + b"\r",
+    ]
+    for message in messages:
+        parts.append(message)
+        if not message.endswith(hl7.SEGMENT_TERMINATORS):
+            parts.append(b"\r")
+    parts.append(separator.join([b"BTS", str(len(messages)).encode("ascii")]) + b"\r")
+    parts.append(separator.join([b"FTS", b"1"]) + b"\r")
+    return b"".join(parts)
+
+
+def split_hl7_batch(content):
+    # Messages of an HL7 batch (or of a single message)
+    messages = []
+    current = None
+    for segment in re.split(rb"\r\n|\r|\n", content):
+        name = segment[:3]
+        if name == b"MSH":
+            current = [segment]
+            messages.append(current)
+        elif name in BATCH_SEGMENTS:
+            current = None
+        elif segment and current is not None:
+            current.append(segment)
+    return [b"\r".join(segments) + b"\r" for segments in messages]
+
+
+def match_acks(messages, acks):
+    # ACK of each message by MSA-2, else by position if there is one ACK per
+    # message, else None
+    by_id = {}
+    for ack in acks:
+        control_id = hl7.ack_control_id(ack)
+        if control_id is not None:
+            by_id.setdefault(control_id, ack)
+    matched = []
+    for i, message in enumerate(messages):
+        control_id = hl7.message_control_id(message)
+        ack = by_id.get(control_id) if control_id is not None else None
+        if ack is None and len(acks) == len(messages):
+            ack = acks[i]
+        matched.append(ack)
+    return matched
+
+
+def multipart(items):
+    # multipart/mixed body of (message, headers) items, and its Content-Type
+    boundary = uuid.uuid4().hex
+    parts = []
+    for message, headers in items:
+        head = "".join(
+            "{}: {}\r\n".format(name, headers[name])
+            for name in PART_HEADERS
+            if name in headers
+        )
+        parts.append("--{}\r\n{}\r\n".format(boundary, head).encode("latin-1"))
+        parts.append(message)
+        parts.append(b"\r\n")
+    parts.append("--{}--\r\n".format(boundary).encode("latin-1"))
+    return b"".join(parts), "multipart/mixed; boundary=" + boundary
+
+
+def split_multipart(content, content_type):
+    # Bodies of the parts of a multipart response
+    match = re.search(r'boundary="?([^";]+)"?', content_type or "")
+    if match is None:
+        raise BatchError("Batch response is not multipart: {}".format(content_type))
+    delimiter = b"--" + match.group(1).encode("latin-1")
+    parts = []
+    for part in content.split(delimiter)[1:]:
+        if part.startswith(b"--"):
+            break
+        head, separator, body = part.partition(b"\r\n\r\n")
+        if not separator:
+            raise BatchError("Malformed part in the batch response")
+        parts.append(body[:-2] if body.endswith(b"\r\n") else body)
+    return parts
+
+
+def encode(items, batch_format):
+    # Body and headers of the request for (message, headers) items; the
+    # request headers are those of the first message
+    headers = dict(items[0][1])
+    if batch_format == BatchFormat.MULTIPART:
+        body, headers["Content-Type"] = multipart(items)
+    else:
+        body = hl7_batch([message for message, _ in items])
+    return body, headers
+
+
+def decode(messages, response, batch_format):
+    # ACK (or None) of each message, from the response to their batch
+    if batch_format == BatchFormat.MULTIPART:
+        acks = split_multipart(response.content, response.headers.get("content-type"))
+        if len(acks) != len(messages):
+            raise BatchError(
+                "{} parts in the response to a batch of {}".format(
+                    len(acks), len(messages)
+                )
+            )
+        return acks
+    return match_acks(messages, split_hl7_batch(response.content))
+
+
+class BatchResponse:
+    # ACK of one message, with the HTTP response to its batch
+    def __init__(self, content, response, count):
+        self.content = content
+        self.response = response
+        self.count = count
+
+    def __repr__(self):
+        return "{!r} (batch of {})".format(self.response, self.count)
+
+
+class BatchOptions:
+    def __init__(
+        self, max_count, max_bytes=1024 * 1024, linger=0.005, format=BatchFormat.HL7
+    ):
+        # A batch is sent when it has max_count messages or max_bytes bytes,
+        # or linger seconds after its first message
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.linger = linger
+        self.format = format
+
+
+class Batch:
+    def __init__(self):
+        self.items = []  # (message, headers)
+        self.size = 0
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.responses = None
+        self.error = None
+
+    def add(self, message, headers, options):
+        # Index of the message; sets full once the batch reaches a limit
+        self.items.append((message, headers))
+        self.size += len(message)
+        if options.max_count <= len(self.items) or options.max_bytes <= self.size:
+            self.full.set()
+        return len(self.items) - 1
+
+
+def responses(batch, response, batch_format):
+    # BatchResponse of each message of batch
+    if len(batch.items) == 1:
+        # Sent alone, as without batching
+        return [response]
+    messages = [message for message, _ in batch.items]
+    return [
+        None if ack is None else BatchResponse(ack, response, len(messages))
+        for ack in decode(messages, response, batch_format)
+    ]
+
+
+def result(batch, index):
+    if batch.error is not None:
+        raise batch.error
+    response = batch.responses[index]
+    if response is None:
+        raise BatchError(
+            "No ACK in the batch response for message {}".format(index + 1)
+        )
+    return response
+
+
+class Batcher:
+    # Batches the messages of the MLLP connection threads. The first message
+    # of a batch waits for others, then its thread sends the batch with
+    # post(body, headers), which returns the HTTP response or raises, and
+    # wakes up the threads of the other messages.
+
+    def __init__(self, post, options):
+        self.post = post
+        self.options = options
+        self.batch = None  # batch being filled
+        self.lock = threading.Lock()
+
+    def send(self, message, headers):
+        # Response to message (the HTTP response if it was sent alone, a
+        # BatchResponse otherwise)
+        with self.lock:
+            batch = self.batch
+            leader = batch is None
+            if leader:
+                batch = self.batch = Batch()
+            index = batch.add(message, headers, self.options)
+            if batch.full.is_set():
+                self.batch = None
+        if not leader:
+            batch.done.wait()
+            return result(batch, index)
+
+        batch.full.wait(self.options.linger)
+        with self.lock:
+            if self.batch is batch:
+                self.batch = None
+        try:
+            if len(batch.items) == 1:
+                response = self.post(message, headers)
+            else:
+                response = self.post(*encode(batch.items, self.options.format))
+            batch.responses = responses(batch, response, self.options.format)
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+        return result(batch, index)
+
+
+class AsyncBatch(Batch):
+    def __init__(self):
+        super().__init__()
+        self.full = asyncio.Event()
+
+
+class AsyncBatcher:
+    # Same as Batcher, for the asyncio engine: each batch is sent by a task
+    # of its own, so that it is not cancelled with the connection of its
+    # first message
+
+    def __init__(self, post, options):
+        self.post = post
+        self.options = options
+        self.batch = None
+
+    async def send(self, message, headers):
+        batch = self.batch
+        if batch is None:
+            batch = self.batch = AsyncBatch()
+            batch.task = asyncio.ensure_future(self._send(batch))
+        index = batch.add(message, headers, self.options)
+        if batch.full.is_set():
+            self.batch = None
+        await asyncio.shield(batch.task)
+        return result(batch, index)
+
+    async def _send(self, batch):
+        try:
+            await asyncio.wait_for(batch.full.wait(), self.options.linger)
+        except asyncio.TimeoutError:
+            pass
+        if self.batch is batch:
+            self.batch = None
+        try:
+            if len(batch.items) == 1:
+                response = await self.post(*batch.items[0])
+            else:
+                response = await self.post(*encode(batch.items, self.options.format))
+            batch.responses = responses(batch, response, self.options.format)
+        except Exception as e:
+            batch.error = e
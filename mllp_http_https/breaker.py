@@ -0,0 +1,278 @@
+### Circuit breaker of the upstream of a bridge: the MLLP server of
+### http2mllp and https2mllp, the HTTP(S) server of mllp2http and
+### mllp2https. Once the upstream is failing, messages fail at once
+### (CircuitOpen) instead of each waiting for a connect or read timeout,
+### until a probe message gets through after open_interval seconds.
+import asyncio
+import collections
+import contextlib
+import logging
+import threading
+import time
+
+import requests
+
+from . import metrics
+from .mllp import MllpError
+
+logger = logging.getLogger(__name__)
+
+
+class BreakerOptions:
+    def __init__(
+        self,
+        failures=5,
+        error_rate=None,
+        window=20,
+        open_interval=30,
+        probes=1,
+        nack=None,
+    ):
+        # The circuit opens after this many failures in a row (never if
+        # None), or when the ratio of failures among the last window
+        # messages reaches error_rate (never if None)
+        self.failures = failures
+        self.error_rate = error_rate
+        self.window = window
+        # Seconds the circuit stays open, before probes are let through
+        self.open_interval = open_interval
+        # Messages let through at the same time while half-open: the circuit
+        # closes when one succeeds, and opens again when one fails
+        self.probes = probes
+        # mllp2http and mllp2https: MSA-1 code (AE or AR) of the NACK sent
+        # back while the circuit is open, or None to close the MLLP
+        # connection
+        self.nack = nack
+
+
+class CircuitOpen(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        # Seconds until probes are let through
+        self.retry_after = retry_after
+
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+
+# Value of the state gauge
+STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    def __init__(self, name, options):
+        self.name = name  # of the upstream, for the logs
+        self.options = options
+        self.state = CLOSED
+        self.lock = threading.Lock()
+        self.consecutive = 0  # failures in a row
+        self.results = collections.deque(maxlen=options.window)  # True for failures
+        self.opened_at = None
+        self.probes = 0  # in flight, while half-open
+        self.transitions = {OPEN: 0, HALF_OPEN: 0, CLOSED: 0}
+        self.rejected = 0
+        self.failures = 0
+
+    def allow(self):
+        # Raises CircuitOpen if a message is not to be sent
+        with self.lock:
+            if self.state == OPEN:
+                remaining = (
+                    self.opened_at + self.options.open_interval - time.monotonic()
+                )
+                if 0 < remaining:
+                    self.rejected += 1
+                    raise CircuitOpen(
+                        "Circuit open: {} is failing".format(self.name), remaining
+                    )
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self.options.probes <= self.probes:
+                    self.rejected += 1
+                    raise CircuitOpen(
+                        "Circuit half-open: {} is being probed".format(self.name),
+                        self.options.open_interval,
+                    )
+                self.probes += 1
+
+    def record(self, failed):
+        # Result of a message let through by allow(): failed is None if it
+        # tells nothing about the upstream
+        with self.lock:
+            if failed:
+                self.failures += 1
+            if self.state == HALF_OPEN:
+                self.probes = max(0, self.probes - 1)
+                if failed is not None:
+                    self._transition(OPEN if failed else CLOSED)
+                return
+            if self.state == OPEN or failed is None:
+                # Sent before the circuit opened
+                return
+            self.consecutive = self.consecutive + 1 if failed else 0
+            self.results.append(failed)
+            if self._tripped():
+                self._transition(OPEN)
+
+    def _tripped(self):
+        if (
+            self.options.failures is not None
+            and self.options.failures <= self.consecutive
+        ):
+            return True
+        return (
+            self.options.error_rate is not None
+            and len(self.results) == self.results.maxlen
+            and self.options.error_rate <= sum(self.results) / len(self.results)
+        )
+
+    def _transition(self, state):
+        self.state = state
+        self.transitions[state] += 1
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+            logger.warning(
+                "Circuit open: %s is failing, failing fast for %ss",
+                self.name,
+                self.options.open_interval,
+            )
+        elif state == HALF_OPEN:
+            logger.info("Circuit half-open: probing %s", self.name)
+        else:
+            logger.info("Circuit closed: %s is back", self.name)
+        self.probes = 0
+        self.consecutive = 0
+        self.results.clear()
+
+    @contextlib.contextmanager
+    def attempt(self, failure):
+        # Around the sending of a message: raises CircuitOpen, or records
+        # the result, failure(error) telling whether an error is a failure
+        # of the upstream (or None)
+        self.allow()
+        failed = None
+        try:
+            yield
+            failed = False
+        except Exception as e:
+            failed = failure(e)
+            raise
+        finally:
+            self.record(failed)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "state": STATES[self.state],
+                "opened": self.transitions[OPEN],
+                "half_opened": self.transitions[HALF_OPEN],
+                "closed": self.transitions[CLOSED],
+                "rejected": self.rejected,
+                "failures": self.failures,
+            }
+
+
+def guard(breaker, failure):
+    # breaker.attempt(failure), or nothing without a breaker
+    if breaker is None:
+        return contextlib.nullcontext()
+    return breaker.attempt(failure)
+
+
+def mllp_failure(error):
+    # Connection, timeout and protocol errors. An exhausted pool, or an
+    # error reading a streamed HTTP request, says nothing about the MLLP
+    # server.
+    if isinstance(error, (OSError, asyncio.TimeoutError, MllpError)):
+        return True
+    return None
+
+
+def http_failure(error):
+    # Connection and timeout errors, and 5xx responses, of an HTTP(S)
+    # request (requests or asynchttp). A 4xx response is an answer of the
+    # server, and any other error (e.g. a bug, a malformed batch response)
+    # says nothing about it.
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", getattr(response, "status", None))
+    if status is not None:
+        return 500 <= status
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.RequestException):
+        # Also an OSError
+        return None
+    if isinstance(error, (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError)):
+        return True
+    return None
+
+
+class BreakingMllpClient:
+    # Wraps an MLLP client (MllpClient or PipelinedMllpClient)
+
+    def __init__(self, client, breaker):
+        self.client = client
+        self.breaker = breaker
+
+    def send(self, data):
+        with self.breaker.attempt(mllp_failure):
+            return self.client.send(data)
+
+    def stream(self, parts):
+        with self.breaker.attempt(mllp_failure):
+            yield from self.client.stream(parts)
+
+    def snapshot(self):
+        return self.client.snapshot()
+
+
+class AsyncBreakingMllpClient:
+    # Same as BreakingMllpClient, for the asyncio clients
+
+    def __init__(self, client, breaker):
+        self.client = client
+        self.breaker = breaker
+
+    async def send(self, data):
+        with self.breaker.attempt(mllp_failure):
+            return await self.client.send(data)
+
+    async def stream(self, parts):
+        with self.breaker.attempt(mllp_failure):
+            stream = self.client.stream(parts)
+            try:
+                async for part in stream:
+                    yield part
+            finally:
+                await stream.aclose()
+
+    def snapshot(self):
+        return self.client.snapshot()
+
+    async def close(self):
+        await self.client.close()
+
+
+def open_breaker(name, options):
+    # CircuitBreaker with its metrics, or None without options
+    if options is None:
+        return None
+    breaker = CircuitBreaker(name, options)
+    metrics.REGISTRY.register(metrics.BreakerGauge("mllp_bridge_breaker", breaker))
+    conditions = []
+    if options.failures is not None:
+        conditions.append("{} failures in a row".format(options.failures))
+    if options.error_rate is not None:
+        conditions.append(
+            "an error rate of {} over {} messages".format(
+                options.error_rate, options.window
+            )
+        )
+    logger.info(
+        "Circuit breaker of %s: open for %ss after %s",
+        name,
+        options.open_interval,
+        " or ".join(conditions),
+    )
+    return breaker
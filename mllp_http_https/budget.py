@@ -0,0 +1,296 @@
+### Byte budget of the message data held in memory: request bodies and
+### responses of http2mllp and https2mllp, messages in flight and their
+### responses in mllp2http and mllp2https. Past it, the HTTP(S) bridges
+### answer 503 and the MLLP bridges stop reading (or send a NACK).
+import asyncio
+import logging
+import threading
+
+from . import hl7, metrics
+
+logger = logging.getLogger(__name__)
+
+
+class BudgetOptions:
+    def __init__(self, max_bytes, connection_max_bytes=None, nack=None, retry_after=1):
+        # Bytes held by the process at most, and by one connection at most
+        # (unlimited if None)
+        self.max_bytes = max_bytes
+        self.connection_max_bytes = connection_max_bytes
+        # mllp2http and mllp2https: MSA-1 code (AE or AR) of the NACK sent
+        # back for a message over budget, or None to stop reading until the
+        # message fits
+        self.nack = nack
+        # http2mllp and https2mllp: seconds in the Retry-After header of the
+        # 503 responses
+        self.retry_after = retry_after
+
+
+class BudgetExceeded(Exception):
+    def __init__(self, message, too_large=False):
+        super().__init__(message)
+        # The message alone is over a limit: it would never fit
+        self.too_large = too_large
+
+
+class ByteBudget:
+    # Bytes held by the process, each connection having an Account of its
+    # own. take() fails right away when over budget; wait() and
+    # wait_async() block until the bytes fit; add() counts bytes that are
+    # already held (responses) without checking the limits; check() only
+    # tells whether the bytes could ever be taken.
+
+    def __init__(self, options):
+        self.options = options
+        self.used = 0
+        self.peak = 0
+        self.rejected = 0
+        self.waits = 0
+        self.exhausted = False
+        self.lock = threading.Lock()
+        self.released = threading.Condition(self.lock)
+        self._events = []  # asyncio.Event of each wait_async
+
+    def account(self):
+        return Account(self)
+
+    def _check(self, account, size, held=0):
+        # Raises BudgetExceeded (too_large) if size bytes, with held bytes
+        # of the account, are over a limit
+        if size < 0:
+            raise ValueError("Negative size: {}".format(size))
+        size += held
+        if self.options.max_bytes < size:
+            raise BudgetExceeded(
+                "Message of {} bytes over the byte budget ({})".format(
+                    size, self.options.max_bytes
+                ),
+                too_large=True,
+            )
+        limit = self.options.connection_max_bytes
+        if limit is not None and limit < size:
+            raise BudgetExceeded(
+                "Message of {} bytes over the connection byte budget ({})".format(
+                    size, limit
+                ),
+                too_large=True,
+            )
+
+    def _fits(self, account, size):
+        limit = self.options.connection_max_bytes
+        return self.used + size <= self.options.max_bytes and (
+            limit is None or account.size + size <= limit
+        )
+
+    def _add(self, account, size):
+        account.size += size
+        self.used += size
+        self.peak = max(self.peak, self.used)
+
+    def _exhaust(self):
+        if not self.exhausted:
+            self.exhausted = True
+            logger.warning("Byte budget exhausted: %s", self._snapshot())
+
+    def check(self, account, size):
+        # Raises BudgetExceeded (too_large) if account could never hold size
+        # more bytes
+        with self.lock:
+            self._check(account, size, account.size)
+
+    def take(self, account, size):
+        # The message being taken part by part, it is too large once the
+        # bytes of the account are
+        with self.lock:
+            self._check(account, size, account.size)
+            if not self._fits(account, size):
+                self.rejected += 1
+                self._exhaust()
+                raise BudgetExceeded(
+                    "{} bytes over the byte budget ({} of {} in use)".format(
+                        size, self.used, self.options.max_bytes
+                    )
+                )
+            self._add(account, size)
+
+    def wait(self, account, size):
+        with self.lock:
+            self._check(account, size)
+            if not self._fits(account, size):
+                self.waits += 1
+                self._exhaust()
+                while not self._fits(account, size):
+                    self.released.wait()
+            self._add(account, size)
+
+    async def wait_async(self, account, size):
+        # For the asyncio engine, whose accounts are all released on the
+        # event loop
+        with self.lock:
+            self._check(account, size)
+            if self._fits(account, size):
+                self._add(account, size)
+                return
+            self.waits += 1
+            self._exhaust()
+        while True:
+            event = asyncio.Event()
+            with self.lock:
+                if self._fits(account, size):
+                    self._add(account, size)
+                    return
+                self._events.append(event)
+            await event.wait()
+
+    def add(self, account, size):
+        with self.lock:
+            if not account.closed:
+                self._add(account, size)
+
+    def release(self, account, size=None, close=False):
+        # Releases size bytes of account, or all of them. Once closed, the
+        # bytes of the account are not counted any more (messages still in
+        # flight on a closed connection).
+        with self.lock:
+            if account.closed:
+                return
+            size = account.size if size is None else size
+            account.closed = close
+            account.size -= size
+            self.used -= size
+            if self.exhausted and self.used <= self.options.max_bytes // 2:
+                self.exhausted = False
+                logger.info("Byte budget available again: %s", self._snapshot())
+            self.released.notify_all()
+            events, self._events = self._events, []
+        for event in events:
+            event.set()
+
+    def _snapshot(self):
+        return {
+            "used": self.used,
+            "max": self.options.max_bytes,
+            "peak": self.peak,
+            "rejected": self.rejected,
+            "waits": self.waits,
+        }
+
+    def snapshot(self):
+        with self.lock:
+            return self._snapshot()
+
+
+class Account:
+    # Bytes held by one connection (or request) out of a ByteBudget
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.closed = False
+
+    def check(self, size):
+        self.budget.check(self, size)
+
+    def take(self, size):
+        self.budget.take(self, size)
+
+    def wait(self, size):
+        self.budget.wait(self, size)
+
+    async def wait_async(self, size):
+        await self.budget.wait_async(self, size)
+
+    def add(self, size):
+        self.budget.add(self, size)
+
+    def release(self, size=None):
+        # Releases size bytes, or all of them
+        self.budget.release(self, size)
+
+    def close(self):
+        self.budget.release(self, close=True)
+
+
+class _Unlimited:
+    # Account of a connection when there is no budget
+    size = 0
+
+    def check(self, size):
+        pass
+
+    def take(self, size):
+        pass
+
+    def wait(self, size):
+        pass
+
+    async def wait_async(self, size):
+        pass
+
+    def add(self, size):
+        pass
+
+    def release(self, size=None):
+        pass
+
+    def close(self):
+        pass
+
+
+UNLIMITED = _Unlimited()
+
+
+def open_account(budget):
+    # Account of a connection out of budget (a ByteBudget, or None)
+    return UNLIMITED if budget is None else Account(budget)
+
+
+def counted(parts, account):
+    # The parts of a body, each taken from account as it is read
+    for part in parts:
+        account.take(len(part))
+        yield part
+
+
+def admit(account, message, nack):
+    # Takes the bytes of an MLLP message from account, waiting for them to
+    # fit (the next messages are not read meanwhile) if nack is None.
+    # Otherwise returns a Nack with MSA-1 nack to send back for a message
+    # over budget, whose bytes are taken in its place; None once taken.
+    if nack is None:
+        account.wait(len(message))
+        return None
+    try:
+        account.take(len(message))
+    except BudgetExceeded as e:
+        metrics.ERRORS.inc("budget")
+        logger.error("Byte budget exceeded: %s", e)
+        response = hl7.Nack(hl7.ack(message, nack.encode("ascii")), "byte budget")
+        account.add(len(response.content))
+        return response
+    return None
+
+
+async def admit_async(account, message, nack):
+    # Same as admit, for the asyncio engine
+    if nack is None:
+        await account.wait_async(len(message))
+        return None
+    return admit(account, message, nack)
+
+
+def open_budget(options):
+    # ByteBudget with its metrics, or None without options
+    if options is None:
+        return None
+    budget = ByteBudget(options)
+    metrics.REGISTRY.register(metrics.BudgetGauge("mllp_bridge_budget", budget))
+    logger.info(
+        "Byte budget: %s bytes, %s per connection",
+        options.max_bytes,
+        (
+            "unlimited"
+            if options.connection_max_bytes is None
+            else options.connection_max_bytes
+        ),
+    )
+    return budget
@@ -0,0 +1,276 @@
+### Content-Encoding of HTTP(S) bodies: gzip and deflate, and zstd if the
+### zstandard package is installed
+import asyncio
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ENCODINGS = ("gzip", "deflate") + (("zstd",) if zstandard is not None else ())
+
+# Bytes of a compressed body read at a time, and decompressed before the
+# next read (and bytes decompressed at a time)
+READ_SIZE = 64 * 1024
+
+# Bytes of zstd data decompressed at a time: the output of each is bounded
+# (a few bytes of zstd can be blocks of 128 KiB), zstandard has no
+# max_length
+ZSTD_SLICE = 64
+
+
+class CompressionOptions:
+    def __init__(
+        self, encoding="gzip", level=6, min_size=1024, max_size=64 * 1024 * 1024
+    ):
+        # Content-Encoding of the request bodies (the preferred one of the
+        # client for responses)
+        self.encoding = encoding
+        # 1 (fastest) to 9 (smallest), 1 to 22 for zstd
+        self.level = level
+        # Smaller bodies are sent as they are
+        self.min_size = min_size
+        # Compressed bodies received are decompressed to this many bytes at
+        # most (BodyTooLarge past it)
+        self.max_size = max_size
+
+
+class DecodeError(ValueError):
+    pass
+
+
+class UnsupportedEncoding(DecodeError):
+    pass
+
+
+class BodyTooLarge(DecodeError):
+    pass
+
+
+if zstandard is not None:
+    DECODE_ERRORS = (zlib.error, zstandard.ZstdError)
+else:
+    DECODE_ERRORS = (zlib.error,)
+
+
+def compress(data, encoding, level=6):
+    if encoding == "gzip":
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    if encoding == "deflate":
+        return zlib.compress(data, level)
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    raise UnsupportedEncoding(encoding)
+
+
+class _ZstdDecompressor:
+    # Same interface as the zlib decompressobj: decompress(data, max_length),
+    # flush(), eof, unused_data and unconsumed_tail. Past max_length, the
+    # output is over by what ZSTD_SLICE bytes decompress to at most.
+
+    def __init__(self):
+        self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+        self.unconsumed_tail = b""
+        self.extra = b""  # data after the end of the frame
+
+    @property
+    def eof(self):
+        return self.decompressor.eof
+
+    @property
+    def unused_data(self):
+        return self.decompressor.unused_data + self.extra
+
+    def decompress(self, data, max_length=0):
+        view = memoryview(data)
+        parts = []
+        size = 0
+        while view and not (max_length and max_length <= size):
+            if self.eof:
+                self.extra += view.tobytes()
+                view = view[len(view) :]
+                break
+            part = self.decompressor.decompress(view[:ZSTD_SLICE])
+            view = view[ZSTD_SLICE:]
+            size += len(part)
+            parts.append(part)
+        self.unconsumed_tail = view.tobytes()
+        return b"".join(parts)
+
+    def flush(self):
+        return b""
+
+
+def decompressor(encoding):
+    # Object with decompress(chunk) and flush() for a Content-Encoding, or
+    # None for identity
+    encoding = (encoding or "identity").strip().lower()
+    if encoding == "identity":
+        return None
+    if encoding in ("gzip", "x-gzip"):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        return zlib.decompressobj()
+    if encoding == "zstd" and zstandard is not None:
+        return _ZstdDecompressor()
+    raise UnsupportedEncoding(encoding)
+
+
+def request_decompressor(encoding, options):
+    # decompressor(encoding) for a body received by a server whose
+    # CompressionOptions are options: compressed bodies are refused
+    # (UnsupportedEncoding) if None
+    d = decompressor(encoding)
+    if d is not None and options is None:
+        raise UnsupportedEncoding("{} (compression is off)".format(encoding))
+    return d
+
+
+def _inflate(d, data):
+    # Output of d for data, in parts of at most READ_SIZE bytes
+    while data:
+        part = d.decompress(data, READ_SIZE)
+        data = d.unconsumed_tail
+        if part:
+            yield part
+
+
+def _check_size(size, max_size):
+    if max_size is not None and max_size < size:
+        raise BodyTooLarge("Decompressed body over {} bytes".format(max_size))
+
+
+def _check_end(d):
+    # Raises DecodeError unless the compressed data ended, and nothing after
+    if d.unused_data:
+        raise DecodeError("Data after the end of the compressed body")
+    if not d.eof:
+        raise DecodeError("Compressed body truncated")
+
+
+def decompress(data, encoding, max_size=None):
+    # data decompressed, of max_size bytes at most (BodyTooLarge past it)
+    d = decompressor(encoding)
+    if d is None:
+        return data
+    return b"".join(_decompressed((data,), d, max_size))
+
+
+def read_parts(rfile, length, size=READ_SIZE):
+    # Body of Content-Length length, in parts of at most size bytes
+    while 0 < length:
+        chunk = rfile.read(min(size, length))
+        if not chunk:
+            raise EOFError("Body shorter than Content-Length")
+        length -= len(chunk)
+        yield chunk
+
+
+async def read_parts_async(reader, length, size=READ_SIZE, timeout=None):
+    # Same as read_parts, from an asyncio stream, with timeout seconds for
+    # each read
+    while 0 < length:
+        chunk = await asyncio.wait_for(reader.readexactly(min(size, length)), timeout)
+        length -= len(chunk)
+        yield chunk
+
+
+def decode_parts(parts, encoding, options=None):
+    # The parts of a received body, decompressed as they come. Raises
+    # UnsupportedEncoding right away (as request_decompressor),
+    # DecodeError while iterating.
+    d = request_decompressor(encoding, options)
+    return parts if d is None else _decompressed(parts, d, options.max_size)
+
+
+def _decompressed(parts, d, max_size):
+    size = 0
+    try:
+        for part in parts:
+            for part in _inflate(d, part):
+                size += len(part)
+                _check_size(size, max_size)
+                yield part
+            if d.unused_data:
+                break
+        part = d.flush()
+        size += len(part)
+        _check_size(size, max_size)
+        if part:
+            yield part
+        _check_end(d)
+    except DECODE_ERRORS as e:
+        raise DecodeError(e)
+
+
+def decode_parts_async(parts, encoding, options=None):
+    # Same as decode_parts, for an asynchronous iterable
+    d = request_decompressor(encoding, options)
+    return parts if d is None else _decompressed_async(parts, d, options.max_size)
+
+
+async def _decompressed_async(parts, d, max_size):
+    size = 0
+    try:
+        async for part in parts:
+            for part in _inflate(d, part):
+                size += len(part)
+                _check_size(size, max_size)
+                yield part
+            if d.unused_data:
+                break
+        part = d.flush()
+        size += len(part)
+        _check_size(size, max_size)
+        if part:
+            yield part
+        _check_end(d)
+    except DECODE_ERRORS as e:
+        raise DecodeError(e)
+
+
+def response_encoding(accept_encoding, options, size):
+    # Content-Encoding of a response of size bytes, from the Accept-Encoding
+    # header of the request: the encoding with the highest q-value, options
+    # .encoding on a tie, or None to send it as it is
+    if options is None or size < options.min_size or not accept_encoding:
+        return None
+    best = None
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        name = name.strip().lower()
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name == "*":
+            name = options.encoding
+        if name not in ENCODINGS or q <= 0:
+            continue
+        rank = (q, name == options.encoding)
+        if best is None or best[0] < rank:
+            best = (rank, name)
+    return best and best[1]
+
+
+def encode_response(data, accept_encoding, options):
+    # Body of a response and its Content-Encoding, None if not compressed
+    encoding = response_encoding(accept_encoding, options, len(data))
+    if encoding is None:
+        return data, None
+    return compress(data, encoding, options.level), encoding
+
+
+def encode_request(data, headers, options):
+    # Body and headers of a request, with the body compressed if options
+    # is set and the body large enough
+    if options is None or len(data) < options.min_size:
+        return data, headers
+    headers = dict(headers, **{"Content-Encoding": options.encoding})
+    return compress(data, options.encoding, options.level), headers
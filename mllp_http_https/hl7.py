@@ -0,0 +1,113 @@
+### Fields of HL7 v2 messages (ER7 encoding), read from the bytes without
+### decoding or splitting the whole message
+import time
+
+SEGMENT_TERMINATORS = (b"\r", b"\n")
+
+
+def field(message, segment, index):
+    # Field index of the first segment named segment, or None if there is
+    # no such segment or field. Numbered as in HL7: MSH-1 is the field
+    # separator, so field(message, b"MSH", 10) is the message control ID.
+    if message[:3] != b"MSH" or len(message) < 4:
+        return None
+    separator = message[3:4]
+    if segment == b"MSH":
+        start = 0
+        index -= 1
+    else:
+        starts = [
+            message.find(terminator + segment + separator)
+            for terminator in SEGMENT_TERMINATORS
+        ]
+        starts = [start for start in starts if 0 <= start]
+        if not starts:
+            return None
+        start = min(starts) + 1
+    end = len(message)
+    for terminator in SEGMENT_TERMINATORS:
+        i = message.find(terminator, start, end)
+        if 0 <= i:
+            end = i
+    fields = message[start:end].split(separator)
+    if index < len(fields):
+        return fields[index]
+    return None
+
+
+def message_control_id(message):
+    # MSH-10, or None if absent or empty
+    return field(message, b"MSH", 10) or None
+
+
+def ack_control_id(message):
+    # MSA-2, the control ID of the message acknowledged, or None
+    return field(message, b"MSA", 2) or None
+
+
+def header(message):
+    # Fields of the MSH segment, indexed as in HL7 from MSH-1 (the field
+    # separator itself is not repeated: header(message)[1] is MSH-2), or
+    # None if the message does not start with MSH
+    if message[:3] != b"MSH" or len(message) < 4:
+        return None
+    end = len(message)
+    for terminator in SEGMENT_TERMINATORS:
+        i = message.find(terminator, 0, end)
+        if 0 <= i:
+            end = i
+    return message[:end].split(message[3:4])
+
+
+def replay_key(message):
+    # Sending application (MSH-3), sending facility (MSH-4) and control ID
+    # (MSH-10) of a message, or None if it has no control ID
+    fields = header(message)
+    if fields is None or len(fields) < 10 or not fields[9]:
+        return None
+    return fields[2], fields[3], fields[9]
+
+
+def ack_code(message):
+    # MSA-1 (AA, AE, AR, CA, CE or CR), or None
+    return field(message, b"MSA", 1) or None
+
+
+def ack(message, code=b"AA"):
+    # Original mode acknowledgment of message, sent back on its behalf:
+    # sender and receiver swapped, and MSA-2 set to its control ID
+    fields = header(message)
+    separator = message[3:4] if fields else b"|"
+    if not fields:
+        fields = [b"MSH", b"^~\\&"]
+
+    def get(index):
+        return fields[index] if index < len(fields) else b""
+
+    trigger = get(8).split(get(1)[:1] or b"^")
+    msh = [
+        b"MSH",
+        get(1),
+        get(4),
+        get(5),
+        get(2),
+        get(3),
+        time.strftime("%Y%m%d%H%M%S").encode("ascii"),
+        b"",
+        b"ACK" + (get(1)[:1] + trigger[1] if 1 < len(trigger) else b""),
+        get(9),
+        get(10) or b"P",
+        get(11) or b"2.5",
+    ]
+    return separator.join(msh) + b"\r" + separator.join([b"MSA", code, get(9)]) + b"\r"
+
+
+class Nack:
+    # NACK sent back by mllp2http and mllp2https in place of the response of
+    # the HTTP(S) server, for the reason given
+    def __init__(self, content, reason):
+        self.content = content
+        self.reason = reason
+
+    def __repr__(self):
+        return "<NACK ({})>".format(self.reason)
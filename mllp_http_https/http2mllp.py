@@ -1,179 +1,437 @@
+import asyncio
 import functools
 import http.server
 import logging
-import socket
-import threading
+import math
 import time
-from .mllp import send_mllp, parse_mllp
+from . import compression, metrics, threadpool, workers
+from .breaker import AsyncBreakingMllpClient, BreakingMllpClient, CircuitOpen
+from .budget import BudgetExceeded, counted, open_account, open_budget
+from .asynchttp import (
+    HeadersTooLarge,
+    HttpRequestError,
+    UnsupportedTransferEncoding,
+    is_chunked,
+    parse_content_length,
+    read_body,
+    read_request,
+    response_head,
+)
+from .asyncmllp import AsyncMllpClient
+from .log2file import log_payload
+from .mllp import ParseMode, parse_mllp
+from .pipeline import AsyncPipelinedMllpClient, PipelinedMllpClient
+from .pool import MllpClient, MllpClientOptions, MllpConnection, PoolTimeout
+from .replay import AckCache, AsyncReplayingMllpClient, ReplayingMllpClient
+from .streaming import AsyncStreamMixIn, StreamMixIn, mllp_breaker, stream_threshold
 
 logger = logging.getLogger(__name__)
 
 
-class MllpClientOptions:
-    def __init__(self, keep_alive, max_messages, timeout):
-        # self.address = address
-        self.keep_alive = keep_alive
-        self.max_messages = max_messages
-        self.timeout = timeout
-
-
-class MllpClient:
-    def __init__(self, address, options):
-        self.address = address
-        self.options = options
-        self.connections = []
-        self.lock = threading.Lock()
-
-    def _check_connection(self, connection):
-        while not connection.closed:
-            elasped = (
-                connection.last_update - time.monotonic()
-                if connection.last_update is not None
-                else 0
-            )
-            remaining = self.options.keep_alive + elasped
-            if 0 < remaining:
-                time.sleep(remaining)
-            else:
-                try:
-                    with self.lock:
-                        self.connections.remove(connection)
-                except ValueError:
-                    pass
-                else:
-                    if self.options.keep_alive > 0:
-                        # To keep the connection alive in case keep_alive is -1
-                        connection.close()
-
-    def _connect(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        if self.options.timeout:
-            s.settimeout(self.options.timeout)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 10)
-        # print(self.address)
-        s.connect(self.address)
-        connection = MllpConnection(s)
-        if self.options.keep_alive is not None:
-            thread = threading.Thread(
-                daemon=False,
-                target=self._check_connection,
-                args=(connection,)
-            )
-            thread.start()
-        return connection
-
-    def send(self, data):
-        with self.lock:
-            try:
-                connection = self.connections.pop()
-            except IndexError:
-                connection = None
-            else:
-                connection.last_update = None
-        if connection is None:
-            connection = self._connect()
-        response = connection.send(data)
-        if self.options.max_messages <= connection.message_count and self.options.max_messages >= 0:
-            connection.close()
-        else:
-            connection.last_update = time.monotonic()
-            with self.lock:
-                self.connections.append(connection)
-        return response
-
-
-class MllpConnection:
-    def __init__(self, socket):
-        self.closed = False
-        self.last_update = None
-        self.message_count = 0
-        self.socket = socket
-        # self.responses = read_mllp(read_socket_bytes(self.socket))
-        # self.responses = read_mllp(self.socket.recv(1024))
-        # print(self.responses)
-
-    def close(self):
-        self.close = True
-        self.socket.shutdown(socket.SHUT_RDWR)
-        self.socket.close()
-        print("Disconnected from MLLP Server")
-
-    def send(self, data):
-        # write_mllp(read_socket_bytes(self.socket), data)
-        # self.socket.flush()
-        self.message_count += 1
-        # return next(self.responses)
-        return send_mllp(self.socket, data)
-
-
-# class MllpConnection:
-#     def __init__(self, socket):
-#         #self.address = address
-#         self.cancel = None
-#         self.closed = False
-#         self.socket = socket
-#         self.responses = read_mllp(read_socket_bytes(self.socket))
-#
-#     def close(self):
-#         self.closed = True
-#         self.socket.close()
-#
-#     def send(self, data):
-#         write_mllp(read_socket_bytes(self.socket), data)
-#         self.socket.flush()
-#         self.message_count += 1
-#         return next(self.responses)
-
-
 class HttpServerOptions:
-    def __init__(self, timeout, content_type, keep_alive):
+    def __init__(
+        self,
+        timeout,
+        content_type,
+        keep_alive,
+        mllp_response=ParseMode.STRIP_FRAMING,
+        engine="threaded",
+        workers=1,
+        compression=None,
+        stream_threshold=None,
+        budget=None,
+        pool=None,
+    ):
         self.timeout = timeout
         self.content_type = content_type
         self.keep_alive = keep_alive
+        self.mllp_response = mllp_response
+        self.engine = engine
+        # Processes sharing the port, each with its own connections
+        self.workers = workers
+        # compression.CompressionOptions to compress large responses for
+        # clients that accept it, and accept compressed requests (refused
+        # with 415 if None)
+        self.compression = compression
+        # Requests with a Content-Length of at least this many bytes are
+        # streamed (sent to MLLP as they are read, the response written back
+        # as it is received) instead of read whole, or none if None
+        self.stream_threshold = stream_threshold
+        # budget.BudgetOptions to limit the bytes of the requests and responses
+        # held in memory (answering 503 past it), or None
+        self.budget = budget
+        # threadpool.PoolOptions to handle the connections of the threaded
+        # engine with a bounded pool of threads, shedding them past it, or None
+        # for a thread per connection
+        self.pool = pool
 
 
-class HttpHandler(http.server.BaseHTTPRequestHandler):
-    def __init__(self, request, address, server, mllp_client, content_type, timeout, keep_alive):
+class HttpServer(
+    threadpool.HttpThreadPoolMixIn,
+    workers.ReusePortMixin,
+    http.server.ThreadingHTTPServer,
+):
+    pass
+
+
+class HttpHandler(
+    StreamMixIn, metrics.MetricsMixin, http.server.BaseHTTPRequestHandler
+):
+    def __init__(
+        self,
+        request,
+        address,
+        server,
+        mllp_client,
+        content_type,
+        timeout,
+        keep_alive,
+        mllp_response=ParseMode.STRIP_FRAMING,
+        compression=None,
+        stream_threshold=None,
+        byte_budget=None,
+    ):
         self.content_type = content_type
         self.mllp_client = mllp_client
         self.timeout = timeout
         self.keep_alive = keep_alive
+        self.mllp_response = mllp_response
+        self.compression = compression
+        self.stream_threshold = stream_threshold
+        self.byte_budget = byte_budget
         super().__init__(request, address, server)
 
     def do_POST(self):
+        account = open_account(self.byte_budget)
         try:
             # Process received data
-            content_length = int(self.headers["Content-Length"])  # From the received data
-            data = self.rfile.read(content_length)  # Read income data
+            start = time.perf_counter()
+            if is_chunked(self.headers.get("Transfer-Encoding")):
+                content_length = None  # Chunked: the body ends with its last chunk
+                if "Content-Length" in self.headers:
+                    # Ambiguous length, do not reuse the connection
+                    self.close_connection = True
+            else:
+                # From the received data
+                content_length = parse_content_length(
+                    self.headers.get("Content-Length")
+                )
+            if self.stream_threshold is not None and (
+                content_length is None or self.stream_threshold <= content_length
+            ):
+                self.stream(content_length, account)
+                return
+            if content_length is not None:
+                # A body over the budget is refused before it is read
+                account.check(content_length)
+            # Read income data, decompressed, taken from the budget part by part
+            data = b"".join(counted(self.body_parts(content_length), account))
+            metrics.BODY_READ.observe(time.perf_counter() - start)
+            metrics.MESSAGES.inc()
+            metrics.BYTES.inc("in", value=len(data))
             logger.info("Message: %s bytes", len(data))
-            print("\nReceived Data:\n{}\n\n".format(data))
+            log_payload(logger, "Received Data", data)
 
-            # Send data to MLLP Listener and get MLLP ACK response:
+            # Send data to MLLP Listener and get MLLP ACK response
+            # (already without the Start Block and End Block):
+            start = time.perf_counter()
             response = self.mllp_client.send(data)
+            metrics.MLLP_ROUND_TRIP.observe(time.perf_counter() - start)
+            account.add(len(response))
             logger.info("Response: %s bytes", len(response))
 
-            # Parse the data from the MLLP response:
-            #   > Remove Start block and End Block
-            #   > Correct Carriage Return if needed
-            response = parse_mllp(response)
+            # Prepare the MLLP response for the HTTP body:
+            #   > Add the MLLP framing back, if raw
+            #   > Correct Carriage Return, if crlf
+            start = time.perf_counter()
+            response = parse_mllp(response, self.mllp_response)
+            metrics.PARSE_MLLP.observe(time.perf_counter() - start)
 
             # Prepare and send back ACK to HTTP client
+            start = time.perf_counter()
+            body, encoding = compression.encode_response(
+                response, self.headers.get("Accept-Encoding"), self.compression
+            )
             self.send_response(200)
-            self.send_header("Content-Length", len(response))
+            self.send_header("Content-Length", len(body))
             if self.content_type:
                 self.send_header("Content-Type", self.content_type)
-                print(self.content_type)
+            if encoding is not None:
+                self.send_header("Content-Encoding", encoding)
+            if self.compression is not None:
+                self.send_header("Vary", "Accept-Encoding")
             if self.keep_alive is not None:
                 self.send_header("Keep-Alive", f"timeout={self.keep_alive}")
             self.end_headers()
-            self.wfile.write(response)
-            print("Response Data:\n{}\n\n".format(response))
+            self.wfile.write(body)
+            metrics.RESPONSE_WRITE.observe(time.perf_counter() - start)
+            metrics.BYTES.inc("out", value=len(response))
+            log_payload(logger, "Response Data", response)
+        except PoolTimeout as e:
+            metrics.ERRORS.inc("pool_timeout")
+            logger.error("MLLP connection pool exhausted: %s", e)
+            self.send_error(503, "MLLP connection pool exhausted")
+        except CircuitOpen as e:
+            metrics.ERRORS.inc("circuit_open")
+            logger.error("Message not sent: %s", e)
+            self.send_response(503, "MLLP server unavailable")
+            self.send_header("Retry-After", math.ceil(e.retry_after))
+            self.send_header("Content-Length", 0)
+            self.end_headers()
+        except compression.UnsupportedEncoding as e:
+            metrics.ERRORS.inc("bad_request")
+            logger.error("Unsupported Content-Encoding: %s", e)
+            self.close_connection = True
+            self.send_error(415, "Unsupported Content-Encoding")
+        except compression.BodyTooLarge as e:
+            metrics.ERRORS.inc("bad_request")
+            logger.error("Decompressed request body too large: %s", e)
+            self.close_connection = True
+            self.send_error(413, "Decompressed body too large")
+        except compression.DecodeError as e:
+            metrics.ERRORS.inc("bad_request")
+            logger.error("Failed to decompress the request body: %s", e)
+            self.close_connection = True
+            self.send_error(400, "Bad compressed body")
+        except UnsupportedTransferEncoding as e:
+            metrics.ERRORS.inc("bad_request")
+            logger.error("Unsupported Transfer-Encoding: %s", e)
+            self.close_connection = True
+            self.send_error(501, "Unsupported Transfer-Encoding")
+        except HttpRequestError as e:
+            metrics.ERRORS.inc("bad_request")
+            logger.error("HTTP request error: %s", e)
+            self.close_connection = True
+            self.send_error(400, "Bad request body")
+        except BudgetExceeded as e:
+            metrics.ERRORS.inc("budget")
+            logger.error("Byte budget exceeded: %s", e)
+            self.close_connection = True
+            if e.too_large:
+                self.send_error(413, "Message over the byte budget")
+            else:
+                self.send_response(503, "Byte budget exhausted")
+                self.send_header("Retry-After", self.byte_budget.options.retry_after)
+                self.send_header("Content-Length", 0)
+                self.send_header("Connection", "close")
+                self.end_headers()
+        except Exception as e:
+            metrics.ERRORS.inc("connection")
+            logger.error("HTTP connection error: %s", e)
+        finally:
+            account.release()
+
+
+class AsyncHttpHandler(AsyncStreamMixIn):
+    # Same as HttpHandler, for the asyncio engine: one coroutine per HTTP
+    # connection (with keep-alive), sending to MLLP over non-blocking sockets
+    def __init__(
+        self,
+        mllp_client,
+        content_type,
+        timeout,
+        keep_alive,
+        mllp_response=ParseMode.STRIP_FRAMING,
+        compression=None,
+        stream_threshold=None,
+        byte_budget=None,
+    ):
+        self.content_type = content_type
+        self.mllp_client = mllp_client
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self.mllp_response = mllp_response
+        self.compression = compression
+        self.stream_threshold = stream_threshold
+        self.byte_budget = byte_budget
+
+    async def __call__(self, reader, writer):
+        account = open_account(self.byte_budget)
+        try:
+            while True:
+                account.release()
+                request = await asyncio.wait_for(read_request(reader), self.timeout)
+                if request is None:
+                    break
+                if request.method == "GET" and metrics.is_metrics_path(request.target):
+                    await metrics.write_metrics(writer, request)
+                    if not request.keep_alive:
+                        break
+                    continue
+                if request.method != "POST":
+                    writer.write(
+                        response_head(
+                            501, [("Content-Length", 0), ("Connection", "close")]
+                        )
+                    )
+                    break
+
+                length = request.length
+                if self.stream_threshold is not None and (
+                    length is None or self.stream_threshold <= length
+                ):
+                    if not await self.stream(reader, writer, request, length, account):
+                        break
+                    continue
+
+                # Process received data
+                start = time.perf_counter()
+                if length is not None:
+                    # A body over the budget is refused before it is read
+                    account.check(length)
+                data = await asyncio.wait_for(
+                    read_body(
+                        reader, writer, request, self.compression, take=account.take
+                    ),
+                    self.timeout,
+                )
+                metrics.BODY_READ.observe(time.perf_counter() - start)
+                metrics.MESSAGES.inc()
+                metrics.BYTES.inc("in", value=len(data))
+                logger.info("Message: %s bytes", len(data))
+                log_payload(logger, "Received Data", data)
+
+                # Send data to MLLP Listener and get MLLP ACK response
+                # (already without the Start Block and End Block):
+                start = time.perf_counter()
+                response = await self.mllp_client.send(data)
+                metrics.MLLP_ROUND_TRIP.observe(time.perf_counter() - start)
+                account.add(len(response))
+                logger.info("Response: %s bytes", len(response))
+
+                # Prepare the MLLP response for the HTTP body
+                start = time.perf_counter()
+                response = parse_mllp(response, self.mllp_response)
+                metrics.PARSE_MLLP.observe(time.perf_counter() - start)
+
+                # Prepare and send back ACK to HTTP client
+                start = time.perf_counter()
+                body, encoding = compression.encode_response(
+                    response, request.headers.get("accept-encoding"), self.compression
+                )
+                headers = [("Content-Length", len(body))]
+                if self.content_type:
+                    headers.append(("Content-Type", self.content_type))
+                if encoding is not None:
+                    headers.append(("Content-Encoding", encoding))
+                if self.compression is not None:
+                    headers.append(("Vary", "Accept-Encoding"))
+                if self.keep_alive is not None:
+                    headers.append(("Keep-Alive", f"timeout={self.keep_alive}"))
+                if not request.keep_alive:
+                    headers.append(("Connection", "close"))
+                writer.write(response_head(200, headers))
+                writer.write(body)
+                await writer.drain()
+                metrics.RESPONSE_WRITE.observe(time.perf_counter() - start)
+                metrics.BYTES.inc("out", value=len(response))
+                log_payload(logger, "Response Data", response)
+                if not request.keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except UnsupportedTransferEncoding as e:
+            metrics.ERRORS.inc("bad_request")
+            writer.write(
+                response_head(501, [("Content-Length", 0), ("Connection", "close")])
+            )
+            logger.error("Unsupported Transfer-Encoding: %s", e)
+        except HeadersTooLarge as e:
+            metrics.ERRORS.inc("bad_request")
+            writer.write(
+                response_head(431, [("Content-Length", 0), ("Connection", "close")])
+            )
+            logger.error("HTTP request headers too large: %s", e)
+        except HttpRequestError as e:
+            metrics.ERRORS.inc("bad_request")
+            writer.write(
+                response_head(400, [("Content-Length", 0), ("Connection", "close")])
+            )
+            logger.error("HTTP request error: %s", e)
+        except compression.UnsupportedEncoding as e:
+            metrics.ERRORS.inc("bad_request")
+            writer.write(
+                response_head(415, [("Content-Length", 0), ("Connection", "close")])
+            )
+            logger.error("Unsupported Content-Encoding: %s", e)
+        except compression.BodyTooLarge as e:
+            metrics.ERRORS.inc("bad_request")
+            writer.write(
+                response_head(413, [("Content-Length", 0), ("Connection", "close")])
+            )
+            logger.error("Decompressed request body too large: %s", e)
+        except compression.DecodeError as e:
+            metrics.ERRORS.inc("bad_request")
+            writer.write(
+                response_head(400, [("Content-Length", 0), ("Connection", "close")])
+            )
+            logger.error("Failed to decompress the request body: %s", e)
+        except PoolTimeout as e:
+            metrics.ERRORS.inc("pool_timeout")
+            writer.write(
+                response_head(503, [("Content-Length", 0), ("Connection", "close")])
+            )
+            logger.error("MLLP connection pool exhausted: %s", e)
+        except CircuitOpen as e:
+            metrics.ERRORS.inc("circuit_open")
+            writer.write(
+                response_head(
+                    503,
+                    [
+                        ("Retry-After", math.ceil(e.retry_after)),
+                        ("Content-Length", 0),
+                        ("Connection", "close"),
+                    ],
+                )
+            )
+            logger.error("Message not sent: %s", e)
+        except BudgetExceeded as e:
+            metrics.ERRORS.inc("budget")
+            if e.too_large:
+                writer.write(
+                    response_head(413, [("Content-Length", 0), ("Connection", "close")])
+                )
+            else:
+                writer.write(
+                    response_head(
+                        503,
+                        [
+                            ("Retry-After", self.byte_budget.options.retry_after),
+                            ("Content-Length", 0),
+                            ("Connection", "close"),
+                        ],
+                    )
+                )
+            logger.error("Byte budget exceeded: %s", e)
         except Exception as e:
+            metrics.ERRORS.inc("connection")
             logger.error("HTTP connection error: %s", e)
+        finally:
+            account.release()
+            writer.close()
 
 
 def serve(address, options, mllp_address, mllp_options):
-    client = MllpClient(mllp_address, mllp_options)
+    if 1 < options.workers and workers.worker_index() is None:
+        workers.supervise(
+            options.workers, serve, address, options, mllp_address, mllp_options
+        )
+        return
+
+    if options.engine == "asyncio":
+        asyncio.run(serve_async(address, options, mllp_address, mllp_options))
+        return
+
+    client = (PipelinedMllpClient if 1 < mllp_options.pipeline_depth else MllpClient)(
+        mllp_address, mllp_options
+    )
+    metrics.REGISTRY.register(metrics.PoolGauge("mllp_bridge_mllp_pool", client))
+    if mllp_options.breaker is not None:
+        client = BreakingMllpClient(client, mllp_breaker(mllp_address, mllp_options))
+    if mllp_options.ack_cache_size:
+        client = ReplayingMllpClient(
+            client, AckCache(mllp_options.ack_cache_size, mllp_options.ack_cache_ttl)
+        )
 
     handler = functools.partial(
         HttpHandler,
@@ -181,9 +439,54 @@ def serve(address, options, mllp_address, mllp_options):
         keep_alive=options.keep_alive,
         timeout=options.timeout or None,
         mllp_client=client,
+        mllp_response=options.mllp_response,
+        compression=options.compression,
+        stream_threshold=stream_threshold(options, mllp_options),
+        byte_budget=open_budget(options.budget),
     )
 
-    server = http.server.ThreadingHTTPServer(address, handler)
+    server = HttpServer(address, handler, pool=options.pool)
     logger.info("\nListening on %s:%s", address[0], address[1])
     server.protocol_version = "HTTP/1.1"
     server.serve_forever()
+
+
+async def serve_async(address, options, mllp_address, mllp_options):
+    client = (
+        AsyncPipelinedMllpClient if 1 < mllp_options.pipeline_depth else AsyncMllpClient
+    )(mllp_address, mllp_options)
+    metrics.REGISTRY.register(metrics.PoolGauge("mllp_bridge_mllp_pool", client))
+    if mllp_options.breaker is not None:
+        client = AsyncBreakingMllpClient(
+            client, mllp_breaker(mllp_address, mllp_options)
+        )
+    if mllp_options.ack_cache_size:
+        client = AsyncReplayingMllpClient(
+            client, AckCache(mllp_options.ack_cache_size, mllp_options.ack_cache_ttl)
+        )
+
+    handler = AsyncHttpHandler(
+        content_type=options.content_type,
+        keep_alive=options.keep_alive,
+        timeout=options.timeout or None,
+        mllp_client=client,
+        mllp_response=options.mllp_response,
+        compression=options.compression,
+        stream_threshold=stream_threshold(options, mllp_options),
+        byte_budget=open_budget(options.budget),
+    )
+
+    server = await asyncio.start_server(
+        handler,
+        address[0],
+        address[1],
+        reuse_address=True,
+        reuse_port=workers.reuse_port(),
+        backlog=threadpool.listen_backlog(options.pool),
+    )
+    logger.info("\nListening on %s:%s (asyncio)", address[0], address[1])
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await client.close()
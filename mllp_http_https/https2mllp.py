@@ -2,118 +2,62 @@
 ### By Tiago Rodrigues
 ### Sectra Iberia, Aug 2022
 ### Addapted from https://github.com/rivethealth/mllp-http
+import asyncio
 import base64
 import functools
 import http.server
 import logging
+import math
 import os
-import socket
 import ssl
-import threading
 import time
 from datetime import datetime, timezone
 
-from .mllp import send_mllp, parse_mllp
+from . import compression, metrics, threadpool, workers
+from .breaker import AsyncBreakingMllpClient, BreakingMllpClient, CircuitOpen
+from .budget import BudgetExceeded, counted, open_account, open_budget
+from .asynchttp import (
+    HeadersTooLarge,
+    HttpRequestError,
+    UnsupportedTransferEncoding,
+    is_chunked,
+    parse_content_length,
+    read_body,
+    read_request,
+    response_head,
+)
+from .asyncmllp import AsyncMllpClient
+from .log2file import log_payload
+from .mllp import ParseMode, parse_mllp
+from .pipeline import AsyncPipelinedMllpClient, PipelinedMllpClient
+from .pool import MllpClient, MllpClientOptions, MllpConnection, PoolTimeout
+from .replay import AckCache, AsyncReplayingMllpClient, ReplayingMllpClient
+from .streaming import AsyncStreamMixIn, StreamMixIn, mllp_breaker, stream_threshold
 
 logger = logging.getLogger(__name__)
 
-class MllpClientOptions:
-    def __init__(self, keep_alive, max_messages, timeout):
-        # self.address = address
-        self.keep_alive = keep_alive
-        self.max_messages = max_messages
-        self.timeout = timeout
-
-
-class MllpClient:
-    def __init__(self, address, options):
-        self.address = address
-        self.options = options
-        self.connections = []
-        self.lock = threading.Lock()
-
-    def _check_connection(self, connection):
-        while not connection.closed:
-            elasped = (
-                connection.last_update - time.monotonic()
-                if connection.last_update is not None
-                else 0
-            )
-            remaining = self.options.keep_alive + elasped
-            if 0 < remaining:
-                time.sleep(remaining)
-            else:
-                try:
-                    with self.lock:
-                        self.connections.remove(connection)
-                except ValueError:
-                    pass
-                else:
-                    if self.options.keep_alive > 0:
-                        # To keep the connection alive in case keep_alive is -1
-                        connection.close()
-
-    def _connect(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        if self.options.timeout:
-            s.settimeout(self.options.timeout)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 10)
-        # print(self.address)
-        s.connect(self.address)
-        connection = MllpConnection(s)
-        if self.options.keep_alive is not None:
-            thread = threading.Thread(
-                daemon=False,
-                target=self._check_connection,
-                args=(connection,)
-            )
-            thread.start()
-        return connection
-
-    def send(self, data):
-        with self.lock:
-            try:
-                connection = self.connections.pop()
-            except IndexError:
-                connection = None
-            else:
-                connection.last_update = None
-        if connection is None:
-            connection = self._connect()
-        response = connection.send(data)
-        if connection.message_count >= self.options.max_messages >= 0:
-            connection.close()
-        else:
-            connection.last_update = time.monotonic()
-            with self.lock:
-                self.connections.append(connection)
-        return response
-
-
-class MllpConnection:
-    def __init__(self, socket):
-        self.closed = False
-        self.last_update = None
-        self.message_count = 0
-        self.socket = socket
-
-    def close(self):
-        self.close = True
-        self.socket.shutdown(socket.SHUT_RDWR)
-        self.socket.close()
-        logger.info("Disconnected from MLLP Server")
-        #print("Disconnected from MLLP Server")
-
-    def send(self, data):
-        self.message_count += 1
-
-        # To send the HL7 messages, it will make use of an MLLP parser to format the data
-        # The parser will return the ACK/NACK response
-        return send_mllp(self.socket, data)
-
 
 class HttpsServerOptions:
-    def __init__(self, timeout, content_type, certfile, keyfile, keep_alive, username, password, mllp_parser):
+    def __init__(
+        self,
+        timeout,
+        content_type,
+        certfile,
+        keyfile,
+        keep_alive,
+        username,
+        password,
+        mllp_parser,
+        mllp_response=None,
+        engine="threaded",
+        ciphers=None,
+        handshake_timeout=None,
+        workers=1,
+        compression=None,
+        stream_threshold=None,
+        budget=None,
+        pool=None,
+    ):
         self.timeout = timeout
         self.content_type = content_type
         self.certfile = certfile
@@ -122,30 +66,77 @@ class HttpsServerOptions:
         self.username = username
         self.password = password
         self.mllp_parser = mllp_parser
+        # How the MLLP response is put on the HTTPS body. By default it
+        # follows mllp_parser: without framing if True, as received if False
+        if mllp_response is None:
+            mllp_response = ParseMode.STRIP_FRAMING if mllp_parser else ParseMode.RAW
+        self.mllp_response = mllp_response
+        self.engine = engine
+        # "modern" (ECDHE with AES-GCM or ChaCha20, TLS 1.2 or later), an
+        # OpenSSL cipher list, or None for the OpenSSL defaults
+        self.ciphers = ciphers
+        # Seconds for a client to complete the TLS handshake, or unlimited if None
+        self.handshake_timeout = handshake_timeout
+        # Processes sharing the port, each with its own connections
+        self.workers = workers
+        # compression.CompressionOptions to compress large responses for
+        # clients that accept it, and accept compressed requests (refused
+        # with 415 if None)
+        self.compression = compression
+        # Requests with a Content-Length of at least this many bytes are
+        # streamed (sent to MLLP as they are read, the response written back
+        # as it is received) instead of read whole, or none if None
+        self.stream_threshold = stream_threshold
+        # budget.BudgetOptions to limit the bytes of the requests and responses
+        # held in memory (answering 503 past it), or None
+        self.budget = budget
+        # threadpool.PoolOptions to handle the connections of the threaded
+        # engine with a bounded pool of threads, shedding them past it, or None
+        # for a thread per connection
+        self.pool = pool
 
 
 class Authentication:
     def __init__(self, username, password):
         self.username = username
         self.password = password
-        self.key = ''
+        self.key = ""
         self.key = base64.b64encode(
-            bytes('%s:%s' % (self.username, self.password), 'utf-8')).decode('ascii')
+            bytes("%s:%s" % (self.username, self.password), "utf-8")
+        ).decode("ascii")
 
     def get_auth_key(self):
         return self.key
 
 
-class HttpsHandler(http.server.BaseHTTPRequestHandler):
-    def __init__(self, request, address, server, mllp_client,
-                 content_type, timeout, keep_alive, authentication, mllp_parser):
+class HttpsHandler(
+    StreamMixIn, metrics.MetricsMixin, http.server.BaseHTTPRequestHandler
+):
+    def __init__(
+        self,
+        request,
+        address,
+        server,
+        mllp_client,
+        content_type,
+        timeout,
+        keep_alive,
+        authentication,
+        mllp_response,
+        compression=None,
+        stream_threshold=None,
+        byte_budget=None,
+    ):
         self.protocol_version = "HTTP/1.1"
         self.content_type = content_type
         self.mllp_client = mllp_client
         self.timeout = timeout
         self.keep_alive = keep_alive
         self.authentication = authentication
-        self.mllp_parser = mllp_parser
+        self.mllp_response = mllp_response
+        self.compression = compression
+        self.stream_threshold = stream_threshold
+        self.byte_budget = byte_budget
         super().__init__(request, address, server)
 
     # Disable log from handler
@@ -155,8 +146,8 @@ class HttpsHandler(http.server.BaseHTTPRequestHandler):
     # For Authentication
     def do_AUTHHEAD(self):
         self.send_response(401)
-        self.send_header('WWW-Authenticate', b'Basic realm=\"Test\"')
-        self.send_header('Content-type', b'text/html')
+        self.send_header("WWW-Authenticate", b'Basic realm="Test"')
+        self.send_header("Content-type", b"text/html")
         self.end_headers()
 
     # To check auth on server and client side
@@ -165,22 +156,36 @@ class HttpsHandler(http.server.BaseHTTPRequestHandler):
         # print(self.headers['Authorization'])
         # print(self.headers['Content-type'])
         # print(self.headers['Date'])
-        if self.headers['Authorization'] == None:
+        if self.headers["Authorization"] == None:
             self.do_AUTHHEAD()
-            self.wfile.write(b'Authentication is required.')
-            logger.info('Client did not authenticate.')
+            self.wfile.write(b"Authentication is required.")
+            logger.info("Client did not authenticate.")
+            metrics.ERRORS.inc("unauthorized")
             return False
-        elif self.headers['Authorization'] == 'Basic ' + str(key):
-            logger.info('Client Authenticated.')
+        elif self.headers["Authorization"] == "Basic " + str(key):
+            logger.info("Client Authenticated.")
             return True
         else:
             self.do_AUTHHEAD()
-            self.wfile.write(bytes(self.headers['Authorization'], "ascii"))
-            self.wfile.write(b'Authentication failed: Wrong credentials.')
-            logger.info('Client did not provide the correct credentials.')
+            self.wfile.write(bytes(self.headers["Authorization"], "ascii"))
+            self.wfile.write(b"Authentication failed: Wrong credentials.")
+            logger.info("Client did not provide the correct credentials.")
+            metrics.ERRORS.inc("unauthorized")
             return False
 
+    def do_GET(self):
+        # Metrics, with the same authentication as the messages
+        if self.authentication is not None:
+            try:
+                if not self.check_auth():
+                    return
+            except Exception as e:
+                logger.error("Authentication error: %s", e)
+                return
+        super().do_GET()
+
     def do_POST(self):
+        account = open_account(self.byte_budget)
         try:
             # Check authentication
             authentication_step = False
@@ -196,26 +201,61 @@ class HttpsHandler(http.server.BaseHTTPRequestHandler):
 
             if authentication_step:
                 # Process received data
-                content_length = int(self.headers["Content-Length"])  # From the received data
-                data = self.rfile.read(content_length)  # Read income data
+                start = time.perf_counter()
+                if is_chunked(self.headers.get("Transfer-Encoding")):
+                    content_length = None  # Chunked: the body ends with its last chunk
+                    if "Content-Length" in self.headers:
+                        # Ambiguous length, do not reuse the connection
+                        self.close_connection = True
+                else:
+                    # From the received data
+                    content_length = parse_content_length(
+                        self.headers.get("Content-Length")
+                    )
+                if self.stream_threshold is not None and (
+                    content_length is None or self.stream_threshold <= content_length
+                ):
+                    self.stream(content_length, account)
+                    return
+                if content_length is not None:
+                    # A body over the budget is refused before it is read
+                    account.check(content_length)
+                # Read income data, decompressed, taken from the budget part by part
+                data = b"".join(counted(self.body_parts(content_length), account))
+                metrics.BODY_READ.observe(time.perf_counter() - start)
+                metrics.MESSAGES.inc()
+                metrics.BYTES.inc("in", value=len(data))
                 logger.info("Message: %s bytes", len(data))
-                logger.info("Received Data:\n{}".format(data))
+                log_payload(logger, "Received Data", data)
 
-                # Send data to MLLP Listener and get MLLP ACK response:
+                # Send data to MLLP Listener and get MLLP ACK response
+                # (already without the Start Block and End Block):
+                start = time.perf_counter()
                 response = self.mllp_client.send(data)
+                metrics.MLLP_ROUND_TRIP.observe(time.perf_counter() - start)
+                account.add(len(response))
 
-                # Parse the data from the MLLP response:
-                #   > Remove Start block and End Block
-                #   > Correct Carriage Return if needed
-                if self.mllp_parser:
-                    response = parse_mllp(response)
+                # Prepare the MLLP response for the HTTPS body:
+                #   > Add the MLLP framing back, if raw
+                #   > Correct Carriage Return, if crlf
+                start = time.perf_counter()
+                response = parse_mllp(response, self.mllp_response)
+                metrics.PARSE_MLLP.observe(time.perf_counter() - start)
 
                 # Prepare and send back ACK to HTTPS client
+                start = time.perf_counter()
+                body, encoding = compression.encode_response(
+                    response, self.headers.get("Accept-Encoding"), self.compression
+                )
                 self.send_response(200)
-                self.send_header("Content-Length", len(response))
+                self.send_header("Content-Length", len(body))
                 if self.content_type:
                     self.send_header("Content-Type", self.content_type)
-                    #print(self.content_type)
+                    # print(self.content_type)
+                if encoding is not None:
+                    self.send_header("Content-Encoding", encoding)
+                if self.compression is not None:
+                    self.send_header("Vary", "Accept-Encoding")
                 if self.keep_alive is not None:
                     self.send_header("Keep-Alive", f"timeout={self.keep_alive}")
                 now = datetime.now(timezone.utc)
@@ -223,19 +263,311 @@ class HttpsHandler(http.server.BaseHTTPRequestHandler):
                 # print(date)
                 self.send_header("Date", date)
                 self.end_headers()
-                self.wfile.write(response)
+                self.wfile.write(body)
+                metrics.RESPONSE_WRITE.observe(time.perf_counter() - start)
+                metrics.BYTES.inc("out", value=len(response))
                 logger.info("Response: %s bytes", len(response))
-                logger.info("Response Data: 200 Ok\n{}".format(response))
-
+                log_payload(logger, "Response Data", response)
+
+        except PoolTimeout as e:
+            metrics.ERRORS.inc("pool_timeout")
+            logger.error("MLLP connection pool exhausted: %s", e)
+            self.send_error(503, "MLLP connection pool exhausted")
+        except CircuitOpen as e:
+            metrics.ERRORS.inc("circuit_open")
+            logger.error("Message not sent: %s", e)
+            self.send_response(503, "MLLP server unavailable")
+            self.send_header("Retry-After", math.ceil(e.retry_after))
+            self.send_header("Content-Length", 0)
+            self.end_headers()
+        except compression.UnsupportedEncoding as e:
+            metrics.ERRORS.inc("bad_request")
+            logger.error("Unsupported Content-Encoding: %s", e)
+            self.close_connection = True
+            self.send_error(415, "Unsupported Content-Encoding")
+        except compression.BodyTooLarge as e:
+            metrics.ERRORS.inc("bad_request")
+            logger.error("Decompressed request body too large: %s", e)
+            self.close_connection = True
+            self.send_error(413, "Decompressed body too large")
+        except compression.DecodeError as e:
+            metrics.ERRORS.inc("bad_request")
+            logger.error("Failed to decompress the request body: %s", e)
+            self.close_connection = True
+            self.send_error(400, "Bad compressed body")
+        except UnsupportedTransferEncoding as e:
+            metrics.ERRORS.inc("bad_request")
+            logger.error("Unsupported Transfer-Encoding: %s", e)
+            self.close_connection = True
+            self.send_error(501, "Unsupported Transfer-Encoding")
+        except HttpRequestError as e:
+            metrics.ERRORS.inc("bad_request")
+            logger.error("HTTPS request error: %s", e)
+            self.close_connection = True
+            self.send_error(400, "Bad request body")
+        except BudgetExceeded as e:
+            metrics.ERRORS.inc("budget")
+            logger.error("Byte budget exceeded: %s", e)
+            self.close_connection = True
+            if e.too_large:
+                self.send_error(413, "Message over the byte budget")
+            else:
+                self.send_response(503, "Byte budget exhausted")
+                self.send_header("Retry-After", self.byte_budget.options.retry_after)
+                self.send_header("Content-Length", 0)
+                self.send_header("Connection", "close")
+                self.end_headers()
         except Exception as e:
+            metrics.ERRORS.inc("connection")
             logger.error("HTTPS connection error: %s", e)
+        finally:
+            account.release()
+
+    def date_header(self):
+        return ("Date", datetime.now(timezone.utc).strftime("%a, %d %b %y %H:%M:%S %Z"))
+
+
+class AsyncHttpsHandler(AsyncStreamMixIn):
+    # Same as HttpsHandler, for the asyncio engine: one coroutine per HTTPS
+    # connection (with keep-alive), sending to MLLP over non-blocking sockets
+
+    def __init__(
+        self,
+        mllp_client,
+        content_type,
+        timeout,
+        keep_alive,
+        authentication,
+        mllp_response,
+        compression=None,
+        stream_threshold=None,
+        byte_budget=None,
+    ):
+        self.content_type = content_type
+        self.mllp_client = mllp_client
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self.mllp_response = mllp_response
+        self.compression = compression
+        self.stream_threshold = stream_threshold
+        self.byte_budget = byte_budget
+        # Expected Authorization header: from the username and password, or
+        # the HTTP_AUTHORIZATION environment variable
+        if isinstance(authentication, Authentication):
+            self.authorization = "Basic " + authentication.get_auth_key()
+        else:
+            self.authorization = authentication
 
+    async def __call__(self, reader, writer):
+        account = open_account(self.byte_budget)
+        try:
+            while True:
+                account.release()
+                request = await asyncio.wait_for(read_request(reader), self.timeout)
+                if request is None:
+                    break
+                if request.method == "GET" and metrics.is_metrics_path(request.target):
+                    # Metrics, with the same authentication as the messages
+                    if self.authorization is None or self.check_auth(writer, request):
+                        await metrics.write_metrics(writer, request)
+                    else:
+                        await writer.drain()
+                    if not request.keep_alive:
+                        break
+                    continue
+                if request.method != "POST":
+                    writer.write(
+                        response_head(
+                            501, [("Content-Length", 0), ("Connection", "close")]
+                        )
+                    )
+                    break
+
+                # Check authentication, before the body is read (or any of
+                # the budget taken): the connection is closed with the body
+                # left unread
+                if self.authorization is not None and not self.check_auth(
+                    writer, request, close=True
+                ):
+                    await writer.drain()
+                    break
+
+                length = request.length
+                if self.stream_threshold is not None and (
+                    length is None or self.stream_threshold <= length
+                ):
+                    if not await self.stream(reader, writer, request, length, account):
+                        break
+                    continue
 
-def serve(address, options, mllp_address, mllp_options):
+                # Process received data
+                start = time.perf_counter()
+                if length is not None:
+                    # A body over the budget is refused before it is read
+                    account.check(length)
+                data = await asyncio.wait_for(
+                    read_body(
+                        reader, writer, request, self.compression, take=account.take
+                    ),
+                    self.timeout,
+                )
+                metrics.BODY_READ.observe(time.perf_counter() - start)
+                metrics.MESSAGES.inc()
+                metrics.BYTES.inc("in", value=len(data))
+                logger.info("Message: %s bytes", len(data))
+                log_payload(logger, "Received Data", data)
 
-    # MLLP Client for dealing with the MLLP TCP connection
-    client = MllpClient(mllp_address, mllp_options)
+                # Send data to MLLP Listener and get MLLP ACK response
+                # (already without the Start Block and End Block):
+                start = time.perf_counter()
+                response = await self.mllp_client.send(data)
+                metrics.MLLP_ROUND_TRIP.observe(time.perf_counter() - start)
+                account.add(len(response))
+
+                # Prepare the MLLP response for the HTTPS body
+                start = time.perf_counter()
+                response = parse_mllp(response, self.mllp_response)
+                metrics.PARSE_MLLP.observe(time.perf_counter() - start)
 
+                # Prepare and send back ACK to HTTPS client
+                start = time.perf_counter()
+                body, encoding = compression.encode_response(
+                    response, request.headers.get("accept-encoding"), self.compression
+                )
+                headers = [("Content-Length", len(body))]
+                if self.content_type:
+                    headers.append(("Content-Type", self.content_type))
+                if encoding is not None:
+                    headers.append(("Content-Encoding", encoding))
+                if self.compression is not None:
+                    headers.append(("Vary", "Accept-Encoding"))
+                if self.keep_alive is not None:
+                    headers.append(("Keep-Alive", f"timeout={self.keep_alive}"))
+                now = datetime.now(timezone.utc)
+                headers.append(("Date", now.strftime("%a, %d %b %y %H:%M:%S %Z")))
+                if not request.keep_alive:
+                    headers.append(("Connection", "close"))
+                writer.write(response_head(200, headers, date=False))
+                writer.write(body)
+                await writer.drain()
+                metrics.RESPONSE_WRITE.observe(time.perf_counter() - start)
+                metrics.BYTES.inc("out", value=len(response))
+                logger.info("Response: %s bytes", len(response))
+                log_payload(logger, "Response Data", response)
+                if not request.keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except UnsupportedTransferEncoding as e:
+            metrics.ERRORS.inc("bad_request")
+            writer.write(
+                response_head(501, [("Content-Length", 0), ("Connection", "close")])
+            )
+            logger.error("Unsupported Transfer-Encoding: %s", e)
+        except HeadersTooLarge as e:
+            metrics.ERRORS.inc("bad_request")
+            writer.write(
+                response_head(431, [("Content-Length", 0), ("Connection", "close")])
+            )
+            logger.error("HTTPS request headers too large: %s", e)
+        except HttpRequestError as e:
+            metrics.ERRORS.inc("bad_request")
+            writer.write(
+                response_head(400, [("Content-Length", 0), ("Connection", "close")])
+            )
+            logger.error("HTTPS request error: %s", e)
+        except compression.UnsupportedEncoding as e:
+            metrics.ERRORS.inc("bad_request")
+            writer.write(
+                response_head(415, [("Content-Length", 0), ("Connection", "close")])
+            )
+            logger.error("Unsupported Content-Encoding: %s", e)
+        except compression.BodyTooLarge as e:
+            metrics.ERRORS.inc("bad_request")
+            writer.write(
+                response_head(413, [("Content-Length", 0), ("Connection", "close")])
+            )
+            logger.error("Decompressed request body too large: %s", e)
+        except compression.DecodeError as e:
+            metrics.ERRORS.inc("bad_request")
+            writer.write(
+                response_head(400, [("Content-Length", 0), ("Connection", "close")])
+            )
+            logger.error("Failed to decompress the request body: %s", e)
+        except PoolTimeout as e:
+            metrics.ERRORS.inc("pool_timeout")
+            writer.write(
+                response_head(503, [("Content-Length", 0), ("Connection", "close")])
+            )
+            logger.error("MLLP connection pool exhausted: %s", e)
+        except CircuitOpen as e:
+            metrics.ERRORS.inc("circuit_open")
+            writer.write(
+                response_head(
+                    503,
+                    [
+                        ("Retry-After", math.ceil(e.retry_after)),
+                        ("Content-Length", 0),
+                        ("Connection", "close"),
+                    ],
+                )
+            )
+            logger.error("Message not sent: %s", e)
+        except BudgetExceeded as e:
+            metrics.ERRORS.inc("budget")
+            if e.too_large:
+                writer.write(
+                    response_head(413, [("Content-Length", 0), ("Connection", "close")])
+                )
+            else:
+                writer.write(
+                    response_head(
+                        503,
+                        [
+                            ("Retry-After", self.byte_budget.options.retry_after),
+                            ("Content-Length", 0),
+                            ("Connection", "close"),
+                        ],
+                    )
+                )
+            logger.error("Byte budget exceeded: %s", e)
+        except Exception as e:
+            metrics.ERRORS.inc("connection")
+            logger.error("HTTPS connection error: %s", e)
+        finally:
+            account.release()
+            writer.close()
+
+    def date_header(self):
+        return ("Date", datetime.now(timezone.utc).strftime("%a, %d %b %y %H:%M:%S %Z"))
+
+    def check_auth(self, writer, request, close=False):
+        # Whether the request is authenticated, otherwise answered 401 (with
+        # Connection: close if close, or if it is not kept alive)
+        authorization = request.headers.get("authorization")
+        if authorization == self.authorization:
+            logger.info("Client Authenticated.")
+            return True
+        if authorization is None:
+            body = b"Authentication is required."
+            logger.info("Client did not authenticate.")
+        else:
+            body = b"Authentication failed: Wrong credentials."
+            logger.info("Client did not provide the correct credentials.")
+        metrics.ERRORS.inc("unauthorized")
+        headers = [
+            ("WWW-Authenticate", 'Basic realm="Test"'),
+            ("Content-type", "text/html"),
+            ("Content-Length", len(body)),
+        ]
+        if close or not request.keep_alive:
+            headers.append(("Connection", "close"))
+        writer.write(response_head(401, headers))
+        writer.write(body)
+        return False
+
+
+def server_authentication(options):
     # If authentication is enabled, set the auth
     if options.username and options.password:
         auth = Authentication(
@@ -243,15 +575,123 @@ def serve(address, options, mllp_address, mllp_options):
             password=options.password,
         )
         logger.info(
-            "Authentication on server side is enabled.\nUser: {}\nPassword: {}".format(options.username, "*"*len(options.password)))
+            "Authentication on server side is enabled.\nUser: {}\nPassword: {}".format(
+                options.username, "*" * len(options.password)
+            )
+        )
     elif os.environ.get("HTTP_AUTHORIZATION"):
         auth = os.environ["HTTP_AUTHORIZATION"]
         logger.info(
-            "Authentication on server side is enabled with Environment Variable HTTP_AUTHORIZATION.")
+            "Authentication on server side is enabled with Environment Variable HTTP_AUTHORIZATION."
+        )
     else:
         auth = None
-        logger.warning(
-            "Authentication on server side is disabled.")
+        logger.warning("Authentication on server side is disabled.")
+    return auth
+
+
+MODERN_CIPHERS = "ECDHE+AESGCM:ECDHE+CHACHA20"
+
+
+def server_ssl_context(options):
+    # >> Dealing with SSL/TLS on the HTTP server side
+    # For Python > 3.7
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(
+        certfile=options.certfile,
+        keyfile=options.keyfile,
+    )
+    # Session tickets, so that returning clients resume their TLS session
+    # instead of doing a full handshake
+    context.options &= ~ssl.OP_NO_TICKET
+    if options.ciphers == "modern":
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        context.set_ciphers(MODERN_CIPHERS)
+    elif options.ciphers:
+        context.set_ciphers(options.ciphers)
+    return context
+
+
+class TlsHTTPServer(
+    threadpool.HttpThreadPoolMixIn,
+    workers.ReusePortMixin,
+    http.server.ThreadingHTTPServer,
+):
+    # Accepts TCP connections only: the TLS handshake is done on the thread
+    # of each connection, so that a slow or stalled client does not hold up
+    # the accept loop
+
+    def __init__(self, address, handler, context, handshake_timeout=None, pool=None):
+        self.context = context
+        self.handshake_timeout = handshake_timeout
+        super().__init__(address, handler, pool=pool)
+
+    def get_request(self):
+        s, address = self.socket.accept()
+        try:
+            s = self.context.wrap_socket(
+                s, server_side=True, do_handshake_on_connect=False
+            )
+        except OSError:
+            s.close()
+            raise
+        return s, address
+
+    def handshake(self, request, client_address):
+        # Whether the TLS handshake succeeded
+        timeout = request.gettimeout()
+        request.settimeout(self.handshake_timeout)
+        try:
+            request.do_handshake()
+        except OSError as e:
+            logger.info(
+                "TLS handshake with %s:%s failed: %s",
+                client_address[0],
+                client_address[1],
+                e,
+            )
+            return False
+        request.settimeout(timeout)
+        return True
+
+    def finish_request(self, request, client_address):
+        if self.handshake(request, client_address):
+            super().finish_request(request, client_address)
+
+    def reject_request(self, request, reason):
+        # Connections shed by the accept loop are closed without a response,
+        # a TLS handshake there would hold up the other connections
+        if reason == "wait" and self.handshake(request, request.getpeername()):
+            super().reject_request(request, reason)
+
+
+def serve(address, options, mllp_address, mllp_options):
+    if 1 < options.workers and workers.worker_index() is None:
+        workers.supervise(
+            options.workers, serve, address, options, mllp_address, mllp_options
+        )
+        return
+
+    if options.engine == "asyncio":
+        try:
+            asyncio.run(serve_async(address, options, mllp_address, mllp_options))
+        except Exception as e:
+            logger.error("HTTPS connection error: %s", e)
+        return
+
+    # MLLP Client for dealing with the MLLP TCP connection
+    client = (PipelinedMllpClient if 1 < mllp_options.pipeline_depth else MllpClient)(
+        mllp_address, mllp_options
+    )
+    metrics.REGISTRY.register(metrics.PoolGauge("mllp_bridge_mllp_pool", client))
+    if mllp_options.breaker is not None:
+        client = BreakingMllpClient(client, mllp_breaker(mllp_address, mllp_options))
+    if mllp_options.ack_cache_size:
+        client = ReplayingMllpClient(
+            client, AckCache(mllp_options.ack_cache_size, mllp_options.ack_cache_ttl)
+        )
+
+    auth = server_authentication(options)
 
     # HTTP server handler
     handler = functools.partial(
@@ -261,32 +701,21 @@ def serve(address, options, mllp_address, mllp_options):
         timeout=options.timeout or None,
         mllp_client=client,
         authentication=auth,
-        mllp_parser=options.mllp_parser,
+        mllp_response=options.mllp_response,
+        compression=options.compression,
+        stream_threshold=stream_threshold(options, mllp_options),
+        byte_budget=open_budget(options.budget),
     )
 
-
     try:
-        server = http.server.ThreadingHTTPServer(address, handler)
-
-
         # >> Dealing with SSL/TLS on the HTTP server side
-        # For Python > 3.7
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS)
-        context.load_cert_chain(
-            certfile=options.certfile,
-            keyfile=options.keyfile,
-        )
-        server.socket = context.wrap_socket(
-            server.socket,
-            server_side=True,
+        server = TlsHTTPServer(
+            address,
+            handler,
+            context=server_ssl_context(options),
+            handshake_timeout=options.handshake_timeout,
+            pool=options.pool,
         )
-        # For Python < 3.2 SSLContext is not used, change it by ssl.wrap_socket:
-        # server.socket = ssl.wrap_socket(
-        #     server.socket,
-        #     server_side=True,
-        #     certfile="C:/ssl/certfile.crt",
-        #     keyfile="C:/ssl/keyfile.key",
-        # )
 
         logger.info("Listening on %s:%s", address[0], address[1])
         logger.info("Sending to %s:%s", mllp_address[0], mllp_address[1])
@@ -297,3 +726,52 @@ def serve(address, options, mllp_address, mllp_options):
 
     except Exception as e:
         logger.error("HTTPS connection error: %s", e)
+
+
+async def serve_async(address, options, mllp_address, mllp_options):
+    # MLLP Client for dealing with the MLLP TCP connections, without blocking
+    client = (
+        AsyncPipelinedMllpClient if 1 < mllp_options.pipeline_depth else AsyncMllpClient
+    )(mllp_address, mllp_options)
+    metrics.REGISTRY.register(metrics.PoolGauge("mllp_bridge_mllp_pool", client))
+    if mllp_options.breaker is not None:
+        client = AsyncBreakingMllpClient(
+            client, mllp_breaker(mllp_address, mllp_options)
+        )
+    if mllp_options.ack_cache_size:
+        client = AsyncReplayingMllpClient(
+            client, AckCache(mllp_options.ack_cache_size, mllp_options.ack_cache_ttl)
+        )
+
+    handler = AsyncHttpsHandler(
+        content_type=options.content_type,
+        keep_alive=options.keep_alive,
+        timeout=options.timeout or None,
+        mllp_client=client,
+        authentication=server_authentication(options),
+        mllp_response=options.mllp_response,
+        compression=options.compression,
+        stream_threshold=stream_threshold(options, mllp_options),
+        byte_budget=open_budget(options.budget),
+    )
+
+    server = await asyncio.start_server(
+        handler,
+        address[0],
+        address[1],
+        ssl=server_ssl_context(options),
+        # asyncio takes None for its default of 60s: unlimited is infinity
+        ssl_handshake_timeout=(
+            math.inf if options.handshake_timeout is None else options.handshake_timeout
+        ),
+        reuse_address=True,
+        reuse_port=workers.reuse_port(),
+        backlog=threadpool.listen_backlog(options.pool),
+    )
+    logger.info("Listening on %s:%s (asyncio)", address[0], address[1])
+    logger.info("Sending to %s:%s", mllp_address[0], mllp_address[1])
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await client.close()
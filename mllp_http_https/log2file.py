@@ -3,14 +3,142 @@
 ### Script to manage the logging
 
 
+import atexit
+import hashlib
 import logging
 import logging.handlers as handlers
+import queue
 from time import sleep
 from threading import Thread
 import os
 import sys
 import datetime
 
+from . import metrics
+
+LOG_FORMAT = "%(asctime)s [%(levelname)s] %(name)s %(message)s"
+
+# Records waiting for the background thread at most: past it, new records
+# are dropped (and counted) instead of holding their payloads in memory
+QUEUE_SIZE = 10000
+
+DROPPED = metrics.REGISTRY.register(
+    metrics.Counter(
+        "mllp_bridge_log_records_dropped_total",
+        "Log records dropped because the logging queue was full.",
+    )
+)
+
+
+_listener = None  # QueueListener of this process, once logging is started
+
+
+class DeferredQueueHandler(handlers.QueueHandler):
+    def prepare(self, record):
+        # Records stay in the process, so the message is formatted by the
+        # listener thread instead of the thread that logs it
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED.inc()
+
+
+class QueueListener(handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Waits for room in the queue, that may be full when stopping
+        self.queue.put(self._sentinel)
+
+
+def start_logging(handler, level):
+    # Records of all loggers are queued and written to the handler by a
+    # background thread, so that logging never blocks on I/O
+    handler.setFormatter(logging.Formatter(fmt=LOG_FORMAT))
+    records = queue.Queue(QUEUE_SIZE)
+    queue_handler = DeferredQueueHandler(records)
+    logger = logging.getLogger()
+    logger.setLevel(level)
+    logger.addHandler(queue_handler)
+    _start_listener(records, handler)
+    atexit.register(stop_logging)
+    if hasattr(os, "register_at_fork"):
+        # The listener thread does not survive a fork: a forked worker
+        # process gets its own queue and listener
+        os.register_at_fork(
+            after_in_child=lambda: _restart_logging(queue_handler, handler)
+        )
+    return _listener
+
+
+def _start_listener(records, handler):
+    global _listener
+    _listener = QueueListener(records, handler, respect_handler_level=True)
+    _listener.start()
+
+
+def _restart_logging(queue_handler, handler):
+    records = queue.Queue(QUEUE_SIZE)
+    queue_handler.queue = records
+    _start_listener(records, handler)
+
+
+def stop_logging():
+    # Writes the queued records and stops the background thread of this
+    # process, also for a process exiting with os._exit()
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+# How message payloads are logged: "off", "full", "sha256" or "truncated:N"
+_payload_logging = "full"
+_payload_truncate = None
+
+
+def payload_logging(mode):
+    # Validates a payload logging mode, for the command line
+    if mode in ("off", "full", "sha256"):
+        return mode
+    name, _, size = mode.partition(":")
+    if name == "truncated" and size.isdigit():
+        return mode
+    raise ValueError(mode)
+
+
+def set_payload_logging(mode):
+    global _payload_logging, _payload_truncate
+    mode = payload_logging(mode)
+    _payload_logging, _, size = mode.partition(":")
+    _payload_truncate = int(size) if size else None
+
+
+class Payload:
+    # Message payload in a log record, formatted only if the record is
+    # emitted, on the logging thread
+
+    def __init__(self, data, mode, size=None):
+        self.data = data
+        self.mode = mode
+        self.size = size
+
+    def __str__(self):
+        if self.mode == "sha256":
+            return "sha256:{} ({} bytes)".format(
+                hashlib.sha256(self.data).hexdigest(), len(self.data)
+            )
+        if self.mode == "truncated" and self.size < len(self.data):
+            return "{!r}... ({} bytes)".format(self.data[: self.size], len(self.data))
+        return repr(self.data)
+
+
+def log_payload(logger, label, data):
+    # Logs a message payload (bytes) according to the payload logging mode
+    if _payload_logging != "off":
+        logger.info("%s: %s", label, Payload(data, _payload_logging, _payload_truncate))
+
 
 # Generates and manages the logs files
 class Log2File:
@@ -29,29 +157,29 @@ class Log2File:
             return logging.INFO
 
     def new_log(self):
-        formatter = logging.Formatter(
-            fmt="%(asctime)s [%(levelname)s] %(name)s %(message)s"
-        )
         level = self.log_level(self.log_level_str)
 
-        logger = logging.getLogger()
-        logger.setLevel(level)
-
         filename = self.folder_path + "\\" + self.file_name
-        log_handler = handlers.TimedRotatingFileHandler(filename, when='D', interval=self.number_of_days_log)
-        log_handler.setFormatter(formatter)
+        log_handler = handlers.TimedRotatingFileHandler(
+            filename, when="D", interval=self.number_of_days_log
+        )
 
-        logger.addHandler(log_handler)
+        # Written from a background thread
+        return start_logging(log_handler, level)
 
 
 # Looks and deletes old
 class LogMonitor:
     def __init__(self, number_of_days_check, folder_path):
-        self.daemon = Thread(target=self.background_task, args=(number_of_days_check,), daemon=True, name='LogControl')
+        self.daemon = Thread(
+            target=self.background_task,
+            args=(number_of_days_check,),
+            daemon=True,
+            name="LogControl",
+        )
         self.folder_path = folder_path
         # >> Substituir a thread por um windows service? https://stackoverflow.com/questions/32404/how-do-you-run-a-python-script-as-a-service-in-windows
 
-
     # task that runs at a fixed interval
     def background_task(self, interval_days):
         interval_sec = interval_days * 24 * 60 * 60  # Days to sec
@@ -71,12 +199,14 @@ class LogMonitor:
                 sys.exit(2)
             today = datetime.datetime.now()
             for each_file in os.listdir(self.folder_path):
-                if each_file[len(each_file) - 4:len(each_file)] != ".log":
+                if each_file[len(each_file) - 4 : len(each_file)] != ".log":
                     each_file_path = os.path.join(self.folder_path, each_file)
                     if os.path.isfile(each_file_path):
-                        datetime_str = each_file[len(each_file) - 19:len(each_file)]
+                        datetime_str = each_file[len(each_file) - 19 : len(each_file)]
 
-                        file_cre_date = datetime.datetime.strptime(datetime_str, '%Y-%m-%d_%H-%M-%S')
+                        file_cre_date = datetime.datetime.strptime(
+                            datetime_str, "%Y-%m-%d_%H-%M-%S"
+                        )
                         # file_cre_date = datetime.datetime.fromtimestamp(os.path.getctime(each_file_path))
 
                         dif_days = (today - file_cre_date).days
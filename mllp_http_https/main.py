@@ -3,6 +3,9 @@ import datetime
 import logging
 import logging.handlers as handlers
 import urllib.parse
+from mllp_http_https.compression import ENCODINGS as COMPRESSION_ENCODINGS
+from mllp_http_https.log2file import payload_logging
+from mllp_http_https.spool import fsync_policy
 from mllp_http_https.version import __version__
 
 
@@ -25,6 +28,66 @@ def url_type(arg):
     return urllib.parse.urlparse(arg)
 
 
+def compression_options(args):
+    # CompressionOptions of the --http-compression arguments, or None if off
+    if args.http_compression == "off":
+        return None
+    import mllp_http_https.compression
+
+    return mllp_http_https.compression.CompressionOptions(
+        encoding=args.http_compression,
+        level=args.http_compression_level,
+        min_size=args.http_compression_min_size,
+        max_size=args.http_compression_max_size,
+    )
+
+
+def breaker_options(args):
+    # BreakerOptions of the --breaker arguments, or None without
+    # --breaker-failures or --breaker-error-rate
+    if args.breaker_failures is None and args.breaker_error_rate is None:
+        return None
+    import mllp_http_https.breaker
+
+    return mllp_http_https.breaker.BreakerOptions(
+        failures=args.breaker_failures,
+        error_rate=args.breaker_error_rate,
+        window=args.breaker_window,
+        open_interval=args.breaker_open_time / 1000,
+        probes=args.breaker_probes,
+        nack=getattr(args, "breaker_nack", None),
+    )
+
+
+def pool_options(args):
+    # PoolOptions of the --pool arguments, or None without --pool-threads
+    if not args.pool_threads:
+        return None
+    import mllp_http_https.threadpool
+
+    return mllp_http_https.threadpool.PoolOptions(
+        max_workers=args.pool_threads,
+        queue_size=args.pool_queue,
+        backlog=args.pool_backlog,
+        max_per_client=args.pool_max_per_client,
+        max_wait=args.pool_max_wait / 1000 if args.pool_max_wait else None,
+    )
+
+
+def budget_options(args):
+    # BudgetOptions of the --budget arguments, or None without --budget-bytes
+    if not args.budget_bytes:
+        return None
+    import mllp_http_https.budget
+
+    return mllp_http_https.budget.BudgetOptions(
+        max_bytes=args.budget_bytes,
+        connection_max_bytes=args.budget_connection_bytes,
+        nack=getattr(args, "budget_nack", None),
+        retry_after=getattr(args, "budget_retry_after", 1),
+    )
+
+
 def http2mllp():
     parser = argparse.ArgumentParser(
         "http2mllp",
@@ -53,15 +116,133 @@ def http2mllp():
         default=0,
         help="keep-alive in milliseconds, or unlimited if -1.",
     )
+    parser.add_argument(
+        "--engine",
+        default="threaded",
+        choices=("threaded", "asyncio"),
+        help="threaded: one thread per HTTP connection; asyncio: one event loop for all HTTP connections.",
+    )
+    parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="number of processes sharing the port (SO_REUSEPORT), each with its own MLLP connection pool; restarted if they exit.",
+    )
+    parser.add_argument(
+        "--pool-threads",
+        type=int,
+        help="handle connections with a pool of at most this many threads (threaded engine) instead of a thread per connection, queuing the others; off by default.",
+    )
+    parser.add_argument(
+        "--pool-queue",
+        default=128,
+        type=int,
+        help="with --pool-threads, connections waiting for a thread at most; past it, new connections are answered 503.",
+    )
+    parser.add_argument(
+        "--pool-backlog",
+        default=128,
+        type=int,
+        help="listen backlog of the socket, with --pool-threads (with the asyncio engine too).",
+    )
+    parser.add_argument(
+        "--pool-max-per-client",
+        type=int,
+        help="with --pool-threads, connections of one client IP address at most; past it, new connections are answered 503.",
+    )
+    parser.add_argument(
+        "--pool-max-wait",
+        type=float,
+        help="with --pool-threads, milliseconds a connection waits for a thread at most before being answered 503; unlimited by default.",
+    )
+    parser.add_argument(
+        "--http-compression",
+        default="off",
+        choices=("off",) + COMPRESSION_ENCODINGS,
+        help="encoding of large responses, for clients that accept it (Accept-Encoding); compressed requests (Content-Encoding) are accepted only when on, and refused with 415 otherwise.",
+    )
+    parser.add_argument(
+        "--http-compression-level",
+        default=6,
+        type=int,
+        help="compression level: 1 (fastest) to 9 (smallest), up to 22 for zstd.",
+    )
+    parser.add_argument(
+        "--http-compression-min-size",
+        default=1024,
+        type=int,
+        help="bodies smaller than this many bytes are not compressed.",
+    )
+    parser.add_argument(
+        "--http-compression-max-size",
+        default=64 * 1024 * 1024,
+        type=int,
+        help="compressed bodies received are decompressed to this many bytes at most; past it, requests are answered 413 (default: 64 MiB).",
+    )
+    parser.add_argument(
+        "--stream-threshold",
+        type=int,
+        help="stream requests of at least this many bytes (Content-Length), and all chunked requests (Transfer-Encoding), to MLLP as they are received, and the response back as it is received, instead of reading them whole; off by default.",
+    )
+    parser.add_argument(
+        "--budget-bytes",
+        type=int,
+        help="bytes of messages and responses held in memory by the process at most; past it, requests are answered 503 with Retry-After; unlimited by default.",
+    )
+    parser.add_argument(
+        "--budget-connection-bytes",
+        type=int,
+        help="bytes held in memory by one connection at most, with --budget-bytes; unlimited by default.",
+    )
+    parser.add_argument(
+        "--budget-retry-after",
+        default=1,
+        type=int,
+        help="seconds in the Retry-After header of the 503 responses past --budget-bytes.",
+    )
+    parser.add_argument(
+        "--breaker-failures",
+        type=int,
+        help="open the circuit breaker of the MLLP server after this many failed messages in a row: messages are then answered 503 at once instead of waiting for timeouts; off by default.",
+    )
+    parser.add_argument(
+        "--breaker-error-rate",
+        type=float,
+        help="open the circuit breaker when this ratio (0 to 1) of the last --breaker-window messages failed; off by default.",
+    )
+    parser.add_argument(
+        "--breaker-window",
+        default=20,
+        type=int,
+        help="messages over which --breaker-error-rate is computed.",
+    )
+    parser.add_argument(
+        "--breaker-open-time",
+        default=30000,
+        type=float,
+        help="milliseconds the circuit breaker stays open before probe messages are let through.",
+    )
+    parser.add_argument(
+        "--breaker-probes",
+        default=1,
+        type=int,
+        help="probe messages let through at the same time while half-open; the circuit closes when one succeeds.",
+    )
     parser.add_argument(
         "--log-level",
         choices=("error", "warn", "info"),
         default="info",
     )
+    parser.add_argument(
+        "--payload-logging",
+        default="full",
+        type=payload_logging,
+        help="how message payloads are logged: off, full, sha256 (digest and size) or truncated:N (first N bytes).",
+    )
     parser.add_argument(
         "--mllp-keep-alive",
         type=int,
-        default=10*1000,
+        default=10 * 1000,
         help="keep-alive in milliseconds, or unlimited if -1.",
     )
     parser.add_argument(
@@ -70,6 +251,65 @@ def http2mllp():
         default=-1,
         help="maximum number of messages per connection, or unlimited if -1.",
     )
+    parser.add_argument(
+        "--mllp-recv-size",
+        type=int,
+        default=64 * 1024,
+        help="size in bytes of each read of the MLLP response.",
+    )
+    parser.add_argument(
+        "--mllp-pool-min",
+        type=int,
+        default=0,
+        help="number of MLLP connections kept open even when idle.",
+    )
+    parser.add_argument(
+        "--mllp-pool-max",
+        type=int,
+        default=-1,
+        help="maximum number of open MLLP connections, or unlimited if -1.",
+    )
+    parser.add_argument(
+        "--mllp-pool-timeout",
+        type=int,
+        default=0,
+        help="milliseconds to wait for an MLLP connection when the pool is full, or unlimited if 0.",
+    )
+    parser.add_argument(
+        "--mllp-pool-stats-interval",
+        type=float,
+        default=0,
+        help="seconds between MLLP connection pool statistics log lines, or never if 0.",
+    )
+    parser.add_argument(
+        "--mllp-pipeline-depth",
+        type=int,
+        default=1,
+        help="messages in flight per MLLP connection: above 1, messages are sent without waiting for the previous response.",
+    )
+    parser.add_argument(
+        "--mllp-pipeline-match",
+        default="fifo",
+        choices=("fifo", "control-id"),
+        help="how pipelined MLLP responses are matched to messages: in order (fifo), or by MSA-2 to MSH-10 (control-id), in order for messages without MSH-10; a response matching no message fails the connection.",
+    )
+    parser.add_argument(
+        "--mllp-ack-cache-size",
+        type=int,
+        default=0,
+        help="number of accepted ACKs kept to answer retried messages (same MSH-3, MSH-4 and MSH-10) without sending them again, or no cache if 0.",
+    )
+    parser.add_argument(
+        "--mllp-ack-cache-ttl",
+        type=int,
+        default=300 * 1000,
+        help="milliseconds an ACK is kept for retried messages.",
+    )
+    parser.add_argument(
+        "--mllp-no-delay",
+        action="store_true",
+        help="set TCP_NODELAY on MLLP sockets, disabling Nagle's algorithm.",
+    )
     parser.add_argument(
         "--mllp-release",
         default="1",
@@ -87,13 +327,20 @@ def http2mllp():
         default="application/hl7-v2+er7; charset=utf-8",
         help="HTTP Content-Type header",
     )
+    parser.add_argument(
+        "--mllp-response",
+        default="strip-framing",
+        choices=("raw", "strip-framing", "crlf"),
+        help="how the MLLP response is used as HTTP body: as received, without the MLLP framing, or without the "
+        "framing and with CRLF segment terminators.",
+    )
     parser.add_argument(
         "-v", "--version", action="version", version="%(prog)s {}".format(__version__)
     )
     parser.add_argument(
         "mllp_url",
-        #type=url_type,
-        help="MLLP URL, Defaulf: hostname"
+        # type=url_type,
+        help="MLLP URL, Defaulf: hostname",
     )
     parser.add_argument(
         "--mllp_port",
@@ -106,20 +353,38 @@ def http2mllp():
 
     import mllp_http_https.http2mllp
 
-    logging.basicConfig(
-        format="%(asctime)s [%(levelname)s] %(name)s %(message)s",
-        level=log_level(args.log_level),
+    mllp_http_https.log2file.start_logging(
+        logging.StreamHandler(), log_level(args.log_level)
     )
+    mllp_http_https.log2file.set_payload_logging(args.payload_logging)
 
     http_server_options = mllp_http_https.http2mllp.HttpServerOptions(
         timeout=args.timeout / 1000,
         content_type=args.content_type,
         keep_alive=args.keep_alive,
+        mllp_response=args.mllp_response,
+        engine=args.engine,
+        workers=args.workers,
+        pool=pool_options(args),
+        compression=compression_options(args),
+        stream_threshold=args.stream_threshold,
+        budget=budget_options(args),
     )
     mllp_client_options = mllp_http_https.http2mllp.MllpClientOptions(
         keep_alive=args.mllp_keep_alive / 1000,
         max_messages=args.mllp_max_messages,
         timeout=args.timeout / 100,
+        recv_size=args.mllp_recv_size,
+        no_delay=args.mllp_no_delay,
+        pool_min=args.mllp_pool_min,
+        pool_max=args.mllp_pool_max,
+        pool_timeout=args.mllp_pool_timeout / 1000 or None,
+        stats_interval=args.mllp_pool_stats_interval,
+        pipeline_depth=args.mllp_pipeline_depth,
+        pipeline_match=args.mllp_pipeline_match,
+        ack_cache_size=args.mllp_ack_cache_size,
+        ack_cache_ttl=args.mllp_ack_cache_ttl / 1000,
+        breaker=breaker_options(args),
     )
 
     try:
@@ -136,7 +401,6 @@ def http2mllp():
         pass
 
 
-
 def mllp2http():
     parser = argparse.ArgumentParser(
         "mllp2http",
@@ -166,11 +430,204 @@ environment variables:
         default="application/hl7-v2+er7; charset=utf-8",
         help="HTTP Content-Type header",
     )
+    parser.add_argument(
+        "--engine",
+        default="threaded",
+        choices=("threaded", "asyncio"),
+        help="threaded: one thread per MLLP connection; asyncio: one event loop for all MLLP connections.",
+    )
+    parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="number of processes sharing the port (SO_REUSEPORT), each with its own HTTP connections and metrics port (--metrics-port + worker index); restarted if they exit.",
+    )
+    parser.add_argument(
+        "--pool-threads",
+        type=int,
+        help="handle connections with a pool of at most this many threads (threaded engine) instead of a thread per connection, queuing the others; off by default.",
+    )
+    parser.add_argument(
+        "--pool-queue",
+        default=128,
+        type=int,
+        help="with --pool-threads, connections waiting for a thread at most; past it, new connections are closed.",
+    )
+    parser.add_argument(
+        "--pool-backlog",
+        default=128,
+        type=int,
+        help="listen backlog of the socket, with --pool-threads (with the asyncio engine too).",
+    )
+    parser.add_argument(
+        "--pool-max-per-client",
+        type=int,
+        help="with --pool-threads, connections of one client IP address at most; past it, new connections are closed.",
+    )
+    parser.add_argument(
+        "--pool-max-wait",
+        type=float,
+        help="with --pool-threads, milliseconds a connection waits for a thread at most before being closed; unlimited by default.",
+    )
+    parser.add_argument(
+        "--http-compression",
+        default="off",
+        choices=("off",) + COMPRESSION_ENCODINGS,
+        help="encoding of large request bodies (Content-Encoding); the HTTP server has to accept it.",
+    )
+    parser.add_argument(
+        "--http-compression-level",
+        default=6,
+        type=int,
+        help="compression level: 1 (fastest) to 9 (smallest), up to 22 for zstd.",
+    )
+    parser.add_argument(
+        "--http-compression-min-size",
+        default=1024,
+        type=int,
+        help="bodies smaller than this many bytes are not compressed.",
+    )
+    parser.add_argument(
+        "--http-compression-max-size",
+        default=64 * 1024 * 1024,
+        type=int,
+        help="with --engine asyncio, compressed responses are decompressed to this many bytes at most; past it, the message fails (default: 64 MiB).",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        default=0,
+        type=int,
+        help="port for GET /metrics (Prometheus text format), or no metrics endpoint if 0.",
+    )
+    parser.add_argument(
+        "--queue-dir",
+        default=None,
+        help="directory of a store-and-forward queue: messages are acknowledged to the MLLP sender once stored, then delivered to the HTTP server in the background, with retries. Without it, the HTTP response is sent back.",
+    )
+    parser.add_argument(
+        "--queue-fsync",
+        default="always",
+        type=fsync_policy,
+        help="when queued messages are flushed to disk: always (before the ACK), never (by the OS), or every N milliseconds.",
+    )
+    parser.add_argument(
+        "--queue-workers",
+        default=4,
+        type=int,
+        help="number of queued messages delivered at the same time.",
+    )
+    parser.add_argument(
+        "--queue-segment-size",
+        default=64 * 1024 * 1024,
+        type=int,
+        help="bytes per queue file.",
+    )
+    parser.add_argument(
+        "--http-max-idle",
+        default=0,
+        type=float,
+        help="milliseconds before idle HTTP connections are closed, or never if 0.",
+    )
+    parser.add_argument(
+        "--http-pool-size",
+        default=10,
+        type=int,
+        help="maximum number of idle HTTP connections kept open, shared by all MLLP connections.",
+    )
+    parser.add_argument(
+        "--http-batch-size",
+        default=1,
+        type=int,
+        help="maximum number of messages, from all MLLP connections, sent in one HTTP request; each message is sent alone if 1.",
+    )
+    parser.add_argument(
+        "--http-batch-bytes",
+        default=1024 * 1024,
+        type=int,
+        help="maximum size in bytes of the messages of a batch.",
+    )
+    parser.add_argument(
+        "--http-batch-linger",
+        default=5,
+        type=float,
+        help="milliseconds the first message of a batch waits for others.",
+    )
+    parser.add_argument(
+        "--http-batch-format",
+        default="hl7",
+        choices=("hl7", "multipart"),
+        help="hl7: an HL7 batch (FHS/BHS ... BTS/FTS), answered with a batch of ACKs; multipart: multipart/mixed, answered with one part per ACK, in order.",
+    )
     parser.add_argument(
         "--log-level",
         choices=("error", "warn", "info"),
         default="info",
     )
+    parser.add_argument(
+        "--payload-logging",
+        default="full",
+        type=payload_logging,
+        help="how message payloads are logged: off, full, sha256 (digest and size) or truncated:N (first N bytes).",
+    )
+    parser.add_argument(
+        "--mllp-no-delay",
+        action="store_true",
+        help="set TCP_NODELAY on MLLP sockets, disabling Nagle's algorithm.",
+    )
+    parser.add_argument(
+        "--mllp-max-in-flight",
+        default=1,
+        type=int,
+        help="maximum number of messages of one MLLP connection sent to the HTTP server at the same time; responses are written back in order, and reading pauses at the limit.",
+    )
+    parser.add_argument(
+        "--budget-bytes",
+        type=int,
+        help="bytes of messages and responses held in memory by the process at most; past it, MLLP connections stop reading (or send NACKs, see --budget-nack); unlimited by default.",
+    )
+    parser.add_argument(
+        "--budget-connection-bytes",
+        type=int,
+        help="bytes held in memory by one connection at most, with --budget-bytes; unlimited by default.",
+    )
+    parser.add_argument(
+        "--budget-nack",
+        choices=("AE", "AR"),
+        help="answer messages over --budget-bytes with a NACK of this code instead of pausing reading.",
+    )
+    parser.add_argument(
+        "--breaker-failures",
+        type=int,
+        help="open the circuit breaker of the HTTP server after this many failed messages in a row: messages are then not sent (the MLLP connection is closed, or gets a NACK with --breaker-nack) at once instead of waiting for timeouts; off by default.",
+    )
+    parser.add_argument(
+        "--breaker-error-rate",
+        type=float,
+        help="open the circuit breaker when this ratio (0 to 1) of the last --breaker-window messages failed; off by default.",
+    )
+    parser.add_argument(
+        "--breaker-window",
+        default=20,
+        type=int,
+        help="messages over which --breaker-error-rate is computed.",
+    )
+    parser.add_argument(
+        "--breaker-open-time",
+        default=30000,
+        type=float,
+        help="milliseconds the circuit breaker stays open before probe messages are let through.",
+    )
+    parser.add_argument(
+        "--breaker-probes",
+        default=1,
+        type=int,
+        help="probe messages let through at the same time while half-open; the circuit closes when one succeeds.",
+    )
+    parser.add_argument(
+        "--breaker-nack",
+        choices=("AE", "AR"),
+        help="answer messages with a NACK of this code while the circuit breaker is open, instead of closing the MLLP connection.",
+    )
     parser.add_argument(
         "--mllp-release",
         default="1",
@@ -191,17 +648,50 @@ environment variables:
 
     import mllp_http_https.mllp2http
 
-    logging.basicConfig(
-        format="%(asctime)s [%(levelname)s] %(name)s %(message)s",
-        level=log_level(args.log_level),
+    mllp_http_https.log2file.start_logging(
+        logging.StreamHandler(), log_level(args.log_level)
     )
+    mllp_http_https.log2file.set_payload_logging(args.payload_logging)
+
+    batch_options = None
+    if 1 < args.http_batch_size:
+        import mllp_http_https.batch
 
+        batch_options = mllp_http_https.batch.BatchOptions(
+            max_count=args.http_batch_size,
+            max_bytes=args.http_batch_bytes,
+            linger=args.http_batch_linger / 1000,
+            format=args.http_batch_format,
+        )
     http_client_options = mllp_http_https.mllp2http.HttpClientOptions(
         content_type=args.content_type,
         timeout=args.timeout if args.timeout else None,
+        pool_size=args.http_pool_size,
+        max_idle=args.http_max_idle / 1000 if args.http_max_idle else None,
+        batch=batch_options,
+        compression=compression_options(args),
+        breaker=breaker_options(args),
     )
+    queue_options = None
+    if args.queue_dir:
+        import mllp_http_https.spool
+
+        queue_options = mllp_http_https.spool.SpoolOptions(
+            directory=args.queue_dir,
+            fsync=args.queue_fsync,
+            workers=args.queue_workers,
+            segment_size=args.queue_segment_size,
+        )
     mllp_server_options = mllp_http_https.mllp2http.MllpServerOptions(
-        timeout=args.timeout / 1000 if args.timeout else None
+        timeout=args.timeout / 1000 if args.timeout else None,
+        no_delay=args.mllp_no_delay,
+        engine=args.engine,
+        metrics_port=args.metrics_port or None,
+        workers=args.workers,
+        pool=pool_options(args),
+        queue=queue_options,
+        max_in_flight=args.mllp_max_in_flight,
+        budget=budget_options(args),
     )
 
     try:
@@ -256,13 +746,13 @@ environment variables:
         "--username",
         default=None,
         help="Username for HTTPS server authentication (Optional). If not provided, authentication will be skipped "
-             "unless the environment variable exists.",
+        "unless the environment variable exists.",
     )
     parser.add_argument(
         "--password",
         default=None,
         help="User password for HTTPS server authentication (Optional). If not provided, authentication will be "
-             "skipped unless the environment variable exists.",
+        "skipped unless the environment variable exists.",
     )
     parser.add_argument(
         "--keep-alive",
@@ -270,15 +760,133 @@ environment variables:
         default=0,
         help="keep-alive in milliseconds, or unlimited if -1.",
     )
+    parser.add_argument(
+        "--engine",
+        default="threaded",
+        choices=("threaded", "asyncio"),
+        help="Threaded: one thread per HTTPS connection; asyncio: one event loop for all HTTPS connections.",
+    )
+    parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="Number of processes sharing the port (SO_REUSEPORT), each with its own MLLP connection pool; restarted if they exit.",
+    )
+    parser.add_argument(
+        "--pool-threads",
+        type=int,
+        help="Handle connections with a pool of at most this many threads (threaded engine) instead of a thread per connection, queuing the others; off by default.",
+    )
+    parser.add_argument(
+        "--pool-queue",
+        default=128,
+        type=int,
+        help="With --pool-threads, connections waiting for a thread at most; past it, new connections are answered 503.",
+    )
+    parser.add_argument(
+        "--pool-backlog",
+        default=128,
+        type=int,
+        help="Listen backlog of the socket, with --pool-threads (with the asyncio engine too).",
+    )
+    parser.add_argument(
+        "--pool-max-per-client",
+        type=int,
+        help="With --pool-threads, connections of one client IP address at most; past it, new connections are answered 503.",
+    )
+    parser.add_argument(
+        "--pool-max-wait",
+        type=float,
+        help="With --pool-threads, milliseconds a connection waits for a thread at most before being answered 503; unlimited by default.",
+    )
+    parser.add_argument(
+        "--http-compression",
+        default="off",
+        choices=("off",) + COMPRESSION_ENCODINGS,
+        help="Encoding of large responses, for clients that accept it (Accept-Encoding); compressed requests (Content-Encoding) are accepted only when on, and refused with 415 otherwise.",
+    )
+    parser.add_argument(
+        "--http-compression-level",
+        default=6,
+        type=int,
+        help="Compression level: 1 (fastest) to 9 (smallest), up to 22 for zstd.",
+    )
+    parser.add_argument(
+        "--http-compression-min-size",
+        default=1024,
+        type=int,
+        help="Bodies smaller than this many bytes are not compressed.",
+    )
+    parser.add_argument(
+        "--http-compression-max-size",
+        default=64 * 1024 * 1024,
+        type=int,
+        help="Compressed bodies received are decompressed to this many bytes at most; past it, requests are answered 413 (default: 64 MiB).",
+    )
+    parser.add_argument(
+        "--stream-threshold",
+        type=int,
+        help="Stream requests of at least this many bytes (Content-Length), and all chunked requests (Transfer-Encoding), to MLLP as they are received, and the response back as it is received, instead of reading them whole; off by default.",
+    )
+    parser.add_argument(
+        "--budget-bytes",
+        type=int,
+        help="Bytes of messages and responses held in memory by the process at most; past it, requests are answered 503 with Retry-After; unlimited by default.",
+    )
+    parser.add_argument(
+        "--budget-connection-bytes",
+        type=int,
+        help="Bytes held in memory by one connection at most, with --budget-bytes; unlimited by default.",
+    )
+    parser.add_argument(
+        "--budget-retry-after",
+        default=1,
+        type=int,
+        help="Seconds in the Retry-After header of the 503 responses past --budget-bytes.",
+    )
+    parser.add_argument(
+        "--breaker-failures",
+        type=int,
+        help="Open the circuit breaker of the MLLP server after this many failed messages in a row: messages are then answered 503 at once instead of waiting for timeouts; off by default.",
+    )
+    parser.add_argument(
+        "--breaker-error-rate",
+        type=float,
+        help="Open the circuit breaker when this ratio (0 to 1) of the last --breaker-window messages failed; off by default.",
+    )
+    parser.add_argument(
+        "--breaker-window",
+        default=20,
+        type=int,
+        help="Messages over which --breaker-error-rate is computed.",
+    )
+    parser.add_argument(
+        "--breaker-open-time",
+        default=30000,
+        type=float,
+        help="Milliseconds the circuit breaker stays open before probe messages are let through.",
+    )
+    parser.add_argument(
+        "--breaker-probes",
+        default=1,
+        type=int,
+        help="Probe messages let through at the same time while half-open; the circuit closes when one succeeds.",
+    )
     parser.add_argument(
         "--log-level",
         choices=("error", "warn", "info"),
         default="info",
     )
+    parser.add_argument(
+        "--payload-logging",
+        default="full",
+        type=payload_logging,
+        help="how message payloads are logged: off, full, sha256 (digest and size) or truncated:N (first N bytes).",
+    )
     parser.add_argument(
         "--log-folder",
         default=None,
-        help="Path to folder where the logs will be placed. If not provided logging will be done on command window."
+        help="Path to folder where the logs will be placed. If not provided logging will be done on command window.",
     )
     parser.add_argument(
         "--mllp-keep-alive",
@@ -292,6 +900,65 @@ environment variables:
         default=-1,
         help="Maximum number of messages per connection, or unlimited if -1.",
     )
+    parser.add_argument(
+        "--mllp-recv-size",
+        type=int,
+        default=64 * 1024,
+        help="Size in bytes of each read of the MLLP response.",
+    )
+    parser.add_argument(
+        "--mllp-pool-min",
+        type=int,
+        default=0,
+        help="Number of MLLP connections kept open even when idle.",
+    )
+    parser.add_argument(
+        "--mllp-pool-max",
+        type=int,
+        default=-1,
+        help="Maximum number of open MLLP connections, or unlimited if -1.",
+    )
+    parser.add_argument(
+        "--mllp-pool-timeout",
+        type=int,
+        default=0,
+        help="Milliseconds to wait for an MLLP connection when the pool is full, or unlimited if 0.",
+    )
+    parser.add_argument(
+        "--mllp-pool-stats-interval",
+        type=float,
+        default=0,
+        help="Seconds between MLLP connection pool statistics log lines, or never if 0.",
+    )
+    parser.add_argument(
+        "--mllp-pipeline-depth",
+        type=int,
+        default=1,
+        help="Messages in flight per MLLP connection: above 1, messages are sent without waiting for the previous response.",
+    )
+    parser.add_argument(
+        "--mllp-pipeline-match",
+        default="fifo",
+        choices=("fifo", "control-id"),
+        help="How pipelined MLLP responses are matched to messages: in order (fifo), or by MSA-2 to MSH-10 (control-id), in order for messages without MSH-10; a response matching no message fails the connection.",
+    )
+    parser.add_argument(
+        "--mllp-ack-cache-size",
+        type=int,
+        default=0,
+        help="Number of accepted ACKs kept to answer retried messages (same MSH-3, MSH-4 and MSH-10) without sending them again, or no cache if 0.",
+    )
+    parser.add_argument(
+        "--mllp-ack-cache-ttl",
+        type=int,
+        default=300 * 1000,
+        help="Milliseconds an ACK is kept for retried messages.",
+    )
+    parser.add_argument(
+        "--mllp-no-delay",
+        action="store_true",
+        help="set TCP_NODELAY on MLLP sockets, disabling Nagle's algorithm.",
+    )
     parser.add_argument(
         "--mllp-release",
         default="1",
@@ -304,6 +971,18 @@ environment variables:
         type=float,
         help="socket timeout, in milliseconds, or unlimited if 0.",
     )
+    parser.add_argument(
+        "--tls-ciphers",
+        default=None,
+        help="TLS cipher suites: 'modern' for ECDHE with AES-GCM or ChaCha20 only (TLS 1.2 or later), or an "
+        "OpenSSL cipher list. OpenSSL defaults if not provided.",
+    )
+    parser.add_argument(
+        "--tls-handshake-timeout",
+        default=10000,
+        type=float,
+        help="time for a client to complete the TLS handshake, in milliseconds, or unlimited if 0.",
+    )
     parser.add_argument(
         "--content-type",
         default="application/hl7-v2; charset=utf-8",
@@ -312,7 +991,7 @@ environment variables:
     parser.add_argument(
         "mllp_url",
         # type=url_type,
-        help="MLLP URL, Defaulf: hostname"
+        help="MLLP URL, Defaulf: hostname",
     )
     parser.add_argument(
         "--certfile",
@@ -332,7 +1011,14 @@ environment variables:
         choices=("True", "False"),
         type=str,
         help="If False, the package will not parse the MLLP and will send an HTTPS POST with the MLLP encapsulating "
-             "the HL7 message. If True, the HTTPS POST will only present the HL7 on the Body without MLLP characters",
+        "the HL7 message. If True, the HTTPS POST will only present the HL7 on the Body without MLLP characters",
+    )
+    parser.add_argument(
+        "--mllp-response",
+        default=None,
+        choices=("raw", "strip-framing", "crlf"),
+        help="How the MLLP response is used as HTTPS body: as received, without the MLLP framing, or without the "
+        "framing and with CRLF segment terminators. If not provided, it follows --mllp_parser.",
     )
     parser.add_argument(
         "-v", "--version", action="version", version="%(prog)s {}".format(__version__)
@@ -345,6 +1031,7 @@ environment variables:
     # If log_folder is provided, logs will be written in file. Otherwise, will be written on console.
     if args.log_folder:
         import mllp_http_https.log2file
+
         log = mllp_http_https.log2file.Log2File(
             file_name="https2mllp.log",
             folder_path=args.log_folder,
@@ -361,10 +1048,10 @@ environment variables:
         log_monitor.start()
 
     else:
-        logging.basicConfig(
-            format="%(asctime)s [%(levelname)s] %(name)s %(message)s",
-            level=log_level(args.log_level),
+        mllp_http_https.log2file.start_logging(
+            logging.StreamHandler(), log_level(args.log_level)
         )
+    mllp_http_https.log2file.set_payload_logging(args.payload_logging)
 
     https_server_options = mllp_http_https.https2mllp.HttpsServerOptions(
         timeout=args.timeout / 1000,
@@ -374,12 +1061,34 @@ environment variables:
         keep_alive=args.keep_alive,
         username=args.username if args.username else None,
         password=args.password if args.password else None,
-        mllp_parser=True if args.mllp_parser == "True" else False
+        mllp_parser=True if args.mllp_parser == "True" else False,
+        mllp_response=args.mllp_response,
+        engine=args.engine,
+        ciphers=args.tls_ciphers,
+        handshake_timeout=(
+            args.tls_handshake_timeout / 1000 if args.tls_handshake_timeout else None
+        ),
+        workers=args.workers,
+        pool=pool_options(args),
+        compression=compression_options(args),
+        stream_threshold=args.stream_threshold,
+        budget=budget_options(args),
     )
     mllp_client_options = mllp_http_https.https2mllp.MllpClientOptions(
         keep_alive=args.mllp_keep_alive / 1000,
         max_messages=args.mllp_max_messages,
         timeout=args.timeout / 100,
+        recv_size=args.mllp_recv_size,
+        no_delay=args.mllp_no_delay,
+        pool_min=args.mllp_pool_min,
+        pool_max=args.mllp_pool_max,
+        pool_timeout=args.mllp_pool_timeout / 1000 or None,
+        stats_interval=args.mllp_pool_stats_interval,
+        pipeline_depth=args.mllp_pipeline_depth,
+        pipeline_match=args.mllp_pipeline_match,
+        ack_cache_size=args.mllp_ack_cache_size,
+        ack_cache_ttl=args.mllp_ack_cache_ttl / 1000,
+        breaker=breaker_options(args),
     )
 
     try:
@@ -408,11 +1117,7 @@ environment variables:
     X-API-KEY - HTTPS X-API-KEY header
         """,
     )
-    parser.add_argument(
-        "https_url",
-        help="HTTPS URL",
-        type=url_type
-    )
+    parser.add_argument("https_url", help="HTTPS URL", type=url_type)
     parser.add_argument(
         "-H",
         "--host",
@@ -430,28 +1135,221 @@ environment variables:
         "--username",
         default=None,
         help="Username for HTTPS server authentication (Optional). If not provided, authentication will be skipped "
-             "unless any of the environment variables exists.",
+        "unless any of the environment variables exists.",
     )
     parser.add_argument(
         "--password",
         default=None,
         help="User password for HTTPS server authentication (Optional). If not provided, authentication will be "
-             "skipped unless any of the environment variables exists.",
+        "skipped unless any of the environment variables exists.",
     )
     parser.add_argument(
         "--content-type",
         default="application/hl7-v2; charset=utf-8",
         help="HTTPS Content-Type header",
     )
+    parser.add_argument(
+        "--engine",
+        default="threaded",
+        choices=("threaded", "asyncio"),
+        help="Threaded: one thread per MLLP connection; asyncio: one event loop for all MLLP connections.",
+    )
+    parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="Number of processes sharing the port (SO_REUSEPORT), each with its own HTTPS connections and metrics port (--metrics-port + worker index); restarted if they exit.",
+    )
+    parser.add_argument(
+        "--pool-threads",
+        type=int,
+        help="Handle connections with a pool of at most this many threads (threaded engine) instead of a thread per connection, queuing the others; off by default.",
+    )
+    parser.add_argument(
+        "--pool-queue",
+        default=128,
+        type=int,
+        help="With --pool-threads, connections waiting for a thread at most; past it, new connections are closed.",
+    )
+    parser.add_argument(
+        "--pool-backlog",
+        default=128,
+        type=int,
+        help="Listen backlog of the socket, with --pool-threads (with the asyncio engine too).",
+    )
+    parser.add_argument(
+        "--pool-max-per-client",
+        type=int,
+        help="With --pool-threads, connections of one client IP address at most; past it, new connections are closed.",
+    )
+    parser.add_argument(
+        "--pool-max-wait",
+        type=float,
+        help="With --pool-threads, milliseconds a connection waits for a thread at most before being closed; unlimited by default.",
+    )
+    parser.add_argument(
+        "--http-compression",
+        default="off",
+        choices=("off",) + COMPRESSION_ENCODINGS,
+        help="Encoding of large request bodies (Content-Encoding); the HTTPS server has to accept it.",
+    )
+    parser.add_argument(
+        "--http-compression-level",
+        default=6,
+        type=int,
+        help="Compression level: 1 (fastest) to 9 (smallest), up to 22 for zstd.",
+    )
+    parser.add_argument(
+        "--http-compression-min-size",
+        default=1024,
+        type=int,
+        help="Bodies smaller than this many bytes are not compressed.",
+    )
+    parser.add_argument(
+        "--http-compression-max-size",
+        default=64 * 1024 * 1024,
+        type=int,
+        help="With --engine asyncio, compressed responses are decompressed to this many bytes at most; past it, the message fails (default: 64 MiB).",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        default=0,
+        type=int,
+        help="Port for GET /metrics (Prometheus text format), or no metrics endpoint if 0.",
+    )
+    parser.add_argument(
+        "--queue-dir",
+        default=None,
+        help="Directory of a store-and-forward queue: messages are acknowledged to the MLLP sender once stored, then delivered to the HTTPS server in the background, with retries. Without it, the HTTPS response is sent back.",
+    )
+    parser.add_argument(
+        "--queue-fsync",
+        default="always",
+        type=fsync_policy,
+        help="When queued messages are flushed to disk: always (before the ACK), never (by the OS), or every N milliseconds.",
+    )
+    parser.add_argument(
+        "--queue-workers",
+        default=4,
+        type=int,
+        help="Number of queued messages delivered at the same time.",
+    )
+    parser.add_argument(
+        "--queue-segment-size",
+        default=64 * 1024 * 1024,
+        type=int,
+        help="Bytes per queue file.",
+    )
+    parser.add_argument(
+        "--http-max-idle",
+        default=0,
+        type=float,
+        help="Milliseconds before idle HTTPS connections are closed, or never if 0.",
+    )
+    parser.add_argument(
+        "--http-pool-size",
+        default=10,
+        type=int,
+        help="Maximum number of idle HTTPS connections kept open, shared by all MLLP connections.",
+    )
+    parser.add_argument(
+        "--http-batch-size",
+        default=1,
+        type=int,
+        help="Maximum number of messages, from all MLLP connections, sent in one HTTPS request; each message is sent alone if 1.",
+    )
+    parser.add_argument(
+        "--http-batch-bytes",
+        default=1024 * 1024,
+        type=int,
+        help="Maximum size in bytes of the messages of a batch.",
+    )
+    parser.add_argument(
+        "--http-batch-linger",
+        default=5,
+        type=float,
+        help="Milliseconds the first message of a batch waits for others.",
+    )
+    parser.add_argument(
+        "--http-batch-format",
+        default="hl7",
+        choices=("hl7", "multipart"),
+        help="hl7: an HL7 batch (FHS/BHS ... BTS/FTS), answered with a batch of ACKs; multipart: multipart/mixed, answered with one part per ACK, in order.",
+    )
     parser.add_argument(
         "--log-level",
         choices=("error", "warn", "info"),
         default="info",
     )
+    parser.add_argument(
+        "--payload-logging",
+        default="full",
+        type=payload_logging,
+        help="How message payloads are logged: off, full, sha256 (digest and size) or truncated:N (first N bytes).",
+    )
     parser.add_argument(
         "--log-folder",
         default=None,
-        help="Path to folder where the logs will be placed. If not provided logging will be done on command window."
+        help="Path to folder where the logs will be placed. If not provided logging will be done on command window.",
+    )
+    parser.add_argument(
+        "--mllp-no-delay",
+        action="store_true",
+        help="set TCP_NODELAY on MLLP sockets, disabling Nagle's algorithm.",
+    )
+    parser.add_argument(
+        "--mllp-max-in-flight",
+        default=1,
+        type=int,
+        help="Maximum number of messages of one MLLP connection sent to the HTTPS server at the same time; responses are written back in order, and reading pauses at the limit.",
+    )
+    parser.add_argument(
+        "--budget-bytes",
+        type=int,
+        help="Bytes of messages and responses held in memory by the process at most; past it, MLLP connections stop reading (or send NACKs, see --budget-nack); unlimited by default.",
+    )
+    parser.add_argument(
+        "--budget-connection-bytes",
+        type=int,
+        help="Bytes held in memory by one connection at most, with --budget-bytes; unlimited by default.",
+    )
+    parser.add_argument(
+        "--budget-nack",
+        choices=("AE", "AR"),
+        help="Answer messages over --budget-bytes with a NACK of this code instead of pausing reading.",
+    )
+    parser.add_argument(
+        "--breaker-failures",
+        type=int,
+        help="Open the circuit breaker of the HTTPS server after this many failed messages in a row: messages are then not sent (the MLLP connection is closed, or gets a NACK with --breaker-nack) at once instead of waiting for timeouts; off by default.",
+    )
+    parser.add_argument(
+        "--breaker-error-rate",
+        type=float,
+        help="Open the circuit breaker when this ratio (0 to 1) of the last --breaker-window messages failed; off by default.",
+    )
+    parser.add_argument(
+        "--breaker-window",
+        default=20,
+        type=int,
+        help="Messages over which --breaker-error-rate is computed.",
+    )
+    parser.add_argument(
+        "--breaker-open-time",
+        default=30000,
+        type=float,
+        help="Milliseconds the circuit breaker stays open before probe messages are let through.",
+    )
+    parser.add_argument(
+        "--breaker-probes",
+        default=1,
+        type=int,
+        help="Probe messages let through at the same time while half-open; the circuit closes when one succeeds.",
+    )
+    parser.add_argument(
+        "--breaker-nack",
+        choices=("AE", "AR"),
+        help="Answer messages with a NACK of this code while the circuit breaker is open, instead of closing the MLLP connection.",
     )
     parser.add_argument(
         "--mllp-release",
@@ -470,7 +1368,7 @@ environment variables:
         default="True",
         type=str,
         help="Verify SSL certificate on server side. Should be set to 'True', 'False' or to a path to a CA_BUNDLE "
-             "file or directory with certificates of trusted Cas.",
+        "file or directory with certificates of trusted Cas.",
     )
     parser.add_argument(
         "-v", "--version", action="version", version="%(prog)s {}".format(__version__)
@@ -493,7 +1391,7 @@ environment variables:
         log.new_log()
 
         # Start additional thread to delete old logs
-        print('starting monitor')
+        print("starting monitor")
         log_monitor = mllp_http_https.log2file.LogMonitor(
             number_of_days_check=30,
             folder_path=args.log_folder,
@@ -506,20 +1404,53 @@ environment variables:
         #     level=log_level(args.log_level),
         # )
     else:
-        logging.basicConfig(
-            format="%(asctime)s [%(levelname)s] %(name)s %(message)s",
-            level=log_level(args.log_level),
+        mllp_http_https.log2file.start_logging(
+            logging.StreamHandler(), log_level(args.log_level)
         )
+    mllp_http_https.log2file.set_payload_logging(args.payload_logging)
 
+    batch_options = None
+    if 1 < args.http_batch_size:
+        import mllp_http_https.batch
+
+        batch_options = mllp_http_https.batch.BatchOptions(
+            max_count=args.http_batch_size,
+            max_bytes=args.http_batch_bytes,
+            linger=args.http_batch_linger / 1000,
+            format=args.http_batch_format,
+        )
     https_client_options = mllp_http_https.mllp2https.HttpsClientOptions(
         content_type=args.content_type,
         timeout=args.timeout if args.timeout else None,
         verify=args.verify,
         username=args.username if args.username else None,
         password=args.password if args.password else None,
+        pool_size=args.http_pool_size,
+        max_idle=args.http_max_idle / 1000 if args.http_max_idle else None,
+        batch=batch_options,
+        compression=compression_options(args),
+        breaker=breaker_options(args),
     )
+    queue_options = None
+    if args.queue_dir:
+        import mllp_http_https.spool
+
+        queue_options = mllp_http_https.spool.SpoolOptions(
+            directory=args.queue_dir,
+            fsync=args.queue_fsync,
+            workers=args.queue_workers,
+            segment_size=args.queue_segment_size,
+        )
     mllp_server_options = mllp_http_https.mllp2https.MllpServerOptions(
-        timeout=args.timeout / 1000 if args.timeout else None
+        timeout=args.timeout / 1000 if args.timeout else None,
+        no_delay=args.mllp_no_delay,
+        engine=args.engine,
+        metrics_port=args.metrics_port or None,
+        workers=args.workers,
+        pool=pool_options(args),
+        queue=queue_options,
+        max_in_flight=args.mllp_max_in_flight,
+        budget=budget_options(args),
     )
 
     try:
@@ -533,8 +1464,6 @@ environment variables:
         pass
 
 
-
-
 # For debugging reasons
-#mllp2https()
-#https2mllp()
\ No newline at end of file
+# mllp2https()
+# https2mllp()
@@ -0,0 +1,302 @@
+### Metrics of the bridges, in the Prometheus text format
+import bisect
+import http.server
+import logging
+import threading
+
+from .asynchttp import response_head
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from 100us to 10s
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return (
+        "{"
+        + ",".join(
+            '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+            for name, value in labels
+        )
+        + "}"
+    )
+
+
+class Histogram:
+    # Observations are counted per bucket under a lock held only for the
+    # two increments; cumulative counts are computed when rendered
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def render(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} histogram".format(self.name),
+        ]
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            lines.append(
+                '{}_bucket{{le="{}"}} {}'.format(
+                    self.name, format_value(bound), cumulative
+                )
+            )
+        lines.append("{}_sum {}".format(self.name, format_value(total)))
+        lines.append("{}_count {}".format(self.name, cumulative))
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.values = {} if self.label_names else {(): 0}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, value=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} counter".format(self.name),
+        ]
+        for labels, value in values:
+            lines.append(
+                "{}{} {}".format(
+                    self.name,
+                    format_labels(tuple(zip(self.label_names, labels))),
+                    format_value(value),
+                )
+            )
+        return lines
+
+
+class PoolGauge:
+    # Occupancy of an MLLP client pool, read from its snapshot() when rendered
+
+    GAUGES = ("size", "idle", "in_use", "in_flight", "waiting", "max")
+    COUNTERS = ("created", "closed", "acquired", "timeouts")
+    DESCRIPTION = "MLLP connection pool"
+
+    def __init__(self, name, client):
+        self.name = name
+        self.client = client
+
+    def render(self):
+        snapshot = self.client.snapshot()
+        lines = []
+        for key in self.GAUGES + self.COUNTERS:
+            if key not in snapshot:
+                continue
+            kind = "gauge" if key in self.GAUGES else "counter"
+            name = "{}_{}{}".format(
+                self.name, key, "_total" if kind == "counter" else ""
+            )
+            lines.append(
+                "# HELP {} {}: {}.".format(
+                    name, self.DESCRIPTION, key.replace("_", " ")
+                )
+            )
+            lines.append("# TYPE {} {}".format(name, kind))
+            lines.append("{} {}".format(name, format_value(snapshot[key])))
+        return lines
+
+
+class SpoolGauge(PoolGauge):
+    # Depth and throughput of the store-and-forward queue (spool.Spool)
+
+    GAUGES = ("pending", "in_flight", "bytes")
+    COUNTERS = ("appended", "delivered", "retries", "rejected")
+    DESCRIPTION = "Store-and-forward queue"
+
+
+class BudgetGauge(PoolGauge):
+    # Bytes of message data held in memory (budget.ByteBudget)
+
+    GAUGES = ("used", "max", "peak")
+    COUNTERS = ("rejected", "waits")
+    DESCRIPTION = "Byte budget"
+
+
+class BreakerGauge(PoolGauge):
+    # State (0 closed, 1 half-open, 2 open) and transitions of a circuit
+    # breaker (breaker.CircuitBreaker)
+
+    GAUGES = ("state",)
+    COUNTERS = ("opened", "half_opened", "closed", "rejected", "failures")
+    DESCRIPTION = "Circuit breaker"
+
+
+class ThreadPoolGauge(PoolGauge):
+    # Threads and queued connections of a threaded server
+    # (threadpool.WorkerPool)
+
+    GAUGES = ("threads", "idle", "busy", "queued", "max")
+    COUNTERS = ("accepted", "rejected")
+    DESCRIPTION = "Thread pool"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def unregister(self, metric):
+        with self.lock:
+            self.metrics.remove(metric)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+REGISTRY = Registry()
+
+BODY_READ = REGISTRY.register(
+    Histogram("mllp_bridge_body_read_seconds", "Time to read the HTTP request body.")
+)
+MLLP_ROUND_TRIP = REGISTRY.register(
+    Histogram(
+        "mllp_bridge_mllp_round_trip_seconds",
+        "Time to send a message to the MLLP server and receive its response.",
+    )
+)
+PARSE_MLLP = REGISTRY.register(
+    Histogram(
+        "mllp_bridge_parse_mllp_seconds",
+        "Time to prepare the MLLP response for the HTTP body.",
+    )
+)
+RESPONSE_WRITE = REGISTRY.register(
+    Histogram(
+        "mllp_bridge_response_write_seconds",
+        "Time to write the response to the client.",
+    )
+)
+HTTP_POST = REGISTRY.register(
+    Histogram("mllp_bridge_http_post_seconds", "Time of the POST to the HTTP server.")
+)
+MESSAGES = REGISTRY.register(
+    Counter("mllp_bridge_messages_total", "Messages received.")
+)
+BYTES = REGISTRY.register(
+    Counter(
+        "mllp_bridge_bytes_total",
+        "Payload bytes received (in) and sent back (out).",
+        ("direction",),
+    )
+)
+ERRORS = REGISTRY.register(
+    Counter("mllp_bridge_errors_total", "Failed messages, by kind of error.", ("kind",))
+)
+ACK_CACHE = REGISTRY.register(
+    Counter(
+        "mllp_bridge_ack_cache_total",
+        "ACK replay cache: hits, misses, duplicates coalesced, and entries evicted or expired.",
+        ("event",),
+    )
+)
+
+
+def is_metrics_path(path):
+    return path.partition("?")[0] == "/metrics"
+
+
+class MetricsMixin:
+    # GET /metrics for a BaseHTTPRequestHandler
+    registry = REGISTRY
+
+    def do_GET(self):
+        if not is_metrics_path(self.path):
+            self.send_error(404)
+            return
+        body = self.registry.render()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+async def write_metrics(writer, request):
+    # GET /metrics for the asyncio engine
+    body = REGISTRY.render()
+    headers = [("Content-Length", len(body)), ("Content-Type", CONTENT_TYPE)]
+    if not request.keep_alive:
+        headers.append(("Connection", "close"))
+    writer.write(response_head(200, headers))
+    writer.write(body)
+    await writer.drain()
+
+
+class MetricsHandler(MetricsMixin, http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(address):
+    # /metrics on a side port, served from a daemon thread
+    server = http.server.ThreadingHTTPServer(address, MetricsHandler)
+    thread = threading.Thread(
+        target=server.serve_forever, daemon=True, name="MetricsServer"
+    )
+    thread.start()
+    logger.info("Metrics on %s:%s/metrics", address[0], address[1])
+    return server
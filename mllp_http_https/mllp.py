@@ -1,6 +1,8 @@
 import functools
 import logging
 
+logger = logging.getLogger("mllp.parse")
+
 
 class Format:
     START_BLOCK = 0x0B
@@ -8,6 +10,10 @@ class Format:
     CARRIAGE_RETURN = 0x0D
 
 
+START_BLOCK = bytes([Format.START_BLOCK])
+END_BLOCK = bytes([Format.END_BLOCK, Format.CARRIAGE_RETURN])
+
+
 class State:
     AFTER_BLOCK = 0
     BEFORE_BLOCK = 1
@@ -18,9 +24,137 @@ def to_hex(byte):
     return "EOF" if byte is None else hex(byte)
 
 
-def read_mllp(it):
-    logger = logging.getLogger("mllp.parse")
+class MllpError(Exception):
+    pass
+
+
+class MllpDecoder:
+    # Incremental MLLP decoder: feed it data as it arrives from the socket
+    # (in chunks of any size) and take the complete frames out.
+    # Delimiters are located with bytes.find instead of a per-byte loop, and
+    # a partial frame is kept until the rest of it arrives.
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._offset = 0  # stream position of self._buffer[0]
+        self._scan = 0  # buffer index where the search for END_BLOCK resumes
+        self._state = State.BEFORE_BLOCK
+
+    def feed(self, data):
+        self._buffer += data
+
+    def next_frame(self):
+        # Returns the next complete frame, or None if more data is needed.
+        # Raises MllpError on malformed input.
+        buffer = self._buffer
+        while True:
+            if self._state == State.AFTER_BLOCK:
+                if not buffer:
+                    return None
+                if buffer[0] != Format.CARRIAGE_RETURN:
+                    self._fail(Format.CARRIAGE_RETURN, buffer[0], 0)
+                self._consume(1)
+                self._state = State.BEFORE_BLOCK
+            elif self._state == State.BEFORE_BLOCK:
+                if not buffer:
+                    return None
+                if buffer[0] != Format.START_BLOCK:
+                    self._fail(Format.START_BLOCK, buffer[0], 0)
+                self._scan = 1
+                self._state = State.BLOCK
+            else:
+                end = buffer.find(Format.END_BLOCK, self._scan)
+                start = buffer.find(
+                    Format.START_BLOCK, self._scan, len(buffer) if end < 0 else end
+                )
+                if 0 <= start:
+                    raise MllpError(
+                        "Expected content instead of %s (byte:%s)"
+                        % (to_hex(Format.START_BLOCK), self._offset + start)
+                    )
+                if end < 0:
+                    self._scan = len(buffer)
+                    return None
+                with memoryview(buffer) as view:
+                    frame = bytes(view[1:end])
+                self._consume(end + 1)
+                self._state = State.AFTER_BLOCK
+                return frame
+
+    def next_part(self):
+        # Same as next_frame, but returns the payload of a frame in parts, as
+        # it arrives, so that a large frame is never kept whole: (part, False)
+        # while the frame continues, (part, True) for its last part, or None
+        # if more data is needed. The Start Block stays at buffer[0] while
+        # the payload after it is taken out, as expected by next_frame.
+        buffer = self._buffer
+        while self._state != State.BLOCK:
+            if not buffer:
+                return None
+            if self._state == State.AFTER_BLOCK:
+                if buffer[0] != Format.CARRIAGE_RETURN:
+                    self._fail(Format.CARRIAGE_RETURN, buffer[0], 0)
+                self._consume(1)
+                self._state = State.BEFORE_BLOCK
+            else:
+                if buffer[0] != Format.START_BLOCK:
+                    self._fail(Format.START_BLOCK, buffer[0], 0)
+                self._scan = 1
+                self._state = State.BLOCK
+        end = buffer.find(Format.END_BLOCK, self._scan)
+        start = buffer.find(
+            Format.START_BLOCK, self._scan, len(buffer) if end < 0 else end
+        )
+        if 0 <= start:
+            raise MllpError(
+                "Expected content instead of %s (byte:%s)"
+                % (to_hex(Format.START_BLOCK), self._offset + start)
+            )
+        if 0 <= end:
+            with memoryview(buffer) as view:
+                part = bytes(view[1:end])
+            self._consume(end + 1)
+            self._state = State.AFTER_BLOCK
+            return part, True
+        if len(buffer) <= 1:
+            return None
+        with memoryview(buffer) as view:
+            part = bytes(view[1:])
+        del buffer[1:]
+        self._offset += len(part)
+        self._scan = 1
+        return part, False
 
+    def close(self):
+        # Signals the end of the stream. Raises MllpError if it ends in the
+        # middle of a frame.
+        if self._state == State.BLOCK:
+            raise MllpError(
+                "Expected %s instead of %s (byte:%s)"
+                % (
+                    to_hex(Format.END_BLOCK),
+                    to_hex(None),
+                    self._offset + len(self._buffer),
+                )
+            )
+        if self._state == State.AFTER_BLOCK:
+            raise MllpError(
+                "Expected %s instead of %s (byte:%s)"
+                % (to_hex(Format.CARRIAGE_RETURN), to_hex(None), self._offset)
+            )
+
+    def _consume(self, count):
+        del self._buffer[:count]
+        self._offset += count
+
+    def _fail(self, expected, byte, index):
+        raise MllpError(
+            "Expected %s instead of %s (byte:%s)"
+            % (to_hex(expected), to_hex(byte), self._offset + index)
+        )
+
+
+def read_mllp(it):
     content = None
     state = State.BEFORE_BLOCK
     byte = None
@@ -65,7 +199,6 @@ def read_mllp(it):
             if byte == Format.START_BLOCK:
                 logger.error(
                     "Expected content instead of %s (byte:%s)",
-                    to_hex(Format.CARRIAGE_RETURN),
                     to_hex(byte),
                     i,
                 )
@@ -80,46 +213,202 @@ def read_mllp(it):
                 advance()
 
 
-def parse_mllp(mllp_data):
-    hl7_text = mllp_data.decode("utf-8")
-    hl7_text = hl7_text.replace('\x0b', '')
-    hl7_text = hl7_text.replace('\x1c\r', '')
-    if not hl7_text.find("\r\n"):
-        hl7_text = hl7_text.replace('\r', '\r\n')
-    # if hl7_text.find("\x0d"):
-    #     hl7_text = hl7_text.replace('\x0d', '\r\n')
-    mllp_data = bytes(hl7_text, 'utf-8')
-    return mllp_data
+def read_mllp_chunks(chunks):
+    # Same as read_mllp, but consumes an iterable of byte chunks (e.g. from
+    # net.read_socket_chunks) instead of single bytes.
+    decoder = MllpDecoder()
+    try:
+        for chunk in chunks:
+            decoder.feed(chunk)
+            frame = decoder.next_frame()
+            while frame is not None:
+                yield frame
+                frame = decoder.next_frame()
+        decoder.close()
+    except MllpError as e:
+        logger.error("%s", e)
+
+
+async def read_mllp_async(chunks):
+    # Same as read_mllp_chunks, for an asynchronous iterable of byte chunks
+    # (e.g. from net.read_stream_chunks)
+    decoder = MllpDecoder()
+    try:
+        async for chunk in chunks:
+            decoder.feed(chunk)
+            frame = decoder.next_frame()
+            while frame is not None:
+                yield frame
+                frame = decoder.next_frame()
+        decoder.close()
+    except MllpError as e:
+        logger.error("%s", e)
+
+
+class ParseMode:
+    RAW = "raw"
+    STRIP_FRAMING = "strip-framing"
+    CRLF = "crlf"
+
+    ALL = (RAW, STRIP_FRAMING, CRLF)
+
+
+def parse_mllp(mllp_data, mode=ParseMode.CRLF):
+    # Prepares an MLLP response to be used as an HTTP body. mllp_data may be
+    # the whole frame or just its payload (as returned by MllpReader).
+    #   > raw: the message with its MLLP framing
+    #   > strip-framing: the message without Start Block and End Block
+    #   > crlf: as strip-framing, with segments terminated by CRLF
+    # Works on bytes, so the message is never decoded and is copied at most
+    # once per step actually needed.
+    if mode == ParseMode.RAW:
+        if mllp_data[:1] == START_BLOCK:
+            return bytes(mllp_data)
+        return frame_mllp(mllp_data)
+
+    start = 1 if mllp_data[:1] == START_BLOCK else 0
+    end = len(mllp_data)
+    if mllp_data[end - 2 :] == END_BLOCK:
+        end -= 2
+    elif mllp_data[end - 1 :] == END_BLOCK[:1]:
+        end -= 1
+    if start == 0 and end == len(mllp_data) and type(mllp_data) is bytes:
+        hl7_data = mllp_data
+    else:
+        with memoryview(mllp_data) as view:
+            hl7_data = bytes(view[start:end])
+
+    if mode == ParseMode.CRLF and b"\r" in hl7_data:
+        if b"\r\n" in hl7_data:
+            hl7_data = hl7_data.replace(b"\r\n", b"\r")
+        hl7_data = hl7_data.replace(b"\r", b"\r\n")
+    return hl7_data
+
+
+class PartParser:
+    # Same as parse_mllp, for the payload of a frame received in parts (as
+    # yielded by MllpReader.read_parts): the HTTP body is head(), then
+    # parse(part) of each part in order, then tail(), as yielded by body().
+    # Any of them may be empty.
+
+    def __init__(self, mode=ParseMode.CRLF):
+        self.mode = mode
+        self.pending = b""  # CR at the end of a part, maybe followed by LF
+
+    def head(self):
+        return START_BLOCK if self.mode == ParseMode.RAW else b""
+
+    def parse(self, part):
+        if self.mode != ParseMode.CRLF:
+            return part
+        if self.pending:
+            part = self.pending + part
+            self.pending = b""
+        if part.endswith(b"\r"):
+            part, self.pending = part[:-1], b"\r"
+        if b"\r" in part:
+            if b"\r\n" in part:
+                part = part.replace(b"\r\n", b"\r")
+            part = part.replace(b"\r", b"\r\n")
+        return part
+
+    def tail(self):
+        if self.mode == ParseMode.RAW:
+            return END_BLOCK
+        return b"\r\n" if self.pending else b""
+
+    def body(self, parts):
+        # All the parts of the HTTP body, for an iterable of payload parts
+        yield self.head()
+        for part in parts:
+            yield self.parse(part)
+        yield self.tail()
+
+
+def frame_mllp(content):
+    return b"".join((START_BLOCK, content, END_BLOCK))
 
 
 def write_mllp(wfile, content):
-    wfile.write(bytes([Format.START_BLOCK]))
-    wfile.write(content)
-    wfile.write(bytes([Format.END_BLOCK, Format.CARRIAGE_RETURN]))
-    # wfile.sendall(bytes([Format.START_BLOCK]))
-    # wfile.sendall(content)
-    # wfile.sendall(bytes([Format.END_BLOCK, Format.CARRIAGE_RETURN]))
+    wfile.write(frame_mllp(content))
+
+
+def sendall_mllp(socket, content):
+    # Sends the whole frame with a single scatter-gather sendmsg, so the
+    # framing is not sent in separate segments (Nagle / delayed ACK stalls).
+    # Falls back to one sendall of the joined frame where sendmsg is not
+    # available (Windows, SSL sockets).
+    buffers = [START_BLOCK, memoryview(content), END_BLOCK]
+    try:
+        sent = socket.sendmsg(buffers)
+    except (AttributeError, NotImplementedError):
+        socket.sendall(frame_mllp(content))
+        return
+    while True:
+        while buffers and len(buffers[0]) <= sent:
+            sent -= len(buffers.pop(0))
+        if not buffers:
+            return
+        if sent:
+            buffers[0] = memoryview(buffers[0])[sent:]
+        sent = socket.sendmsg(buffers)
+
+
+class MllpReader:
+    # Reads MLLP frames from a connected socket in large chunks. Only newly
+    # received bytes are scanned, and anything received after the end of a
+    # frame is kept for the next read, so a pooled connection stays in sync.
+
+    def __init__(self, socket, recv_size=64 * 1024):
+        self.socket = socket
+        self.recv_size = recv_size
+        self.decoder = MllpDecoder()
+
+    def read(self):
+        # Returns the payload of the next frame, without the MLLP framing
+        frame = self.decoder.next_frame()
+        while frame is None:
+            data = self.socket.recv(self.recv_size)
+            if not data:
+                self.decoder.close()
+                raise MllpError("Connection closed by MLLP peer")
+            self.decoder.feed(data)
+            frame = self.decoder.next_frame()
+        return frame
+
+    def read_parts(self):
+        # Same as read, but yields the payload in parts as it is received
+        # (at most recv_size bytes each, plus what a previous read left)
+        while True:
+            part = self.decoder.next_part()
+            if part is None:
+                data = self.socket.recv(self.recv_size)
+                if not data:
+                    self.decoder.close()
+                    raise MllpError("Connection closed by MLLP peer")
+                self.decoder.feed(data)
+                continue
+            data, end = part
+            if data:
+                yield data
+            if end:
+                return
 
 
-def send_mllp(socket, content):
+def sendall_mllp_parts(socket, parts):
+    # Sends one frame whose content is given in parts (an iterable of
+    # bytes), each part as soon as it is available
+    socket.sendall(START_BLOCK)
+    for part in parts:
+        socket.sendall(part)
+    socket.sendall(END_BLOCK)
+
+
+def send_mllp(socket, content, reader=None):
     # Send all data on MLLP
-    socket.sendall(bytes([Format.START_BLOCK]))
-    socket.sendall(content)
-    socket.sendall(bytes([Format.END_BLOCK, Format.CARRIAGE_RETURN]))
+    sendall_mllp(socket, content)
 
     # Wait for the ACK/NACK
-    response = bytearray()
-    end_block = bytes([Format.END_BLOCK])
-    while True:
-        if end_block in response:
-            # print('finished', bytes(response))
-            break
-        else:
-            packet = socket.recv(1024)
-            if not packet:
-                break
-            else:
-                response.extend(packet)
-                # print(bytes(response))
-    return bytes(response)
-
+    if reader is None:
+        reader = MllpReader(socket)
+    return reader.read()
@@ -1,13 +1,23 @@
+import asyncio
 import functools
 import logging
 import os
 import requests
 import socket
 import socketserver
+import time
 import urllib
-from .mllp import read_mllp, write_mllp
-from .net import read_socket_bytes
+from . import compression, hl7, metrics, spool, threadpool, workers
+from .batch import AsyncBatcher, Batcher
+from .asynchttp import AsyncHttpClient, HttpStatusError
+from .log2file import log_payload
+from .mllp import frame_mllp, read_mllp_async, read_mllp_chunks, sendall_mllp
+from .net import read_socket_chunks, read_stream_chunks, set_no_delay
+from .session import shared_session
 from .version import __version__
+from .breaker import CircuitOpen, guard, http_failure, open_breaker
+from .budget import BudgetExceeded, admit, admit_async, open_account, open_budget
+from .window import AsyncWindow, Window
 
 logger = logging.getLogger(__name__)
 
@@ -16,92 +26,553 @@ def display_address(address):
     return f"{address[0]}:{address[1]}"
 
 
+def http_headers(local_address, remote_address, http_options):
+    headers = {
+        "Forwarded": f"by={display_address(local_address)};for={display_address(remote_address)};proto=mllp",
+        "User-Agent": f"mllp2http/{__version__}",
+        "X-Forwarded-For": display_address(remote_address),
+        "X-Forwarded-Proto": "mllp",
+    }
+
+    if os.environ.get("HTTP_AUTHORIZATION"):
+        headers["Authorization"] = os.environ["HTTP_AUTHORIZATION"]
+    if os.environ.get("API_KEY"):
+        headers["X-API-KEY"] = os.environ["API_KEY"]
+
+    if http_options.content_type is not None:
+        headers["Content-Type"] = http_options.content_type
+    return headers
+
+
+def http_post(session, http_url, http_options, data, headers):
+    data, headers = compression.encode_request(data, headers, http_options.compression)
+    start = time.perf_counter()
+    response = session.post(
+        urllib.parse.urlunparse(http_url),
+        data=data,
+        headers=headers,
+        timeout=http_options.timeout,
+    )
+    metrics.HTTP_POST.observe(time.perf_counter() - start)
+    response.raise_for_status()
+    return response
+
+
+async def http_post_async(http_client, http_options, data, headers):
+    if http_options.compression is not None:
+        data, headers = compression.encode_request(
+            data, headers, http_options.compression
+        )
+        headers["Accept-Encoding"] = ", ".join(compression.ENCODINGS)
+    start = time.perf_counter()
+    response = await http_client.post(data, headers)
+    metrics.HTTP_POST.observe(time.perf_counter() - start)
+    if "content-encoding" in response.headers:
+        options = http_options.compression or compression.CompressionOptions()
+        response.content = compression.decompress(
+            response.content, response.headers["content-encoding"], options.max_size
+        )
+    response.raise_for_status()
+    return response
+
+
 class MllpServerOptions:
-    def __init__(self, timeout):
+    def __init__(
+        self,
+        timeout,
+        no_delay=False,
+        engine="threaded",
+        metrics_port=None,
+        workers=1,
+        queue=None,
+        max_in_flight=1,
+        budget=None,
+        pool=None,
+    ):
         self.timeout = timeout
+        self.no_delay = no_delay
+        self.engine = engine
+        # Port for GET /metrics, or no metrics endpoint if None
+        self.metrics_port = metrics_port
+        # Processes sharing the port, each with its own connections. Each
+        # worker serves its metrics on metrics_port + its index.
+        self.workers = workers
+        # spool.SpoolOptions to acknowledge messages once stored on disk and
+        # deliver them in the background, or None to wait for the HTTP server
+        self.queue = queue
+        # Messages of one MLLP connection sent to the HTTP server at the same
+        # time; the next messages are not read until a response is written
+        self.max_in_flight = max_in_flight
+        # budget.BudgetOptions to limit the bytes of the messages and responses
+        # held in memory (not reading past it, or sending NACKs), or None
+        self.budget = budget
+        # threadpool.PoolOptions to handle the connections of the threaded
+        # engine with a bounded pool of threads, shedding them past it, or None
+        # for a thread per connection
+        self.pool = pool
+
+
+class HttpForwarder:
+    # Delivers the queued messages to the HTTP server, for spool.Spool
+    def __init__(self, http_url, http_options):
+        self.http_url = http_url
+        self.http_options = http_options
+        self.session = shared_session(
+            http_url, pool_size=http_options.pool_size, max_idle=http_options.max_idle
+        )
+
+    def __call__(self, message, meta):
+        local_address, remote_address = spool.addresses(meta)
+        headers = http_headers(local_address, remote_address, self.http_options)
+        data, headers = compression.encode_request(
+            message, headers, self.http_options.compression
+        )
+        start = time.perf_counter()
+        try:
+            response = self.session.post(
+                urllib.parse.urlunparse(self.http_url),
+                data=data,
+                headers=headers,
+                timeout=self.http_options.timeout,
+            )
+        except Exception:
+            metrics.ERRORS.inc("http_connection")
+            raise
+        metrics.HTTP_POST.observe(time.perf_counter() - start)
+        if not response.ok:
+            metrics.ERRORS.inc("http_status")
+            if not spool.retryable(response.status_code):
+                raise spool.Rejected(f"HTTP response error: {response.status_code}")
+            response.raise_for_status()
+        logger.info("Delivered: %s bytes - %s", len(message), response)
+        log_payload(logger, "Response Data", response.content)
 
 
 class MllpHandler(socketserver.StreamRequestHandler):
-    def __init__(self, request, address, server, timeout, http_url, http_options):
+    def __init__(
+        self,
+        request,
+        address,
+        server,
+        timeout,
+        http_url,
+        http_options,
+        no_delay=False,
+        queue=None,
+        batcher=None,
+        max_in_flight=1,
+        budget=None,
+        breaker=None,
+    ):
         self.http_url = http_url
         self.http_options = http_options
         self.timeout = timeout
+        self.no_delay = no_delay
+        self.queue = queue
+        self.batcher = batcher
+        self.max_in_flight = max_in_flight
+        self.budget = budget
+        self.breaker = breaker
         super().__init__(request, address, server)
 
+    def forward(self, session, local_address, remote_address, account, message):
+        metrics.MESSAGES.inc()
+        metrics.BYTES.inc("in", value=len(message))
+        logger.info("Message: %s bytes", len(message))
+        log_payload(logger, "Received Data", message)
+        headers = http_headers(local_address, remote_address, self.http_options)
+        try:
+            with guard(self.breaker, http_failure):
+                if self.batcher is not None:
+                    response = self.batcher.send(message, headers)
+                else:
+                    response = http_post(
+                        session, self.http_url, self.http_options, message, headers
+                    )
+        except CircuitOpen as e:
+            nack = self.breaker.options.nack
+            if nack is None:
+                raise
+            metrics.ERRORS.inc("circuit_open")
+            logger.error("Message not sent: %s", e)
+            response = hl7.Nack(hl7.ack(message, nack.encode("ascii")), "circuit open")
+        finally:
+            account.release(len(message))
+        account.add(len(response.content))
+        return response
+
+    def fail(self, error):
+        if isinstance(error, CircuitOpen):
+            metrics.ERRORS.inc("circuit_open")
+            logger.error("Message not sent: %s", error)
+        elif isinstance(error, requests.exceptions.HTTPError):
+            metrics.ERRORS.inc("http_status")
+            logger.error("HTTP response error: %s", error.response.status_code)
+        else:
+            metrics.ERRORS.inc("http_connection")
+            logger.error("HTTP connection error: %s", error)
+
+    def reply(self, account, response):
+        content = response.content
+        logger.info("Response: %s bytes - %s", len(content), response)
+        log_payload(logger, "Response Data", content)
+        start = time.perf_counter()
+        sendall_mllp(self.request, content)
+        metrics.RESPONSE_WRITE.observe(time.perf_counter() - start)
+        metrics.BYTES.inc("out", value=len(content))
+        account.release(len(content))
+
     def handle(self):
         if self.timeout:
             self.request.settimeout(self.timeout)
         self.request.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 10)
-        session = requests.Session()
+        if self.no_delay:
+            set_no_delay(self.request)
+        session = shared_session(
+            self.http_url,
+            pool_size=self.http_options.pool_size,
+            max_idle=self.http_options.max_idle,
+        )
         local_address = self.request.getsockname()
         remote_address = self.request.getpeername()
 
-        stream = read_socket_bytes(self.rfile)
+        account = open_account(self.budget)
+        nack = None if self.budget is None else self.budget.options.nack
+        stream = read_socket_chunks(self.rfile)
+        forward = functools.partial(
+            self.forward, session, local_address, remote_address, account
+        )
+
+        window = None
+        if 1 < self.max_in_flight and self.queue is None:
+            window = Window(
+                self.max_in_flight,
+                forward,
+                functools.partial(self.reply, account),
+                self.fail,
+                stop=lambda: self.request.shutdown(socket.SHUT_RD),
+            )
 
         try:
-            for message in read_mllp(stream):
-                try:
-                    logger.info("Message: %s bytes", len(message))
-                    print(message)
-                    headers = {
-                        "Forwarded": f"by={display_address(local_address)};for={display_address(remote_address)};proto=mllp",
-                        "User-Agent": f"mllp2http/{__version__}",
-                        "X-Forwarded-For": display_address(remote_address),
-                        "X-Forwarded-Proto": "mllp",
-                    }
-
-                    if os.environ.get("HTTP_AUTHORIZATION"):
-                        headers["Authorization"] = os.environ["HTTP_AUTHORIZATION"]
-                    if os.environ.get("API_KEY"):
-                        headers["X-API-KEY"] = os.environ["API_KEY"]
-
-                    if self.http_options.content_type is not None:
-                        headers["Content-Type"] = self.http_options.content_type
-                    response = session.post(
-                        urllib.parse.urlunparse(self.http_url),
-                        data=message,
-                        headers=headers,
-                        timeout=self.http_options.timeout,
+            for message in read_mllp_chunks(stream):
+                if self.queue is not None:
+                    ack = spool.store(
+                        self.queue, message, local_address, remote_address
                     )
-                    response.raise_for_status()
-                except requests.exceptions.HTTPError as e:
-                    logger.error("HTTP response error: %s", e.response.status_code)
-                    break
+                    if ack is None:
+                        break
+                    sendall_mllp(self.request, ack)
+                    continue
+                response = admit(account, message, nack)
+                if response is not None:
+                    if window is None:
+                        self.reply(account, response)
+                    elif not window.put(response):
+                        break
+                    continue
+                if window is not None:
+                    if not window.submit(message):
+                        break
+                    continue
+                try:
+                    response = forward(message)
                 except Exception as e:
-                    logger.error("HTTP connection error: %s", e)
+                    self.fail(e)
                     break
+                self.reply(account, response)
+        except BudgetExceeded as e:
+            metrics.ERRORS.inc("budget")
+            logger.error("Byte budget exceeded: %s", e)
+        except ConnectionResetError as e:
+            logger.info("MLLP Server Disconnected")
+        except Exception as e:
+            metrics.ERRORS.inc("mllp_read")
+            logger.error("Failed read MLLP message: %s", e)
+        finally:
+            if window is not None:
+                window.close()
+            account.close()
+
+
+class AsyncMllpHandler:
+    # Same as MllpHandler, for the asyncio engine: one coroutine per MLLP
+    # connection, sharing a single non-blocking HTTP client
+    def __init__(
+        self,
+        timeout,
+        http_client,
+        http_options,
+        no_delay=False,
+        queue=None,
+        batcher=None,
+        max_in_flight=1,
+        budget=None,
+        breaker=None,
+    ):
+        self.http_client = http_client
+        self.http_options = http_options
+        self.timeout = timeout
+        self.no_delay = no_delay
+        self.queue = queue
+        self.batcher = batcher
+        self.max_in_flight = max_in_flight
+        self.budget = budget
+        self.breaker = breaker
+
+    async def forward(self, local_address, remote_address, account, message):
+        metrics.MESSAGES.inc()
+        metrics.BYTES.inc("in", value=len(message))
+        logger.info("Message: %s bytes", len(message))
+        log_payload(logger, "Received Data", message)
+        headers = http_headers(local_address, remote_address, self.http_options)
+        try:
+            with guard(self.breaker, http_failure):
+                if self.batcher is not None:
+                    response = await self.batcher.send(message, headers)
                 else:
-                    content = response.content
-                    logger.info("Response: %s bytes - %s", len(content), response)
-                    write_mllp(self.wfile, content)
-                    self.wfile.flush()
+                    response = await http_post_async(
+                        self.http_client, self.http_options, message, headers
+                    )
+        except CircuitOpen as e:
+            nack = self.breaker.options.nack
+            if nack is None:
+                raise
+            metrics.ERRORS.inc("circuit_open")
+            logger.error("Message not sent: %s", e)
+            response = hl7.Nack(hl7.ack(message, nack.encode("ascii")), "circuit open")
+        finally:
+            account.release(len(message))
+        account.add(len(response.content))
+        return response
+
+    async def fail(self, error):
+        if isinstance(error, CircuitOpen):
+            metrics.ERRORS.inc("circuit_open")
+            logger.error("Message not sent: %s", error)
+        elif isinstance(error, HttpStatusError):
+            metrics.ERRORS.inc("http_status")
+            logger.error("HTTP response error: %s", error.response.status)
+        else:
+            metrics.ERRORS.inc("http_connection")
+            logger.error("HTTP connection error: %s", error)
+
+    async def reply(self, account, writer, response):
+        content = response.content
+        logger.info("Response: %s bytes - %s", len(content), response)
+        log_payload(logger, "Response Data", content)
+        start = time.perf_counter()
+        writer.write(frame_mllp(content))
+        await writer.drain()
+        metrics.RESPONSE_WRITE.observe(time.perf_counter() - start)
+        metrics.BYTES.inc("out", value=len(content))
+        account.release(len(content))
+
+    async def __call__(self, reader, writer):
+        s = writer.get_extra_info("socket")
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 10)
+        if self.no_delay:
+            set_no_delay(s)
+        local_address = writer.get_extra_info("sockname")
+        remote_address = writer.get_extra_info("peername")
+
+        account = open_account(self.budget)
+        nack = None if self.budget is None else self.budget.options.nack
+        stream = read_stream_chunks(reader, timeout=self.timeout)
+        forward = functools.partial(
+            self.forward, local_address, remote_address, account
+        )
+
+        window = None
+        if 1 < self.max_in_flight and self.queue is None:
+            window = AsyncWindow(
+                self.max_in_flight,
+                forward,
+                functools.partial(self.reply, account, writer),
+                self.fail,
+                stop=writer.close,
+            )
+
+        try:
+            async for message in read_mllp_async(stream):
+                if self.queue is not None:
+                    # Stored (and flushed) off the event loop
+                    ack = await asyncio.get_running_loop().run_in_executor(
+                        None,
+                        spool.store,
+                        self.queue,
+                        message,
+                        local_address,
+                        remote_address,
+                    )
+                    if ack is None:
+                        break
+                    writer.write(frame_mllp(ack))
+                    await writer.drain()
+                    continue
+                response = await admit_async(account, message, nack)
+                if response is not None:
+                    if window is None:
+                        await self.reply(account, writer, response)
+                    elif not await window.put(response):
+                        break
+                    continue
+                if window is not None:
+                    if not await window.submit(message):
+                        break
+                    continue
+                try:
+                    response = await forward(message)
+                except Exception as e:
+                    await self.fail(e)
+                    break
+                await self.reply(account, writer, response)
+        except BudgetExceeded as e:
+            metrics.ERRORS.inc("budget")
+            logger.error("Byte budget exceeded: %s", e)
         except ConnectionResetError as e:
             logger.info("MLLP Server Disconnected")
         except Exception as e:
-            print(type(e))
+            metrics.ERRORS.inc("mllp_read")
             logger.error("Failed read MLLP message: %s", e)
+        finally:
+            try:
+                if window is not None:
+                    await window.close()
+            finally:
+                account.close()
+                writer.close()
 
 
-class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+class ThreadedTCPServer(
+    threadpool.ThreadPoolMixIn,
+    workers.ReusePortMixin,
+    socketserver.ThreadingMixIn,
+    socketserver.TCPServer,
+):
     allow_reuse_address = True
 
 
 class HttpClientOptions:
-    def __init__(self, content_type, timeout):
+    def __init__(
+        self,
+        content_type,
+        timeout,
+        pool_size=10,
+        max_idle=None,
+        batch=None,
+        compression=None,
+        breaker=None,
+    ):
         self.content_type = content_type
         self.timeout = timeout
+        # Connections kept open to the HTTP server, shared by all MLLP
+        # connections, and seconds before idle ones are closed (never, if None)
+        self.pool_size = pool_size
+        self.max_idle = max_idle
+        # compression.CompressionOptions to compress large request bodies,
+        # or None to send them as they are
+        self.compression = compression
+        # batch.BatchOptions to send the messages of all MLLP connections in
+        # batches, or None to send each message in its own request
+        self.batch = batch
+        # breaker.BreakerOptions to fail fast while the HTTP server is
+        # failing, or None to always wait for it
+        self.breaker = breaker
+
+
+def http_breaker_name(http_url):
+    # The HTTP server, without the credentials of the URL
+    return "HTTP server {}".format(http_url.netloc.rpartition("@")[2])
 
 
 def serve(address, options, http_url, http_options):
     logger = logging.getLogger(__name__)
 
+    if 1 < options.workers and workers.worker_index() is None:
+        workers.supervise(
+            options.workers, serve, address, options, http_url, http_options
+        )
+        return
+
+    if options.metrics_port:
+        metrics.serve_metrics(
+            (address[0], options.metrics_port + (workers.worker_index() or 0))
+        )
+
+    queue = None
+    if options.queue is not None:
+        queue = spool.open_spool(options.queue, HttpForwarder(http_url, http_options))
+
+    if options.engine == "asyncio":
+        asyncio.run(serve_async(address, options, http_url, http_options, queue))
+        return
+
+    batcher = None
+    if http_options.batch is not None:
+        session = shared_session(
+            http_url, pool_size=http_options.pool_size, max_idle=http_options.max_idle
+        )
+        batcher = Batcher(
+            functools.partial(http_post, session, http_url, http_options),
+            http_options.batch,
+        )
+
     handler = functools.partial(
         MllpHandler,
         http_url=http_url,
         http_options=http_options,
         timeout=options.timeout or None,
+        no_delay=options.no_delay,
+        queue=queue,
+        batcher=batcher,
+        max_in_flight=options.max_in_flight,
+        budget=open_budget(options.budget),
+        breaker=open_breaker(http_breaker_name(http_url), http_options.breaker),
     )
 
-    server = ThreadedTCPServer(address, handler)
+    server = ThreadedTCPServer(address, handler, pool=options.pool)
     logger.info("Listening on %s:%s", address[0], address[1])
     server.serve_forever()
+
+
+async def serve_async(address, options, http_url, http_options, queue=None):
+    http_client = AsyncHttpClient(
+        http_url,
+        timeout=http_options.timeout,
+        pool_size=http_options.pool_size,
+        max_idle=http_options.max_idle,
+    )
+
+    batcher = None
+    if http_options.batch is not None:
+        batcher = AsyncBatcher(
+            functools.partial(http_post_async, http_client, http_options),
+            http_options.batch,
+        )
+
+    handler = AsyncMllpHandler(
+        http_client=http_client,
+        http_options=http_options,
+        timeout=options.timeout or None,
+        no_delay=options.no_delay,
+        queue=queue,
+        batcher=batcher,
+        max_in_flight=options.max_in_flight,
+        budget=open_budget(options.budget),
+        breaker=open_breaker(http_breaker_name(http_url), http_options.breaker),
+    )
+
+    server = await asyncio.start_server(
+        handler,
+        address[0],
+        address[1],
+        reuse_address=True,
+        reuse_port=workers.reuse_port(),
+        backlog=threadpool.listen_backlog(options.pool),
+    )
+    logger.info("Listening on %s:%s (asyncio)", address[0], address[1])
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await http_client.close()
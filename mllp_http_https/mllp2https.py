@@ -2,6 +2,7 @@
 ### By Tiago Rodrigues
 ### Sectra Iberia, Aug 2022
 ### Addapted from https://github.com/rivethealth/mllp-http
+import asyncio
 import base64
 import datetime
 import functools
@@ -12,13 +13,22 @@ from datetime import datetime, timezone
 import requests
 import socket
 import socketserver
+import time
 import urllib
 
 from requests.auth import HTTPBasicAuth
 
-from .mllp import read_mllp, write_mllp
-from .net import read_socket_bytes
+from . import compression, hl7, metrics, spool, threadpool, workers
+from .batch import AsyncBatcher, Batcher
+from .asynchttp import AsyncHttpClient, HttpStatusError
+from .log2file import log_payload
+from .mllp import frame_mllp, read_mllp_async, read_mllp_chunks, sendall_mllp
+from .net import read_socket_chunks, read_stream_chunks, set_no_delay
+from .session import shared_session
 from .version import __version__
+from .breaker import CircuitOpen, guard, http_failure, open_breaker
+from .budget import BudgetExceeded, admit, admit_async, open_account, open_budget
+from .window import AsyncWindow, Window
 
 logger = logging.getLogger(__name__)
 
@@ -27,36 +37,260 @@ def display_address(address):
     return f"{address[0]}:{address[1]}"
 
 
+def basic_auth(username, password):
+    # Authorization header for the username and password, if both are provided
+    if username and password:
+        return "Basic " + base64.b64encode(
+            bytes("%s:%s" % (username, password), "utf-8")
+        ).decode("ascii")
+    return None
+
+
+def https_headers(local_address, remote_address, https_options, auth):
+    headers = {
+        "Forwarded": f"by={display_address(local_address)};for={display_address(remote_address)};proto=mllp",
+        "User-Agent": f"mllp2http/{__version__}",
+        "X-Forwarded-For": display_address(remote_address),
+        "X-Forwarded-Proto": "mllp",
+    }
+
+    if auth:
+        headers["Authorization"] = auth
+    elif os.environ.get("HTTP_AUTHORIZATION"):
+        headers["Authorization"] = os.environ["HTTP_AUTHORIZATION"]
+    if os.environ.get("API_KEY"):
+        headers["X-API-KEY"] = os.environ["API_KEY"]
+
+    if https_options.content_type is not None:
+        headers["Content-Type"] = https_options.content_type
+
+    now = datetime.now(timezone.utc)
+    date = now.strftime("%a, %d %b %y %H:%M:%S %Z")
+    headers["Date"] = date
+    return headers
+
+
+def https_post(session, https_url, https_options, data, headers):
+    data, headers = compression.encode_request(data, headers, https_options.compression)
+    start = time.perf_counter()
+    response = session.post(
+        urllib.parse.urlunparse(https_url),
+        data=data,
+        headers=headers,
+        timeout=https_options.timeout,
+        verify=https_options.verify,  # To verify server SSL/TLS certificate. Keep as False only
+        # when using a self-sign certificate since the library does not allow self-signed certificates
+    )
+    metrics.HTTP_POST.observe(time.perf_counter() - start)
+    response.raise_for_status()  # Get ACK response
+    return response
+
+
+async def https_post_async(https_client, https_options, data, headers):
+    if https_options.compression is not None:
+        data, headers = compression.encode_request(
+            data, headers, https_options.compression
+        )
+        headers["Accept-Encoding"] = ", ".join(compression.ENCODINGS)
+    start = time.perf_counter()
+    response = await https_client.post(data, headers)
+    metrics.HTTP_POST.observe(time.perf_counter() - start)
+    if "content-encoding" in response.headers:
+        options = https_options.compression or compression.CompressionOptions()
+        response.content = compression.decompress(
+            response.content, response.headers["content-encoding"], options.max_size
+        )
+    response.raise_for_status()  # Get ACK response
+    return response
+
+
 class MllpServerOptions:
-    def __init__(self, timeout):
+    def __init__(
+        self,
+        timeout,
+        no_delay=False,
+        engine="threaded",
+        metrics_port=None,
+        workers=1,
+        queue=None,
+        max_in_flight=1,
+        budget=None,
+        pool=None,
+    ):
         self.timeout = timeout
+        self.no_delay = no_delay
+        self.engine = engine
+        # Port for GET /metrics, or no metrics endpoint if None
+        self.metrics_port = metrics_port
+        # Processes sharing the port, each with its own connections. Each
+        # worker serves its metrics on metrics_port + its index.
+        self.workers = workers
+        # spool.SpoolOptions to acknowledge messages once stored on disk and
+        # deliver them in the background, or None to wait for the HTTPS server
+        self.queue = queue
+        # Messages of one MLLP connection sent to the HTTPS server at the
+        # same time; the next messages are not read until a response is written
+        self.max_in_flight = max_in_flight
+        # budget.BudgetOptions to limit the bytes of the messages and responses
+        # held in memory (not reading past it, or sending NACKs), or None
+        self.budget = budget
+        # threadpool.PoolOptions to handle the connections of the threaded
+        # engine with a bounded pool of threads, shedding them past it, or None
+        # for a thread per connection
+        self.pool = pool
+
+
+class HttpsForwarder:
+    # Delivers the queued messages to the HTTPS server, for spool.Spool
+    def __init__(self, https_url, https_options):
+        self.https_url = https_url
+        self.https_options = https_options
+        self.auth = basic_auth(https_options.username, https_options.password)
+        self.session = shared_session(
+            https_url,
+            pool_size=https_options.pool_size,
+            max_idle=https_options.max_idle,
+            verify=https_options.verify,
+        )
+        if not https_options.verify:
+            requests.packages.urllib3.disable_warnings()
+
+    def __call__(self, message, meta):
+        local_address, remote_address = spool.addresses(meta)
+        headers = https_headers(
+            local_address, remote_address, self.https_options, self.auth
+        )
+        data, headers = compression.encode_request(
+            message, headers, self.https_options.compression
+        )
+        start = time.perf_counter()
+        try:
+            response = self.session.post(
+                urllib.parse.urlunparse(self.https_url),
+                data=data,
+                headers=headers,
+                timeout=self.https_options.timeout,
+                verify=self.https_options.verify,
+            )
+        except Exception:
+            metrics.ERRORS.inc("http_connection")
+            raise
+        metrics.HTTP_POST.observe(time.perf_counter() - start)
+        if not response.ok:
+            metrics.ERRORS.inc("http_status")
+            if not spool.retryable(response.status_code):
+                raise spool.Rejected(f"HTTPS response error: {response.status_code}")
+            response.raise_for_status()
+        logger.info("Delivered: %s bytes", len(message))
+        log_payload(logger, "Response Data", response.content)
 
 
 class MllpHandler(socketserver.StreamRequestHandler):
     # Class for parsing HL7 data as MLLP Server and send it to a host as a HTTPS Client
 
-    def __init__(self, request, address, server, timeout, https_url, https_options):
+    def __init__(
+        self,
+        request,
+        address,
+        server,
+        timeout,
+        https_url,
+        https_options,
+        no_delay=False,
+        queue=None,
+        batcher=None,
+        max_in_flight=1,
+        budget=None,
+        breaker=None,
+    ):
         self.https_url = https_url
         self.https_options = https_options
         self.timeout = timeout
+        self.no_delay = no_delay
+        self.queue = queue
+        self.batcher = batcher
+        self.max_in_flight = max_in_flight
+        self.budget = budget
+        self.breaker = breaker
 
         # If username and password are provided as arguments, use authentication
         self.username = https_options.username
         self.password = https_options.password
-        self.auth = None
-        if self.username and self.password:
-            self.auth = ''
-            self.auth = 'Basic ' + base64.b64encode(
-                bytes('%s:%s' % (self.username, self.password), 'utf-8')).decode('ascii')
+        self.auth = basic_auth(self.username, self.password)
         super().__init__(request, address, server)
 
+    def forward(self, session, local_address, remote_address, account, message):
+        metrics.MESSAGES.inc()
+        metrics.BYTES.inc("in", value=len(message))
+        logger.info("Message: %s bytes", len(message))
+        log_payload(logger, "Received Data", message)
+        headers = https_headers(
+            local_address, remote_address, self.https_options, self.auth
+        )
+
+        # Disabled the warning because it was causing the program to freeze
+        if not self.https_options.verify:
+            logger.warning("Verify SSL: " + str(self.https_options.verify))
+            requests.packages.urllib3.disable_warnings()
+
+        # Sending the HL7 data by HTTPS by POST Method
+        try:
+            with guard(self.breaker, http_failure):
+                if self.batcher is not None:
+                    response = self.batcher.send(message, headers)
+                else:
+                    response = https_post(
+                        session, self.https_url, self.https_options, message, headers
+                    )
+        except CircuitOpen as e:
+            nack = self.breaker.options.nack
+            if nack is None:
+                raise
+            metrics.ERRORS.inc("circuit_open")
+            logger.error("Message not sent: %s", e)
+            response = hl7.Nack(hl7.ack(message, nack.encode("ascii")), "circuit open")
+        finally:
+            account.release(len(message))
+        account.add(len(response.content))
+        return response
+
+    def fail(self, error):
+        if isinstance(error, CircuitOpen):
+            metrics.ERRORS.inc("circuit_open")
+            logger.error("Message not sent: %s", error)
+        elif isinstance(error, requests.exceptions.HTTPError):
+            metrics.ERRORS.inc("http_status")
+            logger.error("HTTPS response error: %s", error.response.status_code)
+        else:
+            metrics.ERRORS.inc("http_connection")
+            logger.error("HTTPS connection error: %s", error)
+
+    def reply(self, account, response):
+        content = response.content
+        # print(content.decode())
+        logger.info("Response: %s bytes", len(content))
+        log_payload(logger, "Response Data", content)
+        start = time.perf_counter()
+        sendall_mllp(self.request, content)
+        metrics.RESPONSE_WRITE.observe(time.perf_counter() - start)
+        metrics.BYTES.inc("out", value=len(content))
+        account.release(len(content))
+
     def handle(self):
         if self.timeout:
             self.request.settimeout(self.timeout)
         self.request.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 10)
-
-        # Session for HTTPS persistent connection
-        session = requests.Session()
+        if self.no_delay:
+            set_no_delay(self.request)
+
+        # Session for HTTPS persistent connection, from a pool of connections
+        # shared by all MLLP connections, with a single SSL context
+        session = shared_session(
+            self.https_url,
+            pool_size=self.https_options.pool_size,
+            max_idle=self.https_options.max_idle,
+            verify=self.https_options.verify,
+        )
 
         # >> Notes on dealing with SSL:
         # Requests verifies SSL certificates for HTTPS requests.
@@ -71,80 +305,259 @@ class MllpHandler(socketserver.StreamRequestHandler):
         local_address = self.request.getsockname()
         remote_address = self.request.getpeername()
 
-        stream = read_socket_bytes(self.rfile)
+        account = open_account(self.budget)
+        nack = None if self.budget is None else self.budget.options.nack
+        stream = read_socket_chunks(self.rfile)
+        forward = functools.partial(
+            self.forward, session, local_address, remote_address, account
+        )
+
+        window = None
+        if 1 < self.max_in_flight and self.queue is None:
+            window = Window(
+                self.max_in_flight,
+                forward,
+                functools.partial(self.reply, account),
+                self.fail,
+                stop=lambda: self.request.shutdown(socket.SHUT_RD),
+            )
 
         try:
-            for message in read_mllp(stream):
-                try:
-                    logger.info("Message: %s bytes", len(message))
-                    logger.info("Received Data:\n{}\n\n".format(message))
-                    headers = {
-                        "Forwarded": f"by={display_address(local_address)};for={display_address(remote_address)};proto=mllp",
-                        "User-Agent": f"mllp2http/{__version__}",
-                        "X-Forwarded-For": display_address(remote_address),
-                        "X-Forwarded-Proto": "mllp",
-                    }
-
-                    if self.auth:
-                        headers["Authorization"] = self.auth
-                        #print("Authorization: {}".format(self.auth))
-                    elif os.environ.get("HTTP_AUTHORIZATION"):
-                        headers["Authorization"] = os.environ["HTTP_AUTHORIZATION"]
-                        #print("Authorization: {}".format(os.environ["HTTP_AUTHORIZATION"]))
-                    if os.environ.get("API_KEY"):
-                        headers["X-API-KEY"] = os.environ["API_KEY"]
-                        # print(os.environ["API_KEY"])
-
-                    if self.https_options.content_type is not None:
-                        headers["Content-Type"] = self.https_options.content_type
-
-                    now = datetime.now(timezone.utc)
-                    date = now.strftime("%a, %d %b %y %H:%M:%S %Z")
-                    headers["Date"] = date
-
-                    # Disabled the warning because it was causing the program to freeze
-                    if not self.https_options.verify:
-                        logger.warning("Verify SSL: " + str(self.https_options.verify))
-                        requests.packages.urllib3.disable_warnings()
-
-                    # Sending the HL7 data by HTTPS by POST Method
-                    response = session.post(
-                        urllib.parse.urlunparse(self.https_url),
-                        data=message,
-                        headers=headers,
-                        timeout=self.https_options.timeout,
-                        verify=self.https_options.verify,  # To verify server SSL/TLS certificate. Keep as False only
-                        # when using a self-sign certificate since the library does not allow self-signed certificates
+            for message in read_mllp_chunks(stream):
+                if self.queue is not None:
+                    ack = spool.store(
+                        self.queue, message, local_address, remote_address
                     )
-                    response.raise_for_status()  # Get ACK response
-                except requests.exceptions.HTTPError as e:
-                    logger.error("HTTPS response error: %s", e.response.status_code)
-                    break
+                    if ack is None:
+                        break
+                    sendall_mllp(self.request, ack)
+                    continue
+                response = admit(account, message, nack)
+                if response is not None:
+                    if window is None:
+                        self.reply(account, response)
+                    elif not window.put(response):
+                        break
+                    continue
+                if window is not None:
+                    if not window.submit(message):
+                        break
+                    continue
+                try:
+                    response = forward(message)
                 except Exception as e:
-                    logger.error("HTTPS connection error: %s", e)
+                    self.fail(e)
                     break
-                else:
-                    content = response.content
-                    # print(content.decode())
-                    logger.info("Response: %s bytes", len(content))
-                    logger.info("Response Data:\n{}\n\n".format(content.decode()))
-                    write_mllp(self.wfile, content)
-                    self.wfile.flush()
+                self.reply(account, response)
+        except BudgetExceeded as e:
+            metrics.ERRORS.inc("budget")
+            logger.error("Byte budget exceeded: %s", e)
         except ConnectionResetError as e:
             # An enception was raised when the MLLP client closed the connection on their side
             logger.info("MLLP Server Disconnected")
         except Exception as e:
+            metrics.ERRORS.inc("mllp_read")
             logger.error("Failed read MLLP message: %s", e)
+        finally:
+            if window is not None:
+                window.close()
+            account.close()
+
+
+class AsyncMllpHandler:
+    # Same as MllpHandler, for the asyncio engine: one coroutine per MLLP
+    # connection, sharing a single non-blocking HTTPS client
+
+    def __init__(
+        self,
+        timeout,
+        https_client,
+        https_options,
+        no_delay=False,
+        queue=None,
+        batcher=None,
+        max_in_flight=1,
+        budget=None,
+        breaker=None,
+    ):
+        self.https_client = https_client
+        self.https_options = https_options
+        self.timeout = timeout
+        self.no_delay = no_delay
+        self.queue = queue
+        self.batcher = batcher
+        self.max_in_flight = max_in_flight
+        self.budget = budget
+        self.breaker = breaker
+        self.auth = basic_auth(https_options.username, https_options.password)
+
+    async def forward(self, local_address, remote_address, account, message):
+        metrics.MESSAGES.inc()
+        metrics.BYTES.inc("in", value=len(message))
+        logger.info("Message: %s bytes", len(message))
+        log_payload(logger, "Received Data", message)
+        headers = https_headers(
+            local_address, remote_address, self.https_options, self.auth
+        )
+
+        # Sending the HL7 data by HTTPS by POST Method
+        try:
+            with guard(self.breaker, http_failure):
+                if self.batcher is not None:
+                    response = await self.batcher.send(message, headers)
+                else:
+                    response = await https_post_async(
+                        self.https_client, self.https_options, message, headers
+                    )
+        except CircuitOpen as e:
+            nack = self.breaker.options.nack
+            if nack is None:
+                raise
+            metrics.ERRORS.inc("circuit_open")
+            logger.error("Message not sent: %s", e)
+            response = hl7.Nack(hl7.ack(message, nack.encode("ascii")), "circuit open")
+        finally:
+            account.release(len(message))
+        account.add(len(response.content))
+        return response
+
+    async def fail(self, error):
+        if isinstance(error, CircuitOpen):
+            metrics.ERRORS.inc("circuit_open")
+            logger.error("Message not sent: %s", error)
+        elif isinstance(error, HttpStatusError):
+            metrics.ERRORS.inc("http_status")
+            logger.error("HTTPS response error: %s", error.response.status)
+        else:
+            metrics.ERRORS.inc("http_connection")
+            logger.error("HTTPS connection error: %s", error)
+
+    async def reply(self, account, writer, response):
+        content = response.content
+        logger.info("Response: %s bytes", len(content))
+        log_payload(logger, "Response Data", content)
+        start = time.perf_counter()
+        writer.write(frame_mllp(content))
+        await writer.drain()
+        metrics.RESPONSE_WRITE.observe(time.perf_counter() - start)
+        metrics.BYTES.inc("out", value=len(content))
+        account.release(len(content))
+
+    async def __call__(self, reader, writer):
+        s = writer.get_extra_info("socket")
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 10)
+        if self.no_delay:
+            set_no_delay(s)
+        local_address = writer.get_extra_info("sockname")
+        remote_address = writer.get_extra_info("peername")
+
+        account = open_account(self.budget)
+        nack = None if self.budget is None else self.budget.options.nack
+        stream = read_stream_chunks(reader, timeout=self.timeout)
+        forward = functools.partial(
+            self.forward, local_address, remote_address, account
+        )
+
+        window = None
+        if 1 < self.max_in_flight and self.queue is None:
+            window = AsyncWindow(
+                self.max_in_flight,
+                forward,
+                functools.partial(self.reply, account, writer),
+                self.fail,
+                stop=writer.close,
+            )
 
-
-class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+        try:
+            async for message in read_mllp_async(stream):
+                if self.queue is not None:
+                    # Stored (and flushed) off the event loop
+                    ack = await asyncio.get_running_loop().run_in_executor(
+                        None,
+                        spool.store,
+                        self.queue,
+                        message,
+                        local_address,
+                        remote_address,
+                    )
+                    if ack is None:
+                        break
+                    writer.write(frame_mllp(ack))
+                    await writer.drain()
+                    continue
+                response = await admit_async(account, message, nack)
+                if response is not None:
+                    if window is None:
+                        await self.reply(account, writer, response)
+                    elif not await window.put(response):
+                        break
+                    continue
+                if window is not None:
+                    if not await window.submit(message):
+                        break
+                    continue
+                try:
+                    response = await forward(message)
+                except Exception as e:
+                    await self.fail(e)
+                    break
+                await self.reply(account, writer, response)
+        except BudgetExceeded as e:
+            metrics.ERRORS.inc("budget")
+            logger.error("Byte budget exceeded: %s", e)
+        except ConnectionResetError as e:
+            # An enception was raised when the MLLP client closed the connection on their side
+            logger.info("MLLP Server Disconnected")
+        except Exception as e:
+            metrics.ERRORS.inc("mllp_read")
+            logger.error("Failed read MLLP message: %s", e)
+        finally:
+            try:
+                if window is not None:
+                    await window.close()
+            finally:
+                account.close()
+                writer.close()
+
+
+class ThreadedTCPServer(
+    threadpool.ThreadPoolMixIn,
+    workers.ReusePortMixin,
+    socketserver.ThreadingMixIn,
+    socketserver.TCPServer,
+):
     allow_reuse_address = True
 
 
 class HttpsClientOptions:
-    def __init__(self, content_type, timeout, verify, username, password):
+    def __init__(
+        self,
+        content_type,
+        timeout,
+        verify,
+        username,
+        password,
+        pool_size=10,
+        max_idle=None,
+        batch=None,
+        compression=None,
+        breaker=None,
+    ):
         self.content_type = content_type
         self.timeout = timeout
+        # Connections kept open to the HTTPS server, shared by all MLLP
+        # connections, and seconds before idle ones are closed (never, if None)
+        self.pool_size = pool_size
+        self.max_idle = max_idle
+        # compression.CompressionOptions to compress large request bodies,
+        # or None to send them as they are
+        self.compression = compression
+        # batch.BatchOptions to send the messages of all MLLP connections in
+        # batches, or None to send each message in its own request
+        self.batch = batch
+        # breaker.BreakerOptions to fail fast while the HTTPS server is
+        # failing, or None to always wait for it
+        self.breaker = breaker
         self.verify = True
         if verify == "False":
             self.verify = False
@@ -156,20 +569,68 @@ class HttpsClientOptions:
         self.password = password
 
 
+def https_breaker_name(https_url):
+    # The HTTPS server, without the credentials of the URL
+    return "HTTPS server {}".format(https_url.netloc.rpartition("@")[2])
+
+
 def serve(address, options, https_url, https_options):
     logger = logging.getLogger(__name__)
 
+    if 1 < options.workers and workers.worker_index() is None:
+        workers.supervise(
+            options.workers, serve, address, options, https_url, https_options
+        )
+        return
+
+    if options.metrics_port:
+        metrics.serve_metrics(
+            (address[0], options.metrics_port + (workers.worker_index() or 0))
+        )
+
+    queue = None
+    if options.queue is not None:
+        queue = spool.open_spool(
+            options.queue, HttpsForwarder(https_url, https_options)
+        )
+
+    if options.engine == "asyncio":
+        try:
+            asyncio.run(serve_async(address, options, https_url, https_options, queue))
+        except Exception as e:
+            logger.error("MLLP connection error: %s", e)
+        return
+
+    batcher = None
+    if https_options.batch is not None:
+        session = shared_session(
+            https_url,
+            pool_size=https_options.pool_size,
+            max_idle=https_options.max_idle,
+            verify=https_options.verify,
+        )
+        batcher = Batcher(
+            functools.partial(https_post, session, https_url, https_options),
+            https_options.batch,
+        )
+
     # Handler for parsing the data from the MLLP socket
     handler = functools.partial(
         MllpHandler,
         https_url=https_url,
         https_options=https_options,
         timeout=options.timeout or None,
+        no_delay=options.no_delay,
+        queue=queue,
+        batcher=batcher,
+        max_in_flight=options.max_in_flight,
+        budget=open_budget(options.budget),
+        breaker=open_breaker(https_breaker_name(https_url), https_options.breaker),
     )
 
     try:
         # MLLP Server/Listener
-        server = ThreadedTCPServer(address, handler)
+        server = ThreadedTCPServer(address, handler, pool=options.pool)
 
         logger.info("Listening on %s:%s", address[0], address[1])
         logger.info("Sending to %s", https_url[1])
@@ -179,3 +640,51 @@ def serve(address, options, https_url, https_options):
 
     except Exception as e:
         logger.error("MLLP connection error: %s", e)
+
+
+async def serve_async(address, options, https_url, https_options, queue=None):
+    # Single HTTPS client for every MLLP connection, with the SSL context
+    # built from the verify option
+    https_client = AsyncHttpClient(
+        https_url,
+        timeout=https_options.timeout,
+        verify=https_options.verify,
+        pool_size=https_options.pool_size,
+        max_idle=https_options.max_idle,
+    )
+
+    batcher = None
+    if https_options.batch is not None:
+        batcher = AsyncBatcher(
+            functools.partial(https_post_async, https_client, https_options),
+            https_options.batch,
+        )
+
+    handler = AsyncMllpHandler(
+        https_client=https_client,
+        https_options=https_options,
+        timeout=options.timeout or None,
+        no_delay=options.no_delay,
+        queue=queue,
+        batcher=batcher,
+        max_in_flight=options.max_in_flight,
+        budget=open_budget(options.budget),
+        breaker=open_breaker(https_breaker_name(https_url), https_options.breaker),
+    )
+
+    # MLLP Server/Listener
+    server = await asyncio.start_server(
+        handler,
+        address[0],
+        address[1],
+        reuse_address=True,
+        reuse_port=workers.reuse_port(),
+        backlog=threadpool.listen_backlog(options.pool),
+    )
+    logger.info("Listening on %s:%s (asyncio)", address[0], address[1])
+    logger.info("Sending to %s", https_url[1])
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await https_client.close()
@@ -1,3 +1,4 @@
+import asyncio
 import functools
 import socket
 
@@ -8,3 +9,34 @@ def read_socket_bytes(s):
             yield ord(b)
     except socket.timeout:
         pass
+
+
+def read_socket_chunks(s, size=64 * 1024):
+    # Yields whatever is available on the buffered socket file, up to size
+    # bytes at a time, without waiting for the buffer to fill up.
+    try:
+        for chunk in iter(functools.partial(s.read1, size), b""):
+            yield chunk
+    except socket.timeout:
+        pass
+
+
+async def read_stream_chunks(reader, size=64 * 1024, timeout=None):
+    # Same as read_socket_chunks, for an asyncio StreamReader
+    try:
+        while True:
+            if timeout:
+                chunk = await asyncio.wait_for(reader.read(size), timeout)
+            else:
+                chunk = await reader.read(size)
+            if not chunk:
+                break
+            yield chunk
+    except asyncio.TimeoutError:
+        pass
+
+
+def set_no_delay(s):
+    # Disables Nagle's algorithm, so small MLLP frames (e.g. ACKs) are sent
+    # at once instead of waiting for the peer to acknowledge previous data
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
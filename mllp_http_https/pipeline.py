@@ -0,0 +1,576 @@
+### Pipelined MLLP client connections, for http2mllp and https2mllp: up to
+### pipeline_depth messages are written back-to-back on each connection
+### without waiting for the previous response
+import asyncio
+import collections
+import logging
+import selectors
+import socket
+import threading
+import time
+
+from . import hl7
+from .mllp import MllpDecoder, MllpError, frame_mllp, sendall_mllp
+from .net import set_no_delay
+from .pool import PoolStats, PoolTimeout
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineMatch:
+    # How responses are matched to the messages in flight
+    FIFO = "fifo"  # in the order the messages were sent
+    CONTROL_ID = "control-id"  # MSA-2 to MSH-10, in order if both are missing
+
+    ALL = (FIFO, CONTROL_ID)
+
+
+class InFlight:
+    # Messages sent on a connection and waiting for their response. With
+    # CONTROL_ID, a response is matched by control ID, and a response
+    # without one to the oldest message without one: a response matching no
+    # message means the connection is out of step, and is an MllpError.
+
+    def __init__(self, match):
+        self.match = match
+        self.queue = collections.deque()  # (control ID, waiter), oldest first
+
+    def __len__(self):
+        return len(self.queue)
+
+    def control_id(self, data):
+        if self.match == PipelineMatch.CONTROL_ID:
+            return hl7.message_control_id(data)
+        return None
+
+    def append(self, control_id, waiter):
+        self.queue.append((control_id, waiter))
+
+    def pop(self, response):
+        # Waiter of the message that response answers
+        if not self.queue:
+            raise MllpError("MLLP response without a message in flight")
+        if self.match == PipelineMatch.CONTROL_ID:
+            control_id = hl7.ack_control_id(response)
+            for i, (message_id, waiter) in enumerate(self.queue):
+                if message_id == control_id:
+                    del self.queue[i]
+                    return waiter
+            raise MllpError(
+                "MLLP response for no message in flight (MSA-2 {!r})".format(control_id)
+            )
+        return self.queue.popleft()[1]
+
+    def clear(self):
+        waiters = [waiter for _, waiter in self.queue]
+        self.queue.clear()
+        return waiters
+
+
+class Waiter:
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class PipelinedMllpClient:
+    # Same interface as MllpClient. Messages go to the open connection with
+    # the fewest in flight, below pipeline_depth; a new connection is opened
+    # when all are full, up to pool_max, and senders wait (up to
+    # pool_timeout) beyond that. A reader thread per connection delivers the
+    # responses, and fails every message in flight if the connection drops
+    # or a response times out.
+
+    def __init__(self, address, options):
+        self.address = address
+        self.options = options
+        self.connections = []
+        self.size = 0  # open (or opening) connections
+        self.waiting = 0
+        self.stats = PoolStats()
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+
+    def _connect(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.options.timeout:
+            s.settimeout(self.options.timeout)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 10)
+        if self.options.no_delay:
+            set_no_delay(s)
+        try:
+            s.connect(self.address)
+        except BaseException:
+            s.close()
+            raise
+        return PipelinedMllpConnection(self, s)
+
+    def _reserve(self):
+        # A connection with room for one more message, or None if a new
+        # one may be opened; raises PoolTimeout
+        depth = self.options.pipeline_depth
+        start = None
+        remaining = self.options.pool_timeout
+        while True:
+            connection = min(
+                (c for c in self.connections if not c.draining and c.in_flight < depth),
+                key=lambda c: c.in_flight,
+                default=None,
+            )
+            if connection is not None:
+                connection.reserve()
+                break
+            if not 0 <= self.options.pool_max <= self.size:
+                self.size += 1
+                break
+            if start is None:
+                start = time.monotonic()
+            elif remaining is not None:
+                remaining = self.options.pool_timeout - (time.monotonic() - start)
+            if remaining is not None and remaining <= 0:
+                self.stats.timeouts += 1
+                self.stats.waited(time.monotonic() - start)
+                raise PoolTimeout(
+                    "No MLLP connection available after {}s ({} messages in flight)".format(
+                        self.options.pool_timeout,
+                        sum(c.in_flight for c in self.connections),
+                    )
+                )
+            self.waiting += 1
+            try:
+                self.available.wait(remaining)
+            finally:
+                self.waiting -= 1
+        if start is not None:
+            self.stats.waited(time.monotonic() - start)
+        self.stats.acquired += 1
+        return connection
+
+    def acquire(self):
+        with self.lock:
+            connection = self._reserve()
+        if connection is not None:
+            return connection
+        try:
+            connection = self._connect()
+        except BaseException:
+            with self.lock:
+                self.size -= 1
+                self.available.notify()
+            raise
+        with self.lock:
+            self.stats.created += 1
+            connection.reserve()
+            self.connections.append(connection)
+        connection.start()
+        return connection
+
+    def send(self, data):
+        return self.acquire().send(data)
+
+    def retire(self, connection):
+        # Called with the lock held, once connection is closed
+        if connection in self.connections:
+            self.connections.remove(connection)
+            self.size -= 1
+            self.stats.closed += 1
+        self.available.notify_all()
+
+    def snapshot(self):
+        with self.lock:
+            stats = self.stats
+            idle = sum(1 for c in self.connections if not c.in_flight)
+            return {
+                "size": self.size,
+                "idle": idle,
+                "in_use": self.size - idle,
+                "in_flight": sum(c.in_flight for c in self.connections),
+                "waiting": self.waiting,
+                "max": self.options.pool_max,
+                "created": stats.created,
+                "closed": stats.closed,
+                "acquired": stats.acquired,
+                "waits": stats.waits,
+                "timeouts": stats.timeouts,
+                "wait_time": stats.wait_time,
+                "max_wait_time": stats.max_wait_time,
+            }
+
+
+class PipelineState:
+    # Messages in flight and expiry of a pipelined connection
+
+    def reserve(self):
+        self.in_flight += 1
+        self.message_count += 1
+        if self.message_count >= self.options.max_messages >= 0:
+            self.draining = True
+
+    def _idle_timeout(self):
+        # Seconds before the connection expires, or None while in use or
+        # if it never does
+        keep_alive = self.options.keep_alive
+        if self.in_flight or keep_alive is None or keep_alive < 0:
+            return None
+        return max(0, self.last_update + keep_alive - time.monotonic())
+
+    def _expire(self):
+        # Marks the connection closed and retires it, if it is done with
+        # (recycled after max_messages, or idle for keep_alive)
+        if (
+            self.in_flight
+            or self.client.size <= self.options.pool_min
+            and not self.draining
+        ):
+            return False
+        if not self.draining and self._idle_timeout() != 0:
+            return False
+        self.closed = True
+        self.client.retire(self)
+        return True
+
+
+class PipelinedMllpConnection(PipelineState):
+    # The state (in flight, closed, draining) is guarded by the lock of the
+    # client, and writes by write_lock, so that the frames go out in the
+    # order of the messages in flight
+
+    def __init__(self, client, socket):
+        self.client = client
+        self.options = client.options
+        self.socket = socket
+        self.in_flight = 0  # reserved, sent or not yet
+        self.messages = InFlight(self.options.pipeline_match)
+        self.message_count = 0
+        self.last_update = time.monotonic()
+        self.closed = False
+        self.draining = False  # takes no more messages, closed once done
+        self.write_lock = threading.Lock()
+        self._reader = threading.Thread(
+            target=self._read, daemon=True, name="MllpPipelineReader"
+        )
+
+    def start(self):
+        self._reader.start()
+
+    def send(self, data):
+        waiter = Waiter()
+        control_id = self.messages.control_id(data)
+        try:
+            with self.write_lock:
+                with self.client.lock:
+                    if self.closed:
+                        self.in_flight -= 1
+                        self.client.available.notify()
+                        raise MllpError("MLLP connection closed")
+                    self.messages.append(control_id, waiter)
+                sendall_mllp(self.socket, data)
+        except MllpError:
+            raise
+        except BaseException as e:
+            self.fail(e)
+            raise
+        if not waiter.event.wait(self.options.timeout or None):
+            self.fail(
+                socket.timeout(
+                    "No MLLP response after {}s".format(self.options.timeout)
+                )
+            )
+        # Once failed, the waiter has either its response or its error, both
+        # set with the lock held
+        with self.client.lock:
+            response, error = waiter.response, waiter.error
+        if error is not None:
+            raise error
+        return response
+
+    def fail(self, error):
+        # Closes the connection and fails every message in flight
+        with self.client.lock:
+            if self.closed:
+                return
+            self.closed = True
+            waiters = self.messages.clear()
+            self.in_flight -= len(waiters)
+            for waiter in waiters:
+                waiter.error = error
+            self.client.retire(self)
+        if waiters:
+            logger.error(
+                "MLLP connection failed with %s messages in flight: %s",
+                len(waiters),
+                error,
+            )
+        for waiter in waiters:
+            waiter.event.set()
+        self._close()
+
+    def _close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        logger.info("Disconnected from MLLP Server")
+
+    def _read(self):
+        decoder = MllpDecoder()
+        # Registered once for the life of the connection (select.select
+        # would also fail past FD_SETSIZE descriptors)
+        selector = selectors.DefaultSelector()
+        try:
+            selector.register(self.socket, selectors.EVENT_READ)
+            while True:
+                frame = decoder.next_frame()
+                while frame is not None:
+                    self._deliver(frame)
+                    frame = decoder.next_frame()
+                with self.client.lock:
+                    if self.closed:
+                        return
+                    if self._expire():
+                        break
+                    timeout = self._idle_timeout()
+                if not selector.select(timeout):
+                    continue
+                data = self.socket.recv(self.options.recv_size)
+                if not data:
+                    decoder.close()
+                    raise MllpError("Connection closed by MLLP peer")
+                decoder.feed(data)
+        except (OSError, ValueError, MllpError) as e:
+            self.fail(e)
+            return
+        finally:
+            selector.close()
+        self._close()
+
+    def _deliver(self, response):
+        with self.client.lock:
+            waiter = self.messages.pop(response)
+            self.in_flight -= 1
+            self.last_update = time.monotonic()
+            self.client.available.notify()
+            waiter.response = response
+        waiter.event.set()
+
+
+class AsyncPipelinedMllpClient:
+    # Same as PipelinedMllpClient, for the asyncio engine: one reader task
+    # per connection, and futures instead of threads waiting
+
+    def __init__(self, address, options):
+        self.address = address
+        self.options = options
+        self.connections = []
+        self.size = 0
+        self.waiting = 0
+        self.stats = PoolStats()
+        self.available = asyncio.Condition()
+
+    async def _connect(self):
+        reader, writer = await asyncio.open_connection(*self.address)
+        s = writer.get_extra_info("socket")
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 10)
+        if self.options.no_delay:
+            set_no_delay(s)
+        return AsyncPipelinedMllpConnection(self, reader, writer)
+
+    def _reserve(self):
+        # As PipelinedMllpClient._reserve, without waiting: a connection,
+        # True if a new one may be opened, or None
+        depth = self.options.pipeline_depth
+        connection = min(
+            (c for c in self.connections if not c.draining and c.in_flight < depth),
+            key=lambda c: c.in_flight,
+            default=None,
+        )
+        if connection is not None:
+            connection.reserve()
+            return connection
+        if not 0 <= self.options.pool_max <= self.size:
+            self.size += 1
+            return True
+        return None
+
+    async def acquire(self):
+        connection = self._reserve()
+        if connection is None:
+            self.waiting += 1
+            start = time.monotonic()
+            try:
+                async with self.available:
+                    connection = await asyncio.wait_for(
+                        self.available.wait_for(self._reserve),
+                        self.options.pool_timeout,
+                    )
+            except asyncio.TimeoutError:
+                self.stats.timeouts += 1
+                raise PoolTimeout(
+                    "No MLLP connection available after {}s".format(
+                        self.options.pool_timeout
+                    )
+                )
+            finally:
+                self.waiting -= 1
+                self.stats.waited(time.monotonic() - start)
+        self.stats.acquired += 1
+        if connection is not True:
+            return connection
+        try:
+            if self.options.timeout:
+                connection = await asyncio.wait_for(
+                    self._connect(), self.options.timeout
+                )
+            else:
+                connection = await self._connect()
+        except BaseException:
+            self.size -= 1
+            self.notify()
+            raise
+        self.stats.created += 1
+        connection.reserve()
+        self.connections.append(connection)
+        connection.start()
+        return connection
+
+    async def send(self, data):
+        connection = await self.acquire()
+        return await connection.send(data)
+
+    def notify(self):
+        # Wakes up the senders waiting for room, from a task as notifying
+        # needs the condition lock
+        async def notify():
+            async with self.available:
+                self.available.notify_all()
+
+        if self.waiting:
+            asyncio.ensure_future(notify())
+
+    def retire(self, connection):
+        if connection in self.connections:
+            self.connections.remove(connection)
+            self.size -= 1
+            self.stats.closed += 1
+        self.notify()
+
+    def snapshot(self):
+        idle = sum(1 for c in self.connections if not c.in_flight)
+        return {
+            "size": self.size,
+            "idle": idle,
+            "in_use": self.size - idle,
+            "in_flight": sum(c.in_flight for c in self.connections),
+            "waiting": self.waiting,
+            "max": self.options.pool_max,
+            "created": self.stats.created,
+            "closed": self.stats.closed,
+            "acquired": self.stats.acquired,
+            "timeouts": self.stats.timeouts,
+        }
+
+    async def close(self):
+        for connection in list(self.connections):
+            connection.fail(MllpError("MLLP client closed"))
+
+
+class AsyncPipelinedMllpConnection(PipelineState):
+    def __init__(self, client, reader, writer):
+        self.client = client
+        self.options = client.options
+        self.reader = reader
+        self.writer = writer
+        self.in_flight = 0
+        self.messages = InFlight(self.options.pipeline_match)
+        self.message_count = 0
+        self.last_update = time.monotonic()
+        self.closed = False
+        self.draining = False
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._read())
+
+    async def send(self, data):
+        if self.closed:
+            self.in_flight -= 1
+            self.client.notify()
+            raise MllpError("MLLP connection closed")
+        future = asyncio.get_running_loop().create_future()
+        # Written in the order of the messages in flight: write() does not
+        # wait, only drain() does
+        self.messages.append(self.messages.control_id(data), future)
+        self.writer.write(frame_mllp(data))
+        try:
+            await self.writer.drain()
+            return await asyncio.wait_for(
+                asyncio.shield(future), self.options.timeout or None
+            )
+        except asyncio.TimeoutError:
+            self.fail(
+                asyncio.TimeoutError(
+                    "No MLLP response after {}s".format(self.options.timeout)
+                )
+            )
+            raise
+        except (OSError, MllpError) as e:
+            self.fail(e)
+            raise
+
+    def fail(self, error):
+        if self.closed:
+            return
+        self.closed = True
+        futures = self.messages.clear()
+        self.in_flight -= len(futures)
+        self.client.retire(self)
+        if futures:
+            logger.error(
+                "MLLP connection failed with %s messages in flight: %s",
+                len(futures),
+                error,
+            )
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+        self._close()
+
+    def _close(self):
+        self.writer.close()
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+        logger.info("Disconnected from MLLP Server")
+
+    async def _read(self):
+        decoder = MllpDecoder()
+        try:
+            while True:
+                frame = decoder.next_frame()
+                while frame is not None:
+                    future = self.messages.pop(frame)
+                    self.in_flight -= 1
+                    self.last_update = time.monotonic()
+                    self.client.notify()
+                    if not future.done():
+                        future.set_result(frame)
+                    frame = decoder.next_frame()
+                if self.closed:
+                    return
+                if self._expire():
+                    break
+                try:
+                    data = await asyncio.wait_for(
+                        self.reader.read(self.options.recv_size), self._idle_timeout()
+                    )
+                except asyncio.TimeoutError:
+                    continue
+                if not data:
+                    decoder.close()
+                    raise MllpError("Connection closed by MLLP peer")
+                decoder.feed(data)
+        except (OSError, MllpError) as e:
+            self.fail(e)
+            return
+        self._close()
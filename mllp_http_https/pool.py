@@ -0,0 +1,325 @@
+### Pool of MLLP client connections, shared by http2mllp and https2mllp
+import collections
+import logging
+import socket
+import threading
+import time
+
+from .mllp import MllpReader, send_mllp, sendall_mllp_parts
+from .net import set_no_delay
+
+logger = logging.getLogger(__name__)
+
+# Seconds before opening the pool_min connections again, after failing to
+FILL_RETRY = 5
+
+
+class MllpClientOptions:
+    def __init__(
+        self,
+        keep_alive,
+        max_messages,
+        timeout,
+        recv_size=64 * 1024,
+        no_delay=False,
+        pool_min=0,
+        pool_max=-1,
+        pool_timeout=None,
+        stats_interval=0,
+        pipeline_depth=1,
+        pipeline_match="fifo",
+        ack_cache_size=0,
+        ack_cache_ttl=300,
+        breaker=None,
+    ):
+        # keep_alive: idle seconds before a connection is closed, or unlimited
+        # if negative or None (0 closes connections after each message)
+        self.keep_alive = keep_alive
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self.recv_size = recv_size
+        self.no_delay = no_delay
+        # Connections kept open even when idle, and open connections at most
+        # (unlimited if -1)
+        self.pool_min = pool_min
+        self.pool_max = pool_max
+        # Seconds to wait for a connection when the pool is exhausted, or
+        # unlimited if None
+        self.pool_timeout = pool_timeout
+        # Seconds between pool statistics log lines, or never if 0
+        self.stats_interval = stats_interval
+        # Messages in flight per connection: above 1, messages are written
+        # without waiting for the previous response (see pipeline.py), and
+        # responses matched "fifo" or by "control-id"
+        self.pipeline_depth = pipeline_depth
+        self.pipeline_match = pipeline_match
+        # ACKs kept for retried messages (see replay.py), or none if 0, and
+        # seconds they are kept for
+        self.ack_cache_size = ack_cache_size
+        self.ack_cache_ttl = ack_cache_ttl
+        # breaker.BreakerOptions to fail fast while the MLLP server is
+        # failing, or None to always wait for it
+        self.breaker = breaker
+
+    @property
+    def streaming(self):
+        # Whether messages can be streamed (MllpClient.stream), which needs
+        # a connection of their own: not with pipelining or the ACK cache
+        return self.pipeline_depth <= 1 and not self.ack_cache_size
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PoolStats:
+    def __init__(self):
+        self.created = 0
+        self.closed = 0
+        self.acquired = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def waited(self, seconds):
+        self.waits += 1
+        self.wait_time += seconds
+        self.max_wait_time = max(self.max_wait_time, seconds)
+
+
+class MllpClient:
+    # Bounded pool of MLLP connections. Idle connections are reused most
+    # recently used first, so the least used ones are the first to expire.
+    # When pool_max connections are in use, senders wait (up to
+    # pool_timeout) for one to be released. A single reaper thread closes
+    # expired and recycled connections, and keeps pool_min open: idle
+    # connections are in the order they were released, so the oldest one
+    # is the next to expire.
+
+    def __init__(self, address, options):
+        self.address = address
+        self.options = options
+        self.connections = collections.deque()  # idle, most recently used last
+        self.size = 0  # open (or opening) connections, idle or in use
+        self.waiting = 0
+        self.stats = PoolStats()
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        self._reaper_wakeup = threading.Condition(self.lock)
+        self._retired = []  # connections for the reaper to close
+        self._reaper = threading.Thread(
+            target=self._reap, daemon=True, name="MllpPoolReaper"
+        )
+        self._reaper.start()
+
+    def _connect(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.options.timeout:
+            s.settimeout(self.options.timeout)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 10)
+        if self.options.no_delay:
+            set_no_delay(s)
+        try:
+            s.connect(self.address)
+        except BaseException:
+            s.close()
+            raise
+        return MllpConnection(s, self.options.recv_size)
+
+    def acquire(self):
+        with self.lock:
+            start = None
+            while not self.connections and 0 <= self.options.pool_max <= self.size:
+                if start is None:
+                    start = time.monotonic()
+                    remaining = self.options.pool_timeout
+                elif self.options.pool_timeout is not None:
+                    remaining = self.options.pool_timeout - (time.monotonic() - start)
+                if remaining is not None and remaining <= 0:
+                    self.stats.timeouts += 1
+                    self.stats.waited(time.monotonic() - start)
+                    raise PoolTimeout(
+                        "No MLLP connection available after {}s ({} in use)".format(
+                            self.options.pool_timeout, self.size
+                        )
+                    )
+                self.waiting += 1
+                try:
+                    self.available.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            if start is not None:
+                self.stats.waited(time.monotonic() - start)
+            self.stats.acquired += 1
+            if self.connections:
+                return self.connections.pop()
+            self.size += 1
+        try:
+            connection = self._connect()
+        except BaseException:
+            with self.lock:
+                self.size -= 1
+                self.available.notify()
+            raise
+        with self.lock:
+            self.stats.created += 1
+        return connection
+
+    def release(self, connection, reuse=True):
+        keep_alive = self.options.keep_alive
+        if connection.message_count >= self.options.max_messages >= 0:
+            # Recycle the connection
+            reuse = False
+        if keep_alive == 0 and self.options.pool_min <= 0:
+            reuse = False
+        with self.lock:
+            if reuse:
+                connection.last_update = time.monotonic()
+                self.connections.append(connection)
+                if len(self.connections) == 1:
+                    # The oldest idle connection, that the reaper waits for
+                    self._reaper_wakeup.notify()
+            else:
+                self.size -= 1
+                self._retired.append(connection)
+                self._reaper_wakeup.notify()
+            self.available.notify()
+
+    def send(self, data):
+        connection = self.acquire()
+        try:
+            response = connection.send(data)
+        except BaseException:
+            # The connection may be out of sync, do not reuse it
+            self.release(connection, reuse=False)
+            raise
+        self.release(connection)
+        return response
+
+    def stream(self, parts):
+        # Same as send, for a message given in parts (any iterable of bytes,
+        # sent as they come): yields the parts of the response as they are
+        # received. Nothing is sent before the first part is asked for, and
+        # the connection is not reused if the response is not read to its end.
+        connection = self.acquire()
+        reuse = False
+        try:
+            yield from connection.stream(parts)
+            reuse = True
+        finally:
+            self.release(connection, reuse=reuse)
+
+    def snapshot(self):
+        # Pool occupancy and wait statistics
+        with self.lock:
+            stats = self.stats
+            return {
+                "size": self.size,
+                "idle": len(self.connections),
+                "in_use": self.size - len(self.connections),
+                "waiting": self.waiting,
+                "max": self.options.pool_max,
+                "created": stats.created,
+                "closed": stats.closed,
+                "acquired": stats.acquired,
+                "waits": stats.waits,
+                "timeouts": stats.timeouts,
+                "wait_time": stats.wait_time,
+                "max_wait_time": stats.max_wait_time,
+            }
+
+    def _deadline(self):
+        # When the oldest idle connection expires, or None if it does not
+        # (kept for pool_min, or no keep-alive limit)
+        keep_alive = self.options.keep_alive
+        if (
+            not self.connections
+            or self.size <= self.options.pool_min
+            or keep_alive is None
+            or keep_alive < 0
+        ):
+            return None
+        return self.connections[0].last_update + keep_alive
+
+    def _reap(self):
+        stats_interval = self.options.stats_interval
+        next_stats = time.monotonic() + stats_interval if stats_interval else None
+        next_fill = time.monotonic()  # None while pool_min connections are open
+        while True:
+            if next_fill is not None and next_fill <= time.monotonic():
+                next_fill = None if self._fill() else time.monotonic() + FILL_RETRY
+            with self.lock:
+                now = time.monotonic()
+                expired, self._retired = self._retired, []
+                deadline = self._deadline()
+                while deadline is not None and deadline <= now:
+                    expired.append(self.connections.popleft())
+                    self.size -= 1
+                    deadline = self._deadline()
+                self.stats.closed += len(expired)
+                if next_fill is None and self.size < self.options.pool_min:
+                    # Connections closed or failed since
+                    next_fill = now
+                if not expired and (next_fill is None or now < next_fill):
+                    timeouts = [
+                        t - now
+                        for t in (deadline, next_fill, next_stats)
+                        if t is not None
+                    ]
+                    self._reaper_wakeup.wait(min(timeouts) if timeouts else None)
+            for connection in expired:
+                connection.close()
+            if next_stats is not None and next_stats <= time.monotonic():
+                logger.info("MLLP pool: %s", self.snapshot())
+                next_stats = time.monotonic() + stats_interval
+
+    def _fill(self):
+        # Opens the pool_min connections kept warm. Returns False if one
+        # could not be opened.
+        while True:
+            with self.lock:
+                if self.options.pool_min <= self.size:
+                    return True
+                self.size += 1
+            try:
+                connection = self._connect()
+            except Exception as e:
+                logger.warning("Could not open MLLP connection: %s", e)
+                with self.lock:
+                    self.size -= 1
+                    self.available.notify()
+                return False
+            with self.lock:
+                self.stats.created += 1
+            self.release(connection)
+
+
+class MllpConnection:
+    def __init__(self, socket, recv_size):
+        self.closed = False
+        self.last_update = None
+        self.message_count = 0
+        self.socket = socket
+        self.reader = MllpReader(socket, recv_size)
+
+    def close(self):
+        self.closed = True
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        logger.info("Disconnected from MLLP Server")
+
+    def send(self, data):
+        self.message_count += 1
+
+        # To send the HL7 messages, it will make use of an MLLP parser to format the data
+        # The parser will return the ACK/NACK response
+        return send_mllp(self.socket, data, self.reader)
+
+    def stream(self, parts):
+        self.message_count += 1
+        sendall_mllp_parts(self.socket, parts)
+        return self.reader.read_parts()
@@ -0,0 +1,178 @@
+### ACK replay cache for http2mllp and https2mllp: a message retried by the
+### HTTP client (same sender and MSH-10 control ID) gets back the ACK of the
+### first attempt instead of being sent to the MLLP server again
+import asyncio
+import collections
+import logging
+import threading
+import time
+
+from . import hl7, metrics
+
+logger = logging.getLogger(__name__)
+
+# Only accepted messages are replayed: a rejected one may succeed if retried
+REPLAYED_ACK_CODES = (b"AA", b"CA")
+
+
+class AckCache:
+    # Least recently used ACKs by hl7.replay_key, at most max_size of them,
+    # each for ttl seconds after it was received
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()  # key: (expiry, ack)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self.entries[key]
+                metrics.ACK_CACHE.inc("expired")
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, ack):
+        if hl7.ack_code(ack) not in REPLAYED_ACK_CODES:
+            return
+        now = time.monotonic()
+        with self.lock:
+            self.entries[key] = (now + self.ttl, ack)
+            self.entries.move_to_end(key)
+            while self.entries:
+                oldest = next(iter(self.entries.values()))
+                if self.max_size < len(self.entries):
+                    metrics.ACK_CACHE.inc("evicted")
+                elif now < oldest[0]:
+                    break
+                else:
+                    metrics.ACK_CACHE.inc("expired")
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class Flight:
+    # A message being sent, that duplicates received meanwhile wait for
+    def __init__(self):
+        self.event = threading.Event()
+        self.ack = None
+        self.error = None
+
+
+class ReplayingMllpClient:
+    # Wraps an MLLP client (MllpClient or PipelinedMllpClient). Messages are
+    # looked up by sender and control ID: a cached ACK is returned at once,
+    # a message already being sent waits for that ACK (single flight), and
+    # other messages are sent. Messages without a control ID are always
+    # sent.
+
+    def __init__(self, client, cache):
+        self.client = client
+        self.cache = cache
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def send(self, data):
+        key = hl7.replay_key(data)
+        if key is None:
+            return self.client.send(data)
+        with self.lock:
+            ack = self.cache.get(key)
+            if ack is None:
+                flight = self.flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self.flights[key] = Flight()
+        if ack is not None:
+            metrics.ACK_CACHE.inc("hit")
+            logger.info(
+                "Replaying the ACK of message %s", key[2].decode(errors="replace")
+            )
+            return ack
+        if not leader:
+            metrics.ACK_CACHE.inc("coalesced")
+            logger.info(
+                "Waiting for the ACK of message %s, already being sent",
+                key[2].decode(errors="replace"),
+            )
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.ack
+
+        metrics.ACK_CACHE.inc("miss")
+        try:
+            flight.ack = self.client.send(data)
+            self.cache.put(key, flight.ack)
+            return flight.ack
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.event.set()
+
+    def snapshot(self):
+        return self.client.snapshot()
+
+
+class AsyncReplayingMllpClient:
+    # Same as ReplayingMllpClient, for the asyncio clients
+
+    def __init__(self, client, cache):
+        self.client = client
+        self.cache = cache
+        self.flights = {}  # key: future of the ACK
+
+    async def send(self, data):
+        key = hl7.replay_key(data)
+        if key is None:
+            return await self.client.send(data)
+        ack = self.cache.get(key)
+        if ack is not None:
+            metrics.ACK_CACHE.inc("hit")
+            logger.info(
+                "Replaying the ACK of message %s", key[2].decode(errors="replace")
+            )
+            return ack
+        flight = self.flights.get(key)
+        if flight is not None:
+            metrics.ACK_CACHE.inc("coalesced")
+            logger.info(
+                "Waiting for the ACK of message %s, already being sent",
+                key[2].decode(errors="replace"),
+            )
+            return await asyncio.shield(flight)
+
+        metrics.ACK_CACHE.inc("miss")
+        flight = self.flights[key] = asyncio.get_running_loop().create_future()
+        try:
+            ack = await self.client.send(data)
+        except asyncio.CancelledError:
+            flight.cancel()
+            raise
+        except BaseException as e:
+            flight.set_exception(e)
+            # Retrieved by the duplicates, if any
+            flight.exception()
+            raise
+        else:
+            self.cache.put(key, ack)
+            flight.set_result(ack)
+            return ack
+        finally:
+            del self.flights[key]
+
+    def snapshot(self):
+        return self.client.snapshot()
+
+    async def close(self):
+        await self.client.close()
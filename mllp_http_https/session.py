@@ -0,0 +1,140 @@
+### Outbound HTTP(S) connection pools shared by the MLLP connections of
+### mllp2http and mllp2https
+import logging
+import os
+import ssl
+import threading
+import time
+import urllib
+
+import requests
+import requests.adapters
+import requests.certs
+
+logger = logging.getLogger(__name__)
+
+
+class ResumingSSLSocket(ssl.SSLSocket):
+    def _real_close(self):
+        # TLS 1.3 tickets arrive after the handshake, keep the latest one
+        self.context.save_session(self)
+        super()._real_close()
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    # Client context that resumes the last TLS session to the same host, so
+    # that new connections to the backend skip the full handshake
+    sslsocket_class = ResumingSSLSocket
+
+    def __init__(self, protocol=ssl.PROTOCOL_TLS_CLIENT):
+        self.sessions = {}
+
+    def wrap_socket(
+        self,
+        sock,
+        server_side=False,
+        do_handshake_on_connect=True,
+        suppress_ragged_eofs=True,
+        server_hostname=None,
+        session=None,
+    ):
+        if session is None and not server_side:
+            session = self.sessions.get(server_hostname)
+        s = super().wrap_socket(
+            sock,
+            server_side=server_side,
+            do_handshake_on_connect=do_handshake_on_connect,
+            suppress_ragged_eofs=suppress_ragged_eofs,
+            server_hostname=server_hostname,
+            session=session,
+        )
+        if do_handshake_on_connect:
+            self.save_session(s)
+        return s
+
+    def save_session(self, s):
+        if s.server_side or s.server_hostname is None:
+            return
+        session = s.session
+        version = s.version()
+        if session is not None and (session.has_ticket or version != "TLSv1.3"):
+            self.sessions[s.server_hostname] = session
+
+
+def session_ssl_context(verify):
+    # SSL context equivalent to the verify argument of requests: True (the
+    # requests CA bundle), False, or a path to a CA bundle file or directory.
+    # Built once, instead of loading the CA bundle on every connection.
+    context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    if verify is False:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    elif verify is True:
+        context.load_verify_locations(cafile=requests.certs.where())
+    elif os.path.isdir(verify):
+        context.load_verify_locations(capath=verify)
+    else:
+        context.load_verify_locations(cafile=verify)
+    return context
+
+
+class PooledAdapter(requests.adapters.HTTPAdapter):
+    # Keep-alive connections to a single backend. Connections are closed
+    # once the pool has been idle for max_idle seconds (never, if None).
+
+    def __init__(self, pool_size, max_idle=None, verify=True):
+        self.max_idle = max_idle
+        self.verify = verify
+        self.ssl_context = session_ssl_context(verify)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.last_used = time.monotonic()
+        super().__init__(pool_connections=1, pool_maxsize=pool_size)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["ssl_context"] = self.ssl_context
+        super().init_poolmanager(*args, **kwargs)
+
+    def build_connection_pool_key_attributes(self, request, verify, cert=None):
+        # Every request uses the SSL context of the adapter
+        host_params, _ = super().build_connection_pool_key_attributes(
+            request, verify, cert
+        )
+        cert_reqs = "CERT_NONE" if self.verify is False else "CERT_REQUIRED"
+        return host_params, {"ssl_context": self.ssl_context, "cert_reqs": cert_reqs}
+
+    def cert_verify(self, conn, url, verify, cert):
+        # Already in the SSL context
+        pass
+
+    def send(self, request, **kwargs):
+        with self.lock:
+            idle = time.monotonic() - self.last_used
+            if self.max_idle is not None and not self.active and self.max_idle < idle:
+                logger.info("Closing HTTP connections idle for %.1fs", idle)
+                self.poolmanager.clear()
+            self.active += 1
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.last_used = time.monotonic()
+
+
+_adapters = {}
+_adapters_lock = threading.Lock()
+
+
+def shared_session(url, pool_size=10, max_idle=None, verify=True):
+    # Session for one MLLP connection. Its connections to the url come from
+    # a pool shared by every session to the same url and settings.
+    prefix = urllib.parse.urlunparse(url[:2] + ("", "", "", ""))
+    key = (prefix, pool_size, max_idle, verify)
+    with _adapters_lock:
+        adapter = _adapters.get(key)
+        if adapter is None:
+            adapter = _adapters[key] = PooledAdapter(pool_size, max_idle, verify)
+    session = requests.Session()
+    session.mount(prefix, adapter)
+    return session
@@ -0,0 +1,424 @@
+### Store-and-forward queue of mllp2http and mllp2https: each message is
+### appended to an on-disk log and acknowledged to the MLLP sender, then
+### delivered to the HTTP(S) server by background workers, with retries
+import json
+import logging
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+
+from . import hl7, metrics
+from .log2file import log_payload
+
+logger = logging.getLogger(__name__)
+
+# Record header: marker, length of the metadata, length of the message and
+# CRC-32 of both, followed by the metadata and the message. Segments are
+# created filled with zeros, so a zero marker is the end of the data.
+RECORD = struct.Struct(">BIII")
+MARKER = 0x01
+
+CHECKPOINT = "checkpoint"
+
+# Seconds between delivery attempts of a message, doubled after each failure
+BACKOFF_MIN = 0.1
+BACKOFF_MAX = 30
+
+
+def fsync_policy(arg):
+    # Validates an fsync policy, for the command line: "always" (before the
+    # ACK is sent), "never" (left to the OS), or milliseconds between flushes
+    if arg in ("always", "never") or arg.isdigit():
+        return arg
+    raise ValueError(arg)
+
+
+class SpoolOptions:
+    def __init__(
+        self, directory, fsync="always", workers=4, segment_size=64 * 1024 * 1024
+    ):
+        self.directory = directory
+        self.fsync = fsync
+        # Messages delivered at the same time
+        self.workers = workers
+        # Bytes per log file (more for a larger message)
+        self.segment_size = segment_size
+
+
+class Rejected(Exception):
+    # Raised by the deliver function for a message that is not retried
+    pass
+
+
+def retryable(status):
+    # Whether an HTTP error status may succeed if the message is sent again
+    return status in (408, 425, 429) or 500 <= status
+
+
+def fsync_directory(directory):
+    # Makes the entries of directory (created, renamed files) durable
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def allocate(fd, size):
+    # Sizes a new segment with its blocks reserved: writing to a page of a
+    # sparse file through the memory map when the disk is full would kill
+    # the process with SIGBUS, instead of raising OSError (ENOSPC) here
+    if hasattr(os, "posix_fallocate"):
+        os.posix_fallocate(fd, 0, size)
+    else:
+        os.ftruncate(fd, size)
+
+
+class Segment:
+    # Memory-mapped log file, named after the queue offset of its first byte
+
+    def __init__(self, directory, base, size=None):
+        self.base = base
+        self.path = os.path.join(directory, "%020d.log" % base)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        try:
+            if size is not None:
+                try:
+                    allocate(fd, size)
+                    os.fsync(fd)
+                except OSError:
+                    os.remove(self.path)
+                    raise
+            self.size = os.fstat(fd).st_size
+            self.map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        self.end = 0  # end of the records
+        self.flushed = 0
+
+    def read(self, position):
+        # (metadata, message, position of the next record) of the record at
+        # position, or None at the end of the records
+        if self.end < position + RECORD.size:
+            return None
+        marker, meta_length, length, crc = RECORD.unpack_from(self.map, position)
+        start = position + RECORD.size
+        end = start + meta_length + length
+        if marker != MARKER or self.end < end:
+            return None
+        data = self.map[start:end]
+        if zlib.crc32(data) != crc:
+            return None
+        return data[:meta_length], data[meta_length:], end
+
+    def scan(self, position):
+        # Finds the end of the records from position, after a restart; a
+        # torn record at the end is erased. Returns the number of records.
+        self.end = self.size
+        count = 0
+        record = self.read(position)
+        while record is not None:
+            position = record[2]
+            count += 1
+            record = self.read(position)
+        if position < self.size and self.map[position]:
+            logger.warning("Erasing an incomplete record at %s", self.base + position)
+            self.map[position:] = bytes(self.size - position)
+        self.end = self.flushed = position
+        return count
+
+    def write(self, meta, message):
+        # Appends a record, the header last
+        position = self.end
+        start = position + RECORD.size
+        data = meta + message
+        self.map[start : start + len(data)] = data
+        RECORD.pack_into(
+            self.map, position, MARKER, len(meta), len(message), zlib.crc32(data)
+        )
+        self.end = start + len(data)
+        return position
+
+    def flush(self):
+        end = self.end
+        if self.flushed < end:
+            start = self.flushed - self.flushed % mmap.ALLOCATIONGRANULARITY
+            self.map.flush(start, end - start)
+            self.flushed = end
+
+    def remove(self):
+        self.map.close()
+        os.remove(self.path)
+
+
+class Spool:
+    # Append-only log of segments. Offsets are positions in the sequence of
+    # segments: each segment starts where the previous one ends. Workers
+    # take the records in order, and the checkpoint file keeps the offset
+    # before which every record was delivered, so that delivery resumes
+    # there after a restart (records delivered after it are sent again).
+
+    def __init__(self, directory, options):
+        self.directory = directory
+        self.options = options
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        self.flush_lock = threading.Lock()
+        self.checkpoint_lock = threading.Lock()
+        self.segments = []  # oldest first, appended to the last one
+        self.in_flight = set()  # offsets of the records being delivered
+        self.pending = 0
+        self.appended = 0
+        self.delivered = 0
+        self.retries = 0
+        self.rejected = 0
+        os.makedirs(directory, exist_ok=True)
+        self.checkpoint = self.saved = self._read_checkpoint()
+        self.cursor = self.checkpoint  # offset of the next record to deliver
+        self._recover()
+
+    def _read_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT)) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_checkpoint(self, checkpoint):
+        # Replaced atomically: the new file is on disk before the rename,
+        # and the rename once the directory is synced (unless fsync is
+        # "never")
+        path = os.path.join(self.directory, CHECKPOINT)
+        sync = self.options.fsync != "never"
+        with open(path + ".tmp", "w") as f:
+            f.write(str(checkpoint))
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        if sync:
+            fsync_directory(self.directory)
+
+    def _recover(self):
+        bases = sorted(
+            int(name[:-4])
+            for name in os.listdir(self.directory)
+            if name.endswith(".log") and name[:-4].isdigit()
+        )
+        for base in bases:
+            path = os.path.join(self.directory, "%020d.log" % base)
+            if not os.path.getsize(path):
+                # Created but not sized yet when the process stopped
+                logger.warning("Removing empty segment %s", path)
+                os.remove(path)
+                continue
+            segment = Segment(self.directory, base)
+            if segment.base + segment.size <= self.checkpoint:
+                segment.remove()
+                continue
+            self.pending += segment.scan(max(0, self.checkpoint - segment.base))
+            self.segments.append(segment)
+        if self.segments and self.checkpoint < self.segments[0].base:
+            self.checkpoint = self.cursor = self.segments[0].base
+        if self.pending:
+            logger.info("%s queued messages to deliver", self.pending)
+
+    def append(self, meta, message):
+        # Stores a record, flushed to disk before returning if fsync is
+        # "always"
+        size = RECORD.size + len(meta) + len(message)
+        with self.lock:
+            segment = self.segments[-1] if self.segments else None
+            if segment is None or segment.size < segment.end + size:
+                base = segment.base + segment.size if segment else self.checkpoint
+                segment = Segment(
+                    self.directory, base, max(self.options.segment_size, size)
+                )
+                if self.options.fsync != "never":
+                    fsync_directory(self.directory)
+                self.segments.append(segment)
+            segment.write(meta, message)
+            self.pending += 1
+            self.appended += 1
+            self.available.notify()
+        if self.options.fsync == "always":
+            # Group commit: one flush covers the records appended meanwhile
+            with self.flush_lock:
+                if not segment.map.closed:
+                    segment.flush()
+
+    def flush(self):
+        with self.lock:
+            segments = list(self.segments)
+        with self.flush_lock:
+            for segment in segments:
+                if not segment.map.closed:
+                    segment.flush()
+
+    def _read(self):
+        # Next record from the cursor, as (metadata, message, offset of the
+        # record after it), or None
+        for segment in self.segments:
+            if segment.base + segment.size <= self.cursor:
+                continue
+            # The cursor moves to the next segment at the end of the records
+            self.cursor = max(self.cursor, segment.base)
+            record = segment.read(self.cursor - segment.base)
+            if record is not None:
+                meta, message, end = record
+                return meta, message, segment.base + end
+        return None
+
+    def take(self):
+        # (offset, metadata, message) of the next record to deliver
+        with self.lock:
+            record = self._read()
+            while record is None:
+                self.available.wait()
+                record = self._read()
+            meta, message, end = record
+            offset, self.cursor = self.cursor, end
+            self.in_flight.add(offset)
+            return offset, meta, message
+
+    def done(self, offset):
+        with self.lock:
+            self.in_flight.discard(offset)
+            self.pending -= 1
+            self.delivered += 1
+            checkpoint = min(self.in_flight) if self.in_flight else self.cursor
+            if checkpoint == self.checkpoint:
+                return
+            self.checkpoint = checkpoint
+        self._save_checkpoint()
+
+    def _save_checkpoint(self):
+        # Writes the checkpoint without holding the lock, that append()
+        # needs: one write covers the deliveries done while another was
+        # being written. Segments are removed once it is on disk.
+        with self.checkpoint_lock:
+            with self.lock:
+                checkpoint = self.checkpoint
+                if checkpoint == self.saved:
+                    return
+                removed = []
+                while 1 < len(self.segments) and (
+                    self.segments[0].base + self.segments[0].size <= checkpoint
+                ):
+                    removed.append(self.segments.pop(0))
+            self._write_checkpoint(checkpoint)
+            self.saved = checkpoint
+        with self.flush_lock:
+            for segment in removed:
+                segment.remove()
+
+    def start(self, deliver):
+        # Starts the workers delivering the records with deliver(message,
+        # meta), which raises Rejected if the message is not to be retried
+        for i in range(self.options.workers):
+            threading.Thread(
+                target=self._drain,
+                args=(deliver,),
+                daemon=True,
+                name="SpoolWorker-%d" % i,
+            ).start()
+        if self.options.fsync not in ("always", "never"):
+            threading.Thread(
+                target=self._flush_periodically, daemon=True, name="SpoolFlush"
+            ).start()
+
+    def _drain(self, deliver):
+        while True:
+            offset, meta, message = self.take()
+            delay = BACKOFF_MIN
+            while True:
+                try:
+                    deliver(message, meta)
+                except Rejected as e:
+                    with self.lock:
+                        self.rejected += 1
+                    logger.error(
+                        "Queued message %s rejected, not retried: %s", offset, e
+                    )
+                    log_payload(logger, "Rejected Data", message)
+                except Exception as e:
+                    with self.lock:
+                        self.retries += 1
+                    logger.warning(
+                        "Delivery of queued message %s failed, retrying in %.1fs: %s",
+                        offset,
+                        delay,
+                        e,
+                    )
+                    time.sleep(delay * random.uniform(0.5, 1))
+                    delay = min(delay * 2, BACKOFF_MAX)
+                    continue
+                break
+            self.done(offset)
+
+    def _flush_periodically(self):
+        interval = int(self.options.fsync) / 1000
+        while True:
+            time.sleep(interval)
+            self.flush()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "pending": self.pending,
+                "in_flight": len(self.in_flight),
+                "bytes": sum(segment.size for segment in self.segments),
+                "appended": self.appended,
+                "delivered": self.delivered,
+                "retries": self.retries,
+                "rejected": self.rejected,
+            }
+
+
+def open_spool(options, deliver):
+    # Spool of this process (of each worker, with --workers), delivering
+    # with deliver
+    from .workers import worker_index
+
+    directory = options.directory
+    if worker_index() is not None:
+        directory = os.path.join(directory, "worker-%d" % worker_index())
+    spool = Spool(directory, options)
+    metrics.REGISTRY.register(metrics.SpoolGauge("mllp_bridge_queue", spool))
+    spool.start(deliver)
+    logger.info("Queueing messages in %s", directory)
+    return spool
+
+
+def metadata(local_address, remote_address):
+    return json.dumps(
+        {"local": local_address[:2], "remote": remote_address[:2]}
+    ).encode()
+
+
+def addresses(meta):
+    # (local address, remote address) of the MLLP connection of a record
+    meta = json.loads(meta)
+    return tuple(meta["local"]), tuple(meta["remote"])
+
+
+def store(spool, message, local_address, remote_address):
+    # Queues a received message. Returns the ACK to send back, or None if
+    # the message could not be stored.
+    metrics.MESSAGES.inc()
+    metrics.BYTES.inc("in", value=len(message))
+    logger.info("Message: %s bytes", len(message))
+    log_payload(logger, "Received Data", message)
+    try:
+        spool.append(metadata(local_address, remote_address), message)
+    except Exception as e:
+        metrics.ERRORS.inc("queue")
+        logger.error("Failed to queue MLLP message: %s", e)
+        return None
+    ack = hl7.ack(message)
+    metrics.BYTES.inc("out", value=len(ack))
+    return ack
@@ -0,0 +1,218 @@
+### Streaming pass-through of http2mllp and https2mllp: large or chunked
+### request bodies are sent to MLLP in parts as they are read, and the
+### response written back in parts as it is received, so a request never
+### holds a whole message in memory
+import itertools
+import logging
+import time
+
+from . import compression, metrics
+from .asynchttp import (
+    LAST_CHUNK,
+    chunk,
+    chunked_parts,
+    chunked_parts_async,
+    response_head,
+    write_part,
+)
+from .breaker import open_breaker
+from .mllp import PartParser
+
+logger = logging.getLogger(__name__)
+
+
+def stream_threshold(options, mllp_options):
+    # options.stream_threshold, or None if the MLLP client cannot stream
+    if options.stream_threshold is not None and not mllp_options.streaming:
+        logger.warning(
+            "Streaming is not available with MLLP pipelining or the ACK cache"
+        )
+        return None
+    return options.stream_threshold
+
+
+def mllp_breaker(mllp_address, mllp_options):
+    # Circuit breaker of the MLLP server, inside the ACK cache so that
+    # cached ACKs are still replayed while it is open
+    return open_breaker("MLLP server {}:{}".format(*mllp_address), mllp_options.breaker)
+
+
+class StreamMixIn:
+    # For the handlers of the threaded engine (BaseHTTPRequestHandler), with
+    # mllp_client, content_type, keep_alive, mllp_response and compression
+
+    def date_header(self):
+        # Date header of the streamed responses, besides the one of
+        # send_response, or None
+        return None
+
+    def body_parts(self, content_length):
+        # The request body, decompressed, in parts as it is read: chunked if
+        # content_length is None
+        if content_length is None:
+            parts = chunked_parts(self.rfile)
+        else:
+            parts = compression.read_parts(self.rfile, content_length)
+        return compression.decode_parts(
+            parts, self.headers.get("Content-Encoding"), self.compression
+        )
+
+    def stream(self, content_length, account):
+        # The response is chunked (until the connection is closed, for
+        # HTTP/1.0). Streamed responses are not compressed, nor their
+        # payload logged. Each part of the body and of the response is held
+        # in account (a budget.Account) until it is sent.
+        keep_open = not self.close_connection
+        # The connection is not reused if the exchange does not complete
+        self.close_connection = True
+        parts = self.body_parts(content_length)
+        size = 0
+        sent = None
+
+        def body():
+            nonlocal size, sent
+            start = time.perf_counter()
+            for part in parts:
+                account.take(len(part))
+                size += len(part)
+                yield part
+                account.release(len(part))
+            sent = time.perf_counter()
+            metrics.BODY_READ.observe(sent - start)
+            metrics.MESSAGES.inc()
+            metrics.BYTES.inc("in", value=size)
+            logger.info("Message: %s bytes (streamed)", size)
+
+        response = self.mllp_client.stream(body())
+        try:
+            # Send data to MLLP Listener and wait for the first part of the
+            # MLLP ACK response
+            first = next(response, b"")
+            metrics.MLLP_ROUND_TRIP.observe(time.perf_counter() - sent)
+
+            start = time.perf_counter()
+            chunked = (
+                self.protocol_version == "HTTP/1.1"
+                and self.request_version == "HTTP/1.1"
+            )
+            self.send_response(200)
+            if chunked:
+                self.send_header("Transfer-Encoding", "chunked")
+            if self.content_type:
+                self.send_header("Content-Type", self.content_type)
+            if self.keep_alive is not None:
+                self.send_header("Keep-Alive", f"timeout={self.keep_alive}")
+            date = self.date_header()
+            if date is not None:
+                self.send_header(*date)
+            self.end_headers()
+
+            out = 0
+            parts = itertools.chain((first,), response)
+            for part in PartParser(self.mllp_response).body(parts):
+                if part:
+                    account.add(len(part))
+                    out += len(part)
+                    self.wfile.write(chunk(part) if chunked else part)
+                    account.release(len(part))
+            if chunked:
+                self.wfile.write(LAST_CHUNK)
+        finally:
+            response.close()
+        metrics.RESPONSE_WRITE.observe(time.perf_counter() - start)
+        metrics.BYTES.inc("out", value=out)
+        logger.info("Response: %s bytes (streamed)", out)
+        self.close_connection = not (keep_open and chunked)
+
+
+class AsyncStreamMixIn:
+    # Same as StreamMixIn, for the handlers of the asyncio engine, with
+    # timeout as well
+
+    def date_header(self):
+        # Date header of the streamed responses, in place of the default
+        # one, or None
+        return None
+
+    def body_parts(self, reader, request, length):
+        # Same as StreamMixIn.body_parts, from an asyncio stream
+        if length is None:
+            parts = chunked_parts_async(reader, timeout=self.timeout)
+        else:
+            parts = compression.read_parts_async(reader, length, timeout=self.timeout)
+        return compression.decode_parts_async(
+            parts, request.headers.get("content-encoding"), self.compression
+        )
+
+    async def stream(self, reader, writer, request, length, account):
+        # Same as StreamMixIn.stream. Returns whether the connection can be
+        # reused.
+        if request.headers.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        parts = self.body_parts(reader, request, length)
+        size = 0
+        sent = None
+
+        async def body():
+            nonlocal size, sent
+            start = time.perf_counter()
+            async for part in parts:
+                account.take(len(part))
+                size += len(part)
+                yield part
+                account.release(len(part))
+            sent = time.perf_counter()
+            metrics.BODY_READ.observe(sent - start)
+            metrics.MESSAGES.inc()
+            metrics.BYTES.inc("in", value=size)
+            logger.info("Message: %s bytes (streamed)", size)
+
+        response = self.mllp_client.stream(body())
+        try:
+            # Send data to MLLP Listener and wait for the first part of the
+            # MLLP ACK response
+            try:
+                first = await response.__anext__()
+            except StopAsyncIteration:
+                first = b""
+            metrics.MLLP_ROUND_TRIP.observe(time.perf_counter() - sent)
+
+            start = time.perf_counter()
+            chunked = request.version == "HTTP/1.1"
+            keep_alive = chunked and request.keep_alive
+            headers = [("Transfer-Encoding", "chunked")] if chunked else []
+            if self.content_type:
+                headers.append(("Content-Type", self.content_type))
+            if self.keep_alive is not None:
+                headers.append(("Keep-Alive", f"timeout={self.keep_alive}"))
+            date = self.date_header()
+            if date is not None:
+                headers.append(date)
+            if not keep_alive:
+                headers.append(("Connection", "close"))
+            writer.write(response_head(200, headers, date=date is None))
+
+            parser = PartParser(self.mllp_response)
+            out = await write_held(
+                writer, parser.head() + parser.parse(first), chunked, account
+            )
+            async for part in response:
+                out += await write_held(writer, parser.parse(part), chunked, account)
+            out += await write_held(writer, parser.tail(), chunked, account)
+            if chunked:
+                writer.write(LAST_CHUNK)
+                await writer.drain()
+        finally:
+            await response.aclose()
+        metrics.RESPONSE_WRITE.observe(time.perf_counter() - start)
+        metrics.BYTES.inc("out", value=out)
+        logger.info("Response: %s bytes (streamed)", out)
+        return keep_alive
+
+
+async def write_held(writer, data, chunked, account):
+    # write_part, with data held in account until it is sent
+    account.add(len(data))
+    size = await write_part(writer, data, chunked)
+    account.release(len(data))
+    return size
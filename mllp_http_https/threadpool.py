@@ -0,0 +1,226 @@
+### Bounded pool of threads for the socketserver servers of the threaded
+### engine, in place of a thread per connection: connections wait in a
+### bounded queue for a free thread, and are shed (HTTP 503, or closed for
+### MLLP) when the queue is full, when their client has too many, or when
+### they waited too long
+import collections
+import logging
+import threading
+import time
+
+from . import metrics
+from .asynchttp import response_head
+
+logger = logging.getLogger(__name__)
+
+
+class PoolOptions:
+    def __init__(
+        self,
+        max_workers,
+        queue_size=128,
+        backlog=128,
+        max_per_client=None,
+        max_wait=None,
+    ):
+        # Threads handling connections at most
+        self.max_workers = max_workers
+        # Accepted connections waiting for a thread at most
+        self.queue_size = queue_size
+        # Listen backlog of the socket: connections not accepted yet
+        self.backlog = backlog
+        # Connections of one client IP address queued or handled at most
+        # (unlimited if None)
+        self.max_per_client = max_per_client
+        # Seconds a connection waits for a thread at most before being shed
+        # (unlimited if None)
+        self.max_wait = max_wait
+
+
+# Why connections are shed
+REASONS = {
+    "queue": "accept queue full",
+    "client": "too many connections from the client",
+    "wait": "waited too long for a thread",
+}
+
+
+def client_host(client_address):
+    return client_address[0] if isinstance(client_address, tuple) else client_address
+
+
+class WorkerPool:
+    # Threads are started as connections are queued, up to max_workers, and
+    # are kept for the next connections
+
+    def __init__(self, options, handle):
+        self.options = options
+        self.handle = handle  # handle(request, client_address, seconds queued)
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.queue = collections.deque()  # (request, client_address, time queued)
+        self.clients = collections.Counter()  # connections queued or handled per host
+        self.threads = []
+        self.idle = 0
+        self.busy = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.closed = False
+
+    def submit(self, request, client_address):
+        # Queues a connection. Returns None, or the reason to shed it.
+        host = client_host(client_address)
+        with self.lock:
+            limit = self.options.max_per_client
+            if limit is not None and limit <= self.clients[host]:
+                return "client"
+            if self.options.queue_size <= len(self.queue):
+                return "queue"
+            self.clients[host] += 1
+            self.queue.append((request, client_address, time.monotonic()))
+            self.accepted += 1
+            if (
+                self.idle < len(self.queue)
+                and len(self.threads) < self.options.max_workers
+            ):
+                thread = threading.Thread(
+                    target=self._work,
+                    daemon=True,
+                    name="Worker-{}".format(len(self.threads)),
+                )
+                self.threads.append(thread)
+                thread.start()
+            else:
+                self.ready.notify()
+        return None
+
+    def count_rejected(self):
+        with self.lock:
+            self.rejected += 1
+
+    def _work(self):
+        while True:
+            with self.lock:
+                while not self.queue and not self.closed:
+                    self.idle += 1
+                    self.ready.wait()
+                    self.idle -= 1
+                if self.closed:
+                    return
+                request, client_address, queued = self.queue.popleft()
+                self.busy += 1
+            try:
+                self.handle(request, client_address, time.monotonic() - queued)
+            finally:
+                host = client_host(client_address)
+                with self.lock:
+                    self.busy -= 1
+                    self.clients[host] -= 1
+                    if not self.clients[host]:
+                        del self.clients[host]
+
+    def close(self):
+        # Stops the threads once their connection is handled. Returns the
+        # connections still queued.
+        with self.lock:
+            self.closed = True
+            queued, self.queue = list(self.queue), collections.deque()
+            self.ready.notify_all()
+        return [request for request, client_address, queued_at in queued]
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "threads": len(self.threads),
+                "idle": self.idle,
+                "busy": self.busy,
+                "queued": len(self.queue),
+                "max": self.options.max_workers,
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+            }
+
+
+class ThreadPoolMixIn:
+    # For socketserver servers, before ThreadingMixIn: with pool (a
+    # PoolOptions), connections are handled by a WorkerPool, and those shed
+    # are passed to reject_request(request, reason) before being closed.
+    # Without pool, a thread is started for each connection (ThreadingMixIn).
+
+    def __init__(self, *args, pool=None, **kwargs):
+        self.pool = None
+        if pool is not None:
+            self.request_queue_size = pool.backlog
+            self.pool = WorkerPool(pool, self.process_queued)
+            metrics.REGISTRY.register(
+                metrics.ThreadPoolGauge("mllp_bridge_threads", self.pool)
+            )
+            logger.info(
+                "Thread pool: %s threads, %s queued connections, backlog %s",
+                pool.max_workers,
+                pool.queue_size,
+                pool.backlog,
+            )
+        super().__init__(*args, **kwargs)
+
+    def process_request(self, request, client_address):
+        if self.pool is None:
+            super().process_request(request, client_address)
+            return
+        reason = self.pool.submit(request, client_address)
+        if reason is not None:
+            self.shed_request(request, client_address, reason)
+
+    def process_queued(self, request, client_address, wait):
+        max_wait = self.pool.options.max_wait
+        if max_wait is not None and max_wait < wait:
+            self.shed_request(request, client_address, "wait")
+            return
+        # Same as ThreadingMixIn.process_request_thread
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def shed_request(self, request, client_address, reason):
+        self.pool.count_rejected()
+        metrics.ERRORS.inc("overload")
+        logger.warning(
+            "Connection from %s rejected: %s",
+            client_host(client_address),
+            REASONS[reason],
+        )
+        try:
+            self.reject_request(request, reason)
+        except OSError as e:
+            logger.debug("Rejection not sent: %s", e)
+        finally:
+            self.shutdown_request(request)
+
+    def reject_request(self, request, reason):
+        # MLLP has no way to refuse a connection: it is closed
+        pass
+
+    def server_close(self):
+        super().server_close()
+        if self.pool is not None:
+            for request in self.pool.close():
+                self.shutdown_request(request)
+
+
+class HttpThreadPoolMixIn(ThreadPoolMixIn):
+    # For the HTTP servers: connections shed are answered 503, before their
+    # request is read
+
+    def reject_request(self, request, reason):
+        request.sendall(
+            response_head(503, [("Content-Length", 0), ("Connection", "close")])
+        )
+
+
+def listen_backlog(options):
+    # Listen backlog of the asyncio engine, which has no threads to pool:
+    # that of options (a PoolOptions, or None for the asyncio default)
+    return 100 if options is None else options.backlog
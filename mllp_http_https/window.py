@@ -0,0 +1,165 @@
+### Bounded in-flight forwarding on one MLLP connection of mllp2http and
+### mllp2https: messages keep being read while up to size of them are sent
+### to the HTTP(S) server, and the responses are written back in order
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Window:
+    # For the threaded engine. submit() blocks the reading thread while
+    # size messages are in flight (backpressure on the sender). Messages are
+    # sent by forward(message) in a pool of size threads, and a writer
+    # thread passes the responses, in the order of the messages, to
+    # reply(response). The first error is passed to fail(error), then stop()
+    # is called to stop reading, and later responses are dropped.
+
+    def __init__(self, size, forward, reply, fail, stop):
+        self.forward = forward
+        self.reply = reply
+        self.fail = fail
+        self.stop = stop
+        self.slots = threading.BoundedSemaphore(size)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            size, thread_name_prefix="Forward"
+        )
+        self.responses = queue.SimpleQueue()  # futures in order, None at the end
+        self.failed = False
+        self.writer = threading.Thread(target=self._write, daemon=True, name="Reply")
+        self.writer.start()
+
+    def submit(self, message):
+        # False once failed: the connection is to be closed
+        self.slots.acquire()
+        if self.failed:
+            self.slots.release()
+            return False
+        self.responses.put(self.executor.submit(self.forward, message))
+        return True
+
+    def put(self, response):
+        # Passes response to reply() in turn, in place of the response of a
+        # message that is not forwarded (a NACK)
+        future = concurrent.futures.Future()
+        future.set_result(response)
+        self.slots.acquire()
+        if self.failed:
+            self.slots.release()
+            return False
+        self.responses.put(future)
+        return True
+
+    def _write(self):
+        while True:
+            future = self.responses.get()
+            if future is None:
+                return
+            try:
+                if self.failed:
+                    future.cancel()
+                    continue
+                try:
+                    response = future.result()
+                except Exception as e:
+                    self._abort(e, self.fail)
+                    continue
+                try:
+                    self.reply(response)
+                except Exception as e:
+                    self._abort(e, lambda e: logger.info("MLLP write failed: %s", e))
+            finally:
+                self.slots.release()
+
+    def _abort(self, error, log):
+        self.failed = True
+        log(error)
+        try:
+            self.stop()
+        except OSError:
+            pass
+
+    def close(self):
+        # Waits for the responses of the messages in flight to be written
+        self.responses.put(None)
+        self.writer.join()
+        self.executor.shutdown(wait=False)
+
+
+class AsyncWindow:
+    # Same as Window, for the asyncio engine: one task per message in
+    # flight, and a writer task. forward, reply and fail are coroutine
+    # functions, stop a function.
+
+    def __init__(self, size, forward, reply, fail, stop):
+        self.forward = forward
+        self.reply = reply
+        self.fail = fail
+        self.stop = stop
+        self.slots = asyncio.Semaphore(size)
+        self.responses = asyncio.Queue()  # tasks in order, None at the end
+        self.in_flight = collections.deque()
+        self.failed = False
+        self.writer = asyncio.ensure_future(self._write())
+
+    async def submit(self, message):
+        await self.slots.acquire()
+        if self.failed:
+            self.slots.release()
+            return False
+        task = asyncio.ensure_future(self.forward(message))
+        self.in_flight.append(task)
+        self.responses.put_nowait(task)
+        return True
+
+    async def put(self, response):
+        await self.slots.acquire()
+        if self.failed:
+            self.slots.release()
+            return False
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(response)
+        self.in_flight.append(future)
+        self.responses.put_nowait(future)
+        return True
+
+    async def _write(self):
+        while True:
+            task = await self.responses.get()
+            if task is None:
+                return
+            try:
+                if self.failed:
+                    task.cancel()
+                    continue
+                try:
+                    response = await task
+                except Exception as e:
+                    self.failed = True
+                    await self.fail(e)
+                    self.stop()
+                    continue
+                try:
+                    await self.reply(response)
+                except Exception as e:
+                    self.failed = True
+                    logger.info("MLLP write failed: %s", e)
+                    self.stop()
+            finally:
+                self.in_flight.popleft()
+                self.slots.release()
+
+    async def close(self):
+        self.responses.put_nowait(None)
+        try:
+            await asyncio.shield(self.writer)
+        except asyncio.CancelledError:
+            # The connection is cancelled (server stopping)
+            self.writer.cancel()
+            for task in self.in_flight:
+                task.cancel()
+            raise
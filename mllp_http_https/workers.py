@@ -0,0 +1,150 @@
+### Pre-forked worker processes sharing one listening port
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+from .log2file import stop_logging
+
+logger = logging.getLogger(__name__)
+
+# Workers bind the same port with SO_REUSEPORT, and the kernel spreads the
+# connections over them. Needs fork() (not on Windows).
+SUPPORTED = hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")
+
+# Seconds between two starts of the same worker, so that a worker failing
+# at startup (e.g. port in use) is not restarted in a tight loop
+RESTART_DELAY = 1
+
+# Seconds for the workers to exit after SIGTERM, before SIGKILL
+STOP_TIMEOUT = 10
+
+# Seconds between two checks of the supervisor for exited workers
+POLL_INTERVAL = 0.1
+
+_index = None  # index of this worker, None outside of a worker
+
+
+def worker_index():
+    return _index
+
+
+def reuse_port():
+    # Whether the servers of this process bind with SO_REUSEPORT
+    return _index is not None
+
+
+class ReusePortMixin:
+    # For socketserver servers
+
+    def server_bind(self):
+        if reuse_port():
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+def _run_worker(index, target, args):
+    # In the forked process: runs target(*args) and exits, never returns
+    global _index
+    _index = index
+    # SIGTERM stops the worker the same way as Ctrl-C stops a single process
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    code = 0
+    try:
+        logger.info("Worker %s started (pid %s)", index, os.getpid())
+        target(*args)
+    except KeyboardInterrupt:
+        pass
+    except SystemExit as e:
+        code = e.code
+    except BaseException:
+        logger.exception("Worker %s failed", index)
+        code = 1
+    # os._exit: neither unwinds into the frames of the supervisor nor runs
+    # its atexit handlers, and does not wait for the threads of connections
+    # still open
+    if code is None:
+        code = 0
+    elif not isinstance(code, int):
+        print(code, file=sys.stderr)
+        code = 1
+    stop_logging()
+    logging.shutdown()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
+
+
+def supervise(count, target, *args):
+    # Runs target(*args) in count forked workers, restarts the workers that
+    # exit, and stops them all on SIGTERM or SIGINT. Everything target
+    # creates (MLLP connection pool, HTTP sessions, metrics server) is per
+    # worker.
+    if not SUPPORTED:
+        logger.warning("Workers need fork() and SO_REUSEPORT, running a single process")
+        target(*args)
+        return
+
+    workers = {}  # pid: (index, start time)
+    stopping = None  # time by which the workers have to exit
+
+    def spawn(index):
+        pid = os.fork()
+        if not pid:
+            _run_worker(index, target, args)
+        workers[pid] = (index, time.monotonic())
+
+    def stop(signum, frame):
+        nonlocal stopping
+        if stopping is None:
+            logger.info("Stopping %s workers", len(workers))
+            stopping = time.monotonic() + STOP_TIMEOUT
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    previous = {
+        signum: signal.signal(signum, stop)
+        for signum in (signal.SIGTERM, signal.SIGINT)
+    }
+    try:
+        for index in range(count):
+            spawn(index)
+        while workers:
+            # Polled: a blocking waitpid is resumed after the signal
+            # handlers run (PEP 475), and would never get to the SIGKILL
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                if stopping is not None and stopping < time.monotonic():
+                    for pid in list(workers):
+                        logger.warning(
+                            "Killing worker %s (pid %s)", workers[pid][0], pid
+                        )
+                        try:
+                            os.kill(pid, signal.SIGKILL)
+                        except ProcessLookupError:
+                            pass
+                    stopping = float("inf")
+                time.sleep(POLL_INTERVAL)
+                continue
+            index, started = workers.pop(pid)
+            if stopping is not None:
+                continue
+            logger.error(
+                "Worker %s (pid %s) exited with %s, restarting",
+                index,
+                pid,
+                os.waitstatus_to_exitcode(status),
+            )
+            time.sleep(max(0, started + RESTART_DELAY - time.monotonic()))
+            if stopping is None:
+                spawn(index)
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+    logger.info("Workers stopped")
@@ -30,11 +30,9 @@ setuptools.setup(
     },
     long_description=long_description,
     long_description_content_type="text/markdown",
-    install_requires=[
-        "requests"
-    ],
+    install_requires=["requests"],
     name="mllp-https",
-    packages=setuptools.find_packages(),
+    packages=setuptools.find_packages(exclude=["benchmarks", "benchmarks.*"]),
     project_urls={
         "Issues": "https://github.com/tiagoepr/mllp-https/issues",
         "Original Project by Rivet Health": "https://github.com/rivethealth/mllp-http/",
@@ -0,0 +1,52 @@
+# MllpDecoder against the byte-at-a-time read_mllp, however the stream is
+# split into chunks (see benchmarks/mllp_framing.py)
+import random
+
+import pytest
+
+from benchmarks.mllp_framing import (
+    check_roundtrip,
+    check_stream,
+    corpus,
+    malformed,
+    random_stream,
+)
+from mllp_http_https.mllp import frame_mllp
+
+SEED = 20220801
+
+
+@pytest.mark.parametrize(
+    "name, stream, frames", malformed(), ids=[name for name, _, _ in malformed()]
+)
+def test_malformed(name, stream, frames):
+    # Truncated frames and garbage around them: the same frames, then an
+    # error, at every split
+    decoded, error = check_stream(stream, random.Random(SEED), exhaustive=True)
+    assert decoded == frames
+    assert error is not False
+
+
+@pytest.mark.parametrize("name", ["ack", "oru-1mb", "mixed"])
+def test_corpus(name):
+    payloads = dict(corpus(random.Random(SEED)))[name][:10]
+    if name == "oru-1mb":
+        payloads = [payloads[0][:2048]]
+    stream = b"".join(frame_mllp(payload) for payload in payloads)
+    decoded, error = check_stream(
+        stream, random.Random(SEED), exhaustive=len(stream) < 4096
+    )
+    assert decoded == payloads
+    assert error is False
+
+
+def test_fuzz():
+    rng = random.Random(SEED)
+    for _ in range(500):
+        stream, payloads, damaged = random_stream(rng)
+        decoded, error = check_stream(stream, rng)
+        if not damaged:
+            assert decoded == payloads
+            assert error is False
+        for payload in payloads:
+            check_roundtrip(payload, rng)
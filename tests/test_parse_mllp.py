@@ -0,0 +1,39 @@
+# parse_mllp in each ParseMode, against the previous str-based
+# implementation (see benchmarks/parse_mllp.py)
+import pytest
+
+from benchmarks.parse_mllp import corpus, legacy_parse_mllp
+from mllp_http_https.mllp import ParseMode, frame_mllp, parse_mllp
+
+PAYLOADS = list(corpus())
+
+
+@pytest.mark.parametrize("framed", [False, True])
+@pytest.mark.parametrize("payload", PAYLOADS)
+def test_raw(payload, framed):
+    data = frame_mllp(payload) if framed else payload
+    assert parse_mllp(data, ParseMode.RAW) == frame_mllp(payload)
+
+
+@pytest.mark.parametrize("framed", [False, True])
+@pytest.mark.parametrize("payload", PAYLOADS)
+def test_strip_framing(payload, framed):
+    data = frame_mllp(payload) if framed else payload
+    expected = legacy_parse_mllp(frame_mllp(payload), crlf=False)
+    assert parse_mllp(data, ParseMode.STRIP_FRAMING) == expected
+
+
+@pytest.mark.parametrize("framed", [False, True])
+@pytest.mark.parametrize("payload", PAYLOADS)
+def test_crlf(payload, framed):
+    data = frame_mllp(payload) if framed else payload
+    expected = legacy_parse_mllp(frame_mllp(payload), crlf=True)
+    assert parse_mllp(data, ParseMode.CRLF) == expected
+
+
+def test_crlf_not_utf8():
+    # Passed through instead of raising
+    latin1 = "PID|||1||Müller\r".encode("latin-1")
+    assert parse_mllp(frame_mllp(latin1), ParseMode.CRLF) == latin1.replace(
+        b"\r", b"\r\n"
+    )